@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'tools.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,6 +80,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Workflow workers write run progress concurrently with the web process
+        'OPTIONS': {'timeout': 20},
     }
 }
 
@@ -130,3 +133,77 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Workflow graphs are posted as JSON; generated workflows with thousands of nodes exceed Django's 2.5 MB default
+DATA_UPLOAD_MAX_MEMORY_SIZE = int(os.environ.get('DATA_UPLOAD_MAX_MEMORY_SIZE', 64 * 1024 * 1024))
+
+# Workflow execution
+# Maximum number of workflow nodes running at the same time
+WORKFLOW_MAX_WORKERS = int(os.environ.get('WORKFLOW_MAX_WORKERS', os.cpu_count() or 1))
+# "fail_fast" stops launching nodes after the first failure, "continue" keeps independent branches running
+WORKFLOW_FAILURE_POLICY = os.environ.get('WORKFLOW_FAILURE_POLICY', 'fail_fast')
+# A running run whose process has not refreshed its heartbeat for this many seconds is marked failed,
+# so runs of killed workers can be resumed
+WORKFLOW_RUN_STALE_SECONDS = int(os.environ.get('WORKFLOW_RUN_STALE_SECONDS', 120))
+# Lines of tool output kept in memory per process; the full output is written to media/logs
+TOOL_LOG_TAIL_LINES = int(os.environ.get('TOOL_LOG_TAIL_LINES', 200))
+# Tool processes one server process runs at once (workflow nodes, tool runs and help lookups); more wait for a slot
+TOOL_MAX_CONCURRENT_PROCESSES = int(os.environ.get('TOOL_MAX_CONCURRENT_PROCESSES', 256))
+# Seconds a tool may run before its process group is stopped; 0 means no limit.
+# Tools override it with "timeout" in tools.json, workflow nodes with "timeout" in their data
+TOOL_TIMEOUT_SECONDS = int(os.environ.get('TOOL_TIMEOUT_SECONDS', 0)) or None
+# Seconds a stopped (timed out or cancelled) tool gets between SIGTERM and SIGKILL
+TOOL_KILL_GRACE_SECONDS = int(os.environ.get('TOOL_KILL_GRACE_SECONDS', 10))
+# Help texts, versions and binary paths of tools, keyed by the binary's path, size and mtime
+TOOL_INFO_CACHE = os.path.join(BASE_DIR, '.tool_info.json')
+
+# Connect stream-capable outputs and inputs ("stream": true in tools.json) of workflow nodes
+# through named pipes, running producer and consumer together without an intermediate file
+WORKFLOW_STREAMING = os.environ.get('WORKFLOW_STREAMING', '1') == '1'
+
+# Node result cache: outputs of finished nodes are reused when tool, parameters and inputs are unchanged
+WORKFLOW_CACHE_ENABLED = os.environ.get('WORKFLOW_CACHE_ENABLED', '1') == '1'
+WORKFLOW_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache')
+# Least recently used entries are evicted above this size
+WORKFLOW_CACHE_MAX_BYTES = int(os.environ.get('WORKFLOW_CACHE_MAX_BYTES', 50 * 1024 ** 3))
+
+# Resource-aware scheduling: nodes start only when the CPUs and memory their tool declares
+# under "resources" in tools.json are free, across the web process and all workers
+WORKFLOW_RESOURCE_SCHEDULING = os.environ.get('WORKFLOW_RESOURCE_SCHEDULING', '1') == '1'
+# Capacity to schedule against; empty means the whole machine
+WORKFLOW_CPUS = int(os.environ.get('WORKFLOW_CPUS', 0)) or None
+WORKFLOW_MEMORY_MB = int(os.environ.get('WORKFLOW_MEMORY_MB', 0)) or None
+# Shared reservation file
+WORKFLOW_RESOURCE_STATE = os.path.join(BASE_DIR, '.workflow_resources.json')
+
+# "bgzf" stores uploaded FASTQ/FASTA files block-gzip compressed as <name>.gz with a .gzi block index
+UPLOAD_COMPRESSION = os.environ.get('UPLOAD_COMPRESSION', '')
+UPLOAD_COMPRESSION_LEVEL = int(os.environ.get('UPLOAD_COMPRESSION_LEVEL', 6))
+# Compression processes; empty means one per CPU
+UPLOAD_COMPRESSION_WORKERS = int(os.environ.get('UPLOAD_COMPRESSION_WORKERS', 0)) or None
+
+# Uploads are stored once per content under UPLOAD_BLOB_DIR and hard linked into tool directories
+UPLOAD_DEDUPLICATION = os.environ.get('UPLOAD_DEDUPLICATION', '1') == '1'
+# Must be on the same file system as MEDIA_ROOT/my_files for hard links
+UPLOAD_BLOB_DIR = os.path.join(MEDIA_ROOT, 'blobs')
+
+# Retention of media/my_files, applied by manage.py sweep_files (see tools/retention.py).
+# Intermediate outputs of finished workflow runs are deleted after this many days; 0 keeps them
+RETENTION_INTERMEDIATE_DAYS = float(os.environ.get('RETENTION_INTERMEDIATE_DAYS', 0)) or None
+# Above this size least recently used files are evicted; 0 means no cap
+RETENTION_MAX_BYTES = int(os.environ.get('RETENTION_MAX_BYTES', 0)) or None
+# Whether files no node of their run consumed survive the size cap
+RETENTION_KEEP_FINAL_OUTPUTS = os.environ.get('RETENTION_KEEP_FINAL_OUTPUTS', '1') == '1'
+# Files modified more recently than this are never deleted
+RETENTION_MIN_AGE_HOURS = float(os.environ.get('RETENTION_MIN_AGE_HOURS', 1))
+# Files deleted per batch and seconds between batches, so sweeps leave disk bandwidth to running tools
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', 200))
+RETENTION_BATCH_PAUSE = float(os.environ.get('RETENTION_BATCH_PAUSE', 1.0))
+
+# Record indexes of FASTQ/FASTA files, built on their first preview
+PREVIEW_INDEX_DIR = os.path.join(MEDIA_ROOT, 'preview_index')
+
+# Metrics in the Prometheus text format at /tools/metrics/, only answered for these client addresses
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+# Per-process files of metrics shared by the server and the workflow workers
+METRICS_DIR = os.path.join(BASE_DIR, '.metrics')
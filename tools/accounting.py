@@ -0,0 +1,76 @@
+"""
+Per-process resource records and per-tool summaries.
+
+Every tool process started by a workflow node or the tool page is stored as a
+ProcessUsage row, so tool runtimes and memory can be compared across runs,
+for example before and after upgrading a tool.
+"""
+from datetime import timedelta
+
+from django.db.models import Avg, Count, F, Max, Q, Sum
+from django.utils import timezone
+
+from .models import ProcessUsage
+
+USAGE_FIELDS = ("wall_seconds", "user_seconds", "system_seconds", "max_rss_kb", "read_bytes", "write_bytes")
+
+
+def record_usage(tool, result, run=None, node_id=""):
+    """
+    Stores the usage of a finished ProcessResult.
+    """
+    if not result.usage:
+        return None
+    command = result.command
+    if not isinstance(command, str):
+        command = " ".join(command)
+    return ProcessUsage.objects.create(
+        run=run,
+        node_id=node_id,
+        tool=tool,
+        command=command,
+        returncode=result.returncode,
+        **{field: result.usage.get(field) for field in USAGE_FIELDS},
+    )
+
+
+def usage_to_dict(usage):
+    data = {"tool": usage.tool, "returncode": usage.returncode}
+    data.update({field: getattr(usage, field) for field in USAGE_FIELDS})
+    return data
+
+
+def tool_summary(tool=None, days=None):
+    """
+    Returns per-tool aggregates of recorded processes, optionally for one tool or the last days.
+    """
+    queryset = ProcessUsage.objects.all()
+    if tool:
+        queryset = queryset.filter(tool=tool)
+    if days:
+        queryset = queryset.filter(created_at__gte=timezone.now() - timedelta(days=days))
+
+    rows = (
+        queryset.values("tool")
+        .annotate(
+            processes=Count("id"),
+            failures=Count("id", filter=~Q(returncode=0)),
+            total_wall_seconds=Sum("wall_seconds"),
+            avg_wall_seconds=Avg("wall_seconds"),
+            max_wall_seconds=Max("wall_seconds"),
+            total_cpu_seconds=Sum(F("user_seconds") + F("system_seconds")),
+            avg_cpu_seconds=Avg(F("user_seconds") + F("system_seconds")),
+            avg_max_rss_kb=Avg("max_rss_kb"),
+            max_rss_kb=Max("max_rss_kb"),
+            avg_read_bytes=Avg("read_bytes"),
+            avg_write_bytes=Avg("write_bytes"),
+            last_run=Max("created_at"),
+        )
+        .order_by("tool")
+    )
+
+    summary = []
+    for row in rows:
+        row["last_run"] = row["last_run"].isoformat() if row["last_run"] else None
+        summary.append(row)
+    return summary
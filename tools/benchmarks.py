@@ -0,0 +1,243 @@
+"""
+Benchmarks of the orchestration code with stub tools (manage.py benchmark).
+
+Everything runs against a throwaway test database and a temporary MEDIA_ROOT,
+so the numbers only reflect this code: the stub tool copies its input to its
+output and exits. Results are plain dicts so they can be dumped as JSON and
+compared between versions.
+"""
+import json
+import os
+import platform
+import random
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+from django.test import Client, override_settings
+
+from . import file_index
+from .views import get_directory_structure
+
+STUB_TOOL = "bench_stub"
+STUB_SCRIPT = '#!/bin/sh\n# Benchmark stub: copies the input file ($1) to the output file (-o $3)\ncat "$1" > "$3"\n'
+
+READ_LENGTH = 100
+
+
+def write_stub(directory):
+    path = os.path.join(directory, "bench_stub.sh")
+    with open(path, "w") as f:
+        f.write(STUB_SCRIPT)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def stub_tool_def(stub_path):
+    return {
+        "command": stub_path,
+        "options": [
+            {"label": "input", "flag": None, "type": "file", "mandatory": True},
+            {"label": "output", "flag": "-o", "type": "text", "mandatory": True},
+        ],
+        "resources": {"cpus": 1, "memory_mb": 0},
+    }
+
+
+def _stub_node(node_id, tool_def):
+    # "filename" lets downstream nodes pick up this node's output
+    return {
+        "id": node_id,
+        "data": {"label": STUB_TOOL, "parameters": {"output": "out.txt", "filename": "out.txt"}, "toolDef": tool_def},
+    }
+
+
+def build_workflow(shape, size, tool_def, seed_name):
+    """
+    Returns (nodes, edges) with size nodes: a seed file node and size - 1 stub tool nodes.
+
+    "wide" fans the seed out to every tool, "deep" chains the tools one after another.
+    """
+    nodes = [{"id": "seed", "data": {"label": "file", "parameters": {"filename": seed_name}}}]
+    edges = []
+    previous = "seed"
+    for i in range(1, size):
+        node_id = f"n{i}"
+        nodes.append(_stub_node(node_id, tool_def))
+        source = "seed" if shape == "wide" else previous
+        edges.append({"source": source, "target": node_id, "data": {"param": "input"}})
+        previous = node_id
+    return nodes, edges
+
+
+def bench_workflow(client, shape, size, tool_def, seed_name, max_workers):
+    nodes, edges = build_workflow(shape, size, tool_def, seed_name)
+    body = json.dumps({
+        "workflow_name": f"bench_{shape}_{size}",
+        "nodes": nodes,
+        "edges": edges,
+        "max_workers": max_workers,
+        "use_cache": False,
+    })
+
+    start = time.perf_counter()
+    response = client.post("/tools/api/workflows/execute/", body, content_type="application/json")
+    elapsed = time.perf_counter() - start
+
+    result = response.json()
+    tool_seconds = sum(u.get("wall_seconds", 0) for u in result.get("usage", {}).values())
+    tool_nodes = size - 1
+    return {
+        "benchmark": "execute_workflow",
+        "shape": shape,
+        "nodes": size,
+        "max_workers": max_workers,
+        "success": bool(result.get("success")),
+        "error": result.get("error"),
+        "seconds": elapsed,
+        "tool_seconds": tool_seconds,
+        # Time not spent inside tool processes, spread over the nodes
+        "overhead_ms_per_node": max(0.0, elapsed - tool_seconds / max_workers) * 1000 / max(tool_nodes, 1),
+        "nodes_per_second": tool_nodes / elapsed if elapsed else None,
+    }
+
+
+def fastq_block(size=1024 * 1024, seed=0):
+    """
+    Returns about size bytes of FASTQ records with random bases, compressible like real reads.
+    """
+    rng = random.Random(seed)
+    records = []
+    total = 0
+    while total < size:
+        bases = "".join(rng.choice("ACGT") for _ in range(READ_LENGTH))
+        quality = "".join(rng.choice("FGHI") for _ in range(READ_LENGTH))
+        record = f"@read_{len(records)}\n{bases}\n+\n{quality}\n".encode()
+        records.append(record)
+        total += len(record)
+    return b"".join(records)
+
+
+def make_tree(root, file_count, files_per_dir=1000):
+    """
+    Creates file_count empty files spread over sub directories of files_per_dir files.
+    """
+    for i in range(file_count):
+        directory = os.path.join(root, f"dir_{i // files_per_dir:05d}")
+        if i % files_per_dir == 0:
+            os.makedirs(directory, exist_ok=True)
+        open(os.path.join(directory, f"file_{i:07d}.txt"), "w").close()
+
+
+def bench_directory(file_count):
+    root = os.path.join(file_index.files_root(), "bench_tree")
+    make_tree(root, file_count)
+
+    results = []
+    start = time.perf_counter()
+    get_directory_structure(root)
+    results.append({"benchmark": "get_directory_structure", "files": file_count, "seconds": time.perf_counter() - start})
+
+    start = time.perf_counter()
+    file_index.rebuild_index()
+    results.append({"benchmark": "rebuild_file_index", "files": file_count, "seconds": time.perf_counter() - start})
+
+    start = time.perf_counter()
+    file_index.list_directory("bench_tree/dir_00000", page=1, page_size=100)
+    results.append({"benchmark": "list_directory", "files": file_count, "seconds": time.perf_counter() - start})
+
+    shutil.rmtree(root)
+    file_index.remove_path("bench_tree")
+    return results
+
+
+def bench_download(client, total_mb, file_mb=64):
+    """
+    Streams a ZIP of a folder holding total_mb of FASTQ text through download_folder.
+    """
+    root = os.path.join(file_index.files_root(), "bench_download")
+    os.makedirs(root, exist_ok=True)
+    block = fastq_block()
+    remaining = total_mb
+    index = 0
+    while remaining > 0:
+        with open(os.path.join(root, f"reads_{index:03d}.fastq"), "wb") as f:
+            for _ in range(min(file_mb, remaining)):
+                f.write(block)
+        remaining -= file_mb
+        index += 1
+    input_bytes = sum(os.path.getsize(os.path.join(root, name)) for name in os.listdir(root))
+
+    start = time.perf_counter()
+    response = client.get("/tools/download-folder/bench_download/")
+    sent = sum(len(chunk) for chunk in response.streaming_content)
+    elapsed = time.perf_counter() - start
+
+    shutil.rmtree(root)
+    return {
+        "benchmark": "download_folder",
+        "input_bytes": input_bytes,
+        "zip_bytes": sent,
+        "seconds": elapsed,
+        "input_mb_per_second": input_bytes / (1024 * 1024) / elapsed if elapsed else None,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, shapes, max_workers, file_count, download_mb, log=print):
+    """
+    Runs the selected benchmarks in a temporary MEDIA_ROOT and returns the report.
+
+    Must be called with a test database set up (see the benchmark command).
+    """
+    workdir = tempfile.mkdtemp(prefix="dynamic_tools_bench_")
+    overrides = {
+        "MEDIA_ROOT": workdir,
+        "WORKFLOW_CACHE_DIR": os.path.join(workdir, "cache"),
+        "WORKFLOW_RESOURCE_STATE": os.path.join(workdir, "resources.json"),
+        "TOOL_INFO_CACHE": os.path.join(workdir, "tool_info.json"),
+    }
+
+    results = []
+    try:
+        with override_settings(**overrides):
+            os.makedirs(file_index.files_root(), exist_ok=True)
+            tool_def = stub_tool_def(write_stub(workdir))
+            seed_name = "bench_seed.txt"
+            with open(os.path.join(file_index.files_root(), seed_name), "w") as f:
+                f.write("ACGT\n")
+
+            client = Client()
+            for shape in shapes:
+                for size in sizes:
+                    log(f"execute_workflow: {shape} DAG with {size} nodes")
+                    results.append(bench_workflow(client, shape, size, tool_def, seed_name, max_workers))
+            if file_count:
+                log(f"Directory listing: {file_count} files")
+                results.extend(bench_directory(file_count))
+            if download_mb:
+                log(f"download_folder: {download_mb} MB")
+                results.append(bench_download(client, download_mb))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "revision": _git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
@@ -0,0 +1,307 @@
+"""
+BGZF (blocked gzip) files as written by bgzip/htslib.
+
+A BGZF file is a series of gzip members of at most 64 KiB of data each, so
+every gzip reader (FastQC, SPAdes, zcat) reads it as one stream, while the
+.gzi index next to it maps uncompressed offsets to blocks for random access.
+Blocks are compressed independently, which lets compress_file spread them
+over a process pool.
+
+This module does not import Django so pool workers start quickly.
+"""
+import errno
+import gzip
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Uncompressed bytes per block, as bgzip uses
+BLOCK_DATA_SIZE = 0xff00
+MAX_BLOCK_SIZE = 0x10000
+# Blocks per pool task (about 4 MiB), so tasks are large compared to the pickling overhead
+BATCH_BLOCKS = 64
+# Files smaller than this are compressed without starting a pool
+POOL_THRESHOLD = 8 * 1024 * 1024
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+INDEX_SUFFIX = ".gzi"
+
+# ID1 ID2 CM FLG MTIME XFL OS XLEN, then the "BC" extra subfield with BSIZE - 1
+_HEADER = struct.Struct("<4BI2BH2BHH")
+_TRAILER = struct.Struct("<II")
+_U64 = struct.Struct("<Q")
+_PAIR = struct.Struct("<QQ")
+
+
+def compress_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) > MAX_BLOCK_SIZE - _HEADER.size - _TRAILER.size:
+        # Incompressible data: stored deflate blocks always fit
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    block_size = _HEADER.size + len(compressed) + _TRAILER.size
+    header = _HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1)
+    return header + compressed + _TRAILER.pack(zlib.crc32(data), len(data))
+
+
+def _compress_batch(chunks, level):
+    return [(compress_block(chunk, level), len(chunk)) for chunk in chunks]
+
+
+def _batches(f):
+    while True:
+        chunks = []
+        for _ in range(BATCH_BLOCKS):
+            chunk = f.read(BLOCK_DATA_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        if not chunks:
+            return
+        yield chunks
+
+
+def is_bgzf(path):
+    try:
+        with open(path, "rb") as f:
+            header = f.read(_HEADER.size)
+    except OSError:
+        return False
+    return len(header) == _HEADER.size and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+def compress_file(source, target, level=6, workers=None):
+    """
+    Writes source as BGZF to target and its block index to target + ".gzi".
+
+    Batches of blocks are compressed by a pool of workers processes (all CPUs
+    by default) with at most two batches per worker in flight, so memory use
+    does not grow with the file. Returns (uncompressed bytes, compressed bytes).
+    """
+    workers = workers or os.cpu_count() or 1
+    use_pool = workers > 1 and os.path.getsize(source) >= POOL_THRESHOLD
+    # forkserver: forking a threaded web server process is not safe
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("forkserver")) if use_pool else None
+
+    index = []
+    compressed_offset = 0
+    uncompressed_offset = 0
+    part_path = target + ".part"
+    try:
+        with open(source, "rb") as src, open(part_path, "wb") as out:
+            def write(blocks):
+                nonlocal compressed_offset, uncompressed_offset
+                for block, length in blocks:
+                    if compressed_offset:
+                        # Like bgzip, the first block (0, 0) is implied
+                        index.append((compressed_offset, uncompressed_offset))
+                    out.write(block)
+                    compressed_offset += len(block)
+                    uncompressed_offset += length
+
+            pending = deque()
+            for chunks in _batches(src):
+                if pool is None:
+                    write(_compress_batch(chunks, level))
+                    continue
+                pending.append(pool.submit(_compress_batch, chunks, level))
+                if len(pending) >= 2 * workers:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+            out.write(EOF_BLOCK)
+            compressed_offset += len(EOF_BLOCK)
+
+        with open(target + INDEX_SUFFIX, "wb") as f:
+            f.write(_U64.pack(len(index)))
+            for pair in index:
+                f.write(_PAIR.pack(*pair))
+        os.replace(part_path, target)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return uncompressed_offset, compressed_offset
+
+
+def _scan_blocks(f):
+    """
+    Returns the (compressed, uncompressed) offsets of all blocks by reading their headers.
+    """
+    blocks = []
+    compressed_offset = uncompressed_offset = 0
+    while True:
+        f.seek(compressed_offset)
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return blocks
+        block_size = _HEADER.unpack(header)[-1] + 1
+        f.seek(compressed_offset + block_size - _TRAILER.size)
+        _, length = _TRAILER.unpack(f.read(_TRAILER.size))
+        blocks.append((compressed_offset, uncompressed_offset))
+        compressed_offset += block_size
+        uncompressed_offset += length
+
+
+class BgzfReader:
+    """
+    Random access to the uncompressed content of a BGZF file.
+
+    Supports len(), slicing and find() like a read-only mmap, so code written
+    for memory-mapped files can read compressed ones. Recently used blocks are
+    kept decompressed.
+    """
+    CACHED_BLOCKS = 16
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._cache = OrderedDict()
+        try:
+            with open(path + INDEX_SUFFIX, "rb") as f:
+                count = _U64.unpack(f.read(_U64.size))[0]
+                data = f.read(count * _PAIR.size)
+            blocks = [(0, 0)] + [_PAIR.unpack_from(data, i * _PAIR.size) for i in range(count)]
+        except (OSError, struct.error):
+            blocks = _scan_blocks(self._file)
+        self._compressed = [c for c, _ in blocks]
+        self._uncompressed = [u for _, u in blocks]
+        self.size = self._uncompressed[-1] + len(self._block(len(blocks) - 1)) if blocks else 0
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self):
+        return self.size
+
+    def _block(self, i):
+        data = self._cache.get(i)
+        if data is not None:
+            self._cache.move_to_end(i)
+            return data
+        self._file.seek(self._compressed[i])
+        header = self._file.read(_HEADER.size)
+        block_size = _HEADER.unpack(header)[-1] + 1
+        compressed = self._file.read(block_size - _HEADER.size - _TRAILER.size)
+        data = zlib.decompress(compressed, -15)
+        self._cache[i] = data
+        if len(self._cache) > self.CACHED_BLOCKS:
+            self._cache.popitem(last=False)
+        return data
+
+    def _block_index(self, offset):
+        return bisect_right(self._uncompressed, offset) - 1
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("BgzfReader only supports contiguous slices")
+        start, stop, _ = key.indices(self.size)
+        parts = []
+        offset = start
+        while offset < stop:
+            i = self._block_index(offset)
+            data = self._block(i)
+            begin = offset - self._uncompressed[i]
+            if not data:
+                # The empty end-of-file block
+                break
+            part = data[begin:begin + stop - offset]
+            parts.append(part)
+            offset += len(part)
+        return b"".join(parts)
+
+    def find(self, sub, start=0):
+        """
+        Returns the uncompressed offset of the first occurrence of sub at or after start, or -1.
+        """
+        start = max(start, 0)
+        if start >= self.size:
+            return -1
+        i = self._block_index(start)
+        # The end of the previous block, for matches that span two blocks
+        carry = b""
+        while i < len(self._compressed):
+            data = self._block(i)
+            block_start = self._uncompressed[i]
+            if carry:
+                found = (carry + data[:len(sub) - 1]).find(sub)
+                if found != -1:
+                    return block_start - len(carry) + found
+            begin = max(start - block_start, 0)
+            found = data.find(sub, begin)
+            if found != -1:
+                return block_start + found
+            carry = data[max(begin, len(data) - len(sub) + 1):] if len(sub) > 1 else b""
+            i += 1
+        return -1
+
+
+class DecompressedStreams:
+    """
+    Named pipes through which tools that cannot read gzip get BGZF inputs decompressed.
+
+    add() returns the pipe path to put on the command line. Inside the with
+    block a thread per pipe writes the decompressed data as the tool reads
+    it; nothing is written to disk. Each pipe can be read once.
+    """
+    OPEN_POLL_INTERVAL = 0.05
+
+    def __init__(self):
+        self._dir = None
+        self._sources = []
+        self._threads = []
+        self._stop = threading.Event()
+
+    def add(self, path):
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix="bgzf_streams_")
+        name = os.path.basename(path)
+        if name.endswith(".gz"):
+            name = name[:-3]
+        fifo = os.path.join(self._dir, f"{len(self._sources)}_{name}")
+        os.mkfifo(fifo)
+        self._sources.append((path, fifo))
+        return fifo
+
+    def _feed(self, path, fifo):
+        # Opening the write end blocks until the tool opens the pipe, which it may never do
+        while True:
+            try:
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                if self._stop.wait(self.OPEN_POLL_INTERVAL):
+                    return
+        os.set_blocking(fd, True)
+        try:
+            with os.fdopen(fd, "wb") as out, gzip.open(path, "rb") as src:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+        except BrokenPipeError:
+            # The tool stopped reading
+            pass
+
+    def __enter__(self):
+        for path, fifo in self._sources:
+            thread = threading.Thread(target=self._feed, args=(path, fifo), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        if self._dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
@@ -0,0 +1,258 @@
+"""
+Content-addressed storage of uploaded files.
+
+Each distinct upload is stored once as settings.UPLOAD_BLOB_DIR/<ab>/<sha256>
+and shows up in tool directories as hard links to it, so uploading the same
+reads for five tools takes the disk space (and write time) of one. The
+sha256 is computed while the upload is written. Blobs are read-only because
+every link shares the same data.
+
+The link count of a blob is its reference count: deleting a file through
+remove_file or remove_tree removes the blob as well once no other link to
+it is left. Blobs are found from a link by their inode, through the
+symlinks in UPLOAD_BLOB_DIR/inodes.
+
+With UPLOAD_COMPRESSION="bgzf", FASTQ/FASTA blobs are stored compressed as
+<sha256>.gz plus their .gzi index (see bgzf.py), linked as <name>.gz.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import uuid
+
+from django.conf import settings
+
+from . import bgzf
+from .preview import EXTENSIONS as SEQUENCE_EXTENSIONS
+
+COMPRESSED_SUFFIX = ".gz"
+# Suffix of chunked uploads in progress (see uploads.py), whose names are taken
+PART_SUFFIX = ".part"
+
+
+def blob_dir():
+    return getattr(settings, "UPLOAD_BLOB_DIR", None) or os.path.join(settings.MEDIA_ROOT, "blobs")
+
+
+def dedup_enabled():
+    return getattr(settings, "UPLOAD_DEDUPLICATION", True)
+
+
+def _compress(filename):
+    return (
+        getattr(settings, "UPLOAD_COMPRESSION", "") == "bgzf"
+        and os.path.splitext(filename)[1].lower() in SEQUENCE_EXTENSIONS
+    )
+
+
+def _tmp_path():
+    directory = os.path.join(blob_dir(), "tmp")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, uuid.uuid4().hex)
+
+
+def _inode_link(stat):
+    return os.path.join(blob_dir(), "inodes", f"{stat.st_dev}-{stat.st_ino}")
+
+
+def blob_path(digest, suffix=""):
+    return os.path.join(blob_dir(), digest[:2], digest + suffix)
+
+
+def _register(path):
+    """
+    Makes a new blob read-only and findable by its inode.
+    """
+    os.chmod(path, 0o444)
+    link = _inode_link(os.stat(path))
+    os.makedirs(os.path.dirname(link), exist_ok=True)
+    if os.path.lexists(link):
+        # Left behind by a blob whose inode number was reused
+        os.remove(link)
+    os.symlink(os.path.relpath(path, os.path.dirname(link)), link)
+
+
+def _publish(tmp, target):
+    """
+    Moves the temporary file tmp to target unless an identical blob got there first.
+    """
+    try:
+        # Unlike rename, link never replaces a blob that other files already link to
+        os.link(tmp, target)
+        _register(target)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp)
+
+
+def _store(source, digest, filename):
+    """
+    Returns the blob holding the content of source (with digest), creating it if needed.
+
+    source is removed either way.
+    """
+    compress = _compress(filename)
+    suffix = COMPRESSED_SUFFIX if compress else ""
+    target = blob_path(digest, suffix)
+    if not os.path.exists(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = _tmp_path() + suffix
+        if compress:
+            size, compressed = bgzf.compress_file(
+                source, tmp,
+                level=getattr(settings, "UPLOAD_COMPRESSION_LEVEL", 6),
+                workers=getattr(settings, "UPLOAD_COMPRESSION_WORKERS", None),
+            )
+            print(f"Compressed {filename}: {size} -> {compressed} bytes")
+            # The index goes first so a published blob always has one
+            _publish(tmp + bgzf.INDEX_SUFFIX, target + bgzf.INDEX_SUFFIX)
+        else:
+            try:
+                os.link(source, tmp)
+            except OSError:
+                shutil.copyfile(source, tmp)
+        _publish(tmp, target)
+    os.remove(source)
+    return target
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            raise
+        # Another file system or no hard links: a private copy, not counted as a reference
+        shutil.copyfile(src, dst)
+
+
+def link_into(blob, directory, filename):
+    """
+    Makes blob available in directory as filename and returns the path.
+
+    A file there with the same content is reused; if the name is taken by a
+    different file, a "_1", "_2", ... suffix is added like generate_unique_filename.
+    """
+    blob_stat = os.stat(blob)
+    base, ext = os.path.splitext(filename)
+    counter = 1
+    candidate = filename
+    while True:
+        path = os.path.join(directory, candidate)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            if os.path.exists(path + PART_SUFFIX):
+                # Reserved by a chunked upload in progress
+                candidate = f"{base}_{counter}{ext}"
+                counter += 1
+                continue
+            try:
+                _link_or_copy(blob, path)
+                if os.path.exists(blob + bgzf.INDEX_SUFFIX):
+                    _link_or_copy(blob + bgzf.INDEX_SUFFIX, path + bgzf.INDEX_SUFFIX)
+                return path
+            except FileExistsError:
+                # Taken in the meantime; look at it again
+                continue
+        if os.path.samestat(stat, blob_stat):
+            return path
+        candidate = f"{base}_{counter}{ext}"
+        counter += 1
+
+
+def store_chunks(chunks, directory, filename):
+    """
+    Writes an uploaded file's chunks into the blob store and links it into directory.
+    """
+    tmp = _tmp_path()
+    hasher = hashlib.sha256()
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                hasher.update(chunk)
+        blob = _store(tmp, hasher.hexdigest(), filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if blob.endswith(COMPRESSED_SUFFIX):
+        filename += COMPRESSED_SUFFIX
+    return link_into(blob, directory, filename)
+
+
+def store_file(path, digest):
+    """
+    Replaces the completed upload at path (content sha256 digest) by a link to its blob.
+
+    Returns the path of the link, which ends in ".gz" if the file was compressed.
+    """
+    directory, filename = os.path.split(path)
+    blob = _store(path, digest, filename)
+    if blob.endswith(COMPRESSED_SUFFIX):
+        filename += COMPRESSED_SUFFIX
+    return link_into(blob, directory, filename)
+
+
+def blob_of(stat):
+    """
+    Returns the path of the blob a file with this stat links to, or None.
+    """
+    if stat.st_nlink < 2:
+        # Not a link to a blob (a blob has at least two links while referenced)
+        return None
+    inode_link = _inode_link(stat)
+    try:
+        blob = os.path.join(os.path.dirname(inode_link), os.readlink(inode_link))
+        if os.path.samestat(os.stat(blob), stat):
+            return blob
+    except OSError:
+        pass
+    return None
+
+
+def _release(stat):
+    """
+    Removes the blob of a deleted link if that was its last reference.
+    """
+    blob = blob_of(stat)
+    if blob is None:
+        return
+    try:
+        if os.stat(blob).st_nlink > 1:
+            return
+        # A link made between the check and here keeps its data; the blob name is just gone
+        os.remove(blob)
+        os.remove(_inode_link(stat))
+    except FileNotFoundError:
+        pass
+
+
+def remove_file(path):
+    """
+    Deletes a file, and its blob if this was the last file linking to it.
+    """
+    stat = os.stat(path)
+    os.remove(path)
+    _release(stat)
+
+
+def remove_tree(path):
+    """
+    Deletes a directory tree like shutil.rmtree, releasing the blobs it linked to.
+    """
+    linked = []
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if stat.st_nlink > 1:
+                linked.append(stat)
+    shutil.rmtree(path)
+    for stat in linked:
+        _release(stat)
@@ -0,0 +1,209 @@
+"""
+Content-addressed cache of workflow node results.
+
+A node's key is a hash of its tool executable, its command line with input
+files replaced by their content digests and output paths replaced by
+placeholders. Outputs of a successful node are stored once under
+settings.WORKFLOW_CACHE_DIR and hard linked into later runs with the same key.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+from .introspection import command_fingerprint
+
+CHUNK_SIZE = 1024 * 1024
+
+# (path, size, mtime_ns, inode) -> sha256, so unchanged inputs are hashed once per process
+_digest_memo = {}
+_digest_lock = threading.Lock()
+_evict_lock = threading.Lock()
+
+
+def cache_dir():
+    return getattr(settings, "WORKFLOW_CACHE_DIR", None) or os.path.join(settings.MEDIA_ROOT, "cache")
+
+
+def cache_enabled():
+    return getattr(settings, "WORKFLOW_CACHE_ENABLED", True)
+
+
+def file_digest(path):
+    """
+    Returns the sha256 of a file, or of a directory's names and contents.
+    """
+    if os.path.isdir(path):
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                h.update(os.path.relpath(file_path, path).encode())
+                h.update(file_digest(file_path).encode())
+        return h.hexdigest()
+
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    with _digest_lock:
+        if memo_key in _digest_memo:
+            return _digest_memo[memo_key]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    with _digest_lock:
+        _digest_memo[memo_key] = digest
+    return digest
+
+
+def tool_fingerprint(command):
+    """
+    Identifies the installed tool version by its resolved binary path, size and mtime
+    (and its package for "python3 -m <module>").
+    """
+    return command_fingerprint(command[:3]) or command[0]
+
+
+def node_cache_key(command, input_paths, output_paths):
+    """
+    Hashes a command line. Input files count by name and content, output paths only by position.
+    """
+    inputs = set(input_paths)
+    outputs = {path: i for i, path in enumerate(output_paths)}
+    parts = [tool_fingerprint(command)]
+    for arg in command[1:]:
+        if arg in outputs:
+            parts.append(f"<output:{outputs[arg]}>")
+        elif arg in inputs:
+            parts.append(f"<input:{os.path.basename(arg)}:{file_digest(arg)}>")
+        else:
+            parts.append(arg)
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def _entry_dir(key):
+    return os.path.join(cache_dir(), key[:2], key)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def link_tree(src, dst):
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=_link_or_copy, dirs_exist_ok=True)
+    else:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.exists(dst):
+            os.remove(dst)
+        _link_or_copy(src, dst)
+
+
+def _tree_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def restore(key, output_paths):
+    """
+    Links cached outputs into output_paths. Returns False on a cache miss.
+    """
+    entry = _entry_dir(key)
+    meta_path = os.path.join(entry, "meta.json")
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    if meta.get("outputs") != len(output_paths):
+        return False
+
+    for i, path in enumerate(output_paths):
+        cached = os.path.join(entry, "outputs", str(i))
+        if not os.path.exists(cached):
+            return False
+        link_tree(cached, path)
+
+    # The meta file's mtime is the entry's last use for LRU eviction
+    os.utime(meta_path)
+    return True
+
+
+def store(key, output_paths):
+    """
+    Adds the outputs of a successful node to the cache, then evicts old entries if over budget.
+    """
+    if not output_paths or not all(os.path.exists(p) for p in output_paths):
+        return
+    entry = _entry_dir(key)
+    if os.path.exists(entry):
+        return
+
+    tmp = os.path.join(cache_dir(), f"tmp-{uuid.uuid4().hex}")
+    try:
+        for i, path in enumerate(output_paths):
+            link_tree(path, os.path.join(tmp, "outputs", str(i)))
+        meta = {"outputs": len(output_paths), "size": _tree_size(os.path.join(tmp, "outputs")), "created": time.time()}
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        os.rename(tmp, entry)
+    except OSError:
+        # Another run stored the same key first, or the disk is full
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    evict()
+
+
+def evict(max_bytes=None):
+    """
+    Removes least recently used entries until the cache fits in WORKFLOW_CACHE_MAX_BYTES.
+    """
+    if max_bytes is None:
+        max_bytes = getattr(settings, "WORKFLOW_CACHE_MAX_BYTES", None)
+    if not max_bytes or not os.path.isdir(cache_dir()):
+        return []
+
+    with _evict_lock:
+        entries = []
+        for prefix in os.listdir(cache_dir()):
+            prefix_dir = os.path.join(cache_dir(), prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                meta_path = os.path.join(prefix_dir, key, "meta.json")
+                try:
+                    with open(meta_path) as f:
+                        size = json.load(f).get("size", 0)
+                    last_used = os.path.getmtime(meta_path)
+                except (OSError, json.JSONDecodeError):
+                    continue
+                entries.append((last_used, size, key))
+
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for _, size, key in sorted(entries):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(_entry_dir(key), ignore_errors=True)
+            total -= size
+            removed.append(key)
+        return removed
@@ -0,0 +1,1140 @@
+"""
+Workflow execution engine.
+
+Nodes whose dependencies are satisfied are launched concurrently, bounded by a
+worker budget, instead of strictly one after another.
+
+Besides tool nodes a graph can contain "file" nodes, and "scatter" and
+"gather" nodes for running tools over many files. A scatter node lists input
+files, as a glob under media/my_files (parameter "pattern", e.g.
+"run42/*.fastq.gz") or explicitly (parameter "files", a list or one path per
+line). Every node between it and the next gather node is run once per file;
+the gather node collects the outputs of all copies into one directory that
+the next tool receives as a single input.
+
+Options declared "stream": true in tools.json are read (inputs) or written
+(outputs) sequentially once. When such an output feeds such an input and
+nothing else needs it as a file, the executor creates a named pipe in place
+of the output file and starts producer and consumer together, so the data
+never touches the disk and both steps overlap (see _plan_streams).
+"""
+import contextlib
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from django.conf import settings
+
+from . import bgzf, cache, scheduler
+from .process import CANCELLED, TIMEOUT, run_process, tool_timeout
+from .scheduler import resource_pool
+from .utils import load_tools_config
+
+# Seconds between retries when ready nodes wait for CPU or memory held by other runs
+RESOURCE_POLL_INTERVAL = 0.5
+
+# Bump when the layout of compiled plans changes; stored plans of another version are recompiled
+PLAN_VERSION = 3
+
+# Node labels that are handled by the engine instead of running a tool
+FILE = "file"
+SCATTER = "scatter"
+GATHER = "gather"
+CONTROL_NODES = (FILE, SCATTER, GATHER)
+
+# Failure policies
+FAIL_FAST = "fail_fast"   # stop launching new nodes after the first failure
+CONTINUE = "continue"     # keep running branches that do not depend on the failed node
+FAILURE_POLICIES = (FAIL_FAST, CONTINUE)
+
+
+class WorkflowError(Exception):
+    """Raised when a workflow graph is invalid or a node cannot be prepared."""
+    pass
+
+
+class NodeCancelled(Exception):
+    """Raised by run_command when the tool was stopped because the run was cancelled."""
+    pass
+
+
+def compile_workflow(nodes, edges):
+    """
+    Validates the graph and compiles it into an execution plan.
+
+    The plan is plain JSON so it can be stored with the workflow and its runs:
+
+        {"version", "order": [node ids in topological order],
+         "nodes": {id: {"label", "dir", "parents", "children", "inputs", "options"}}}
+
+    "inputs" binds each incoming file to the node whose outputs hold it (None for
+    media/my_files), to a scatter node or to a gather node's directory, and
+    "options" is the tool's option layout with outputs, file inputs and
+    stream-capable options already classified. Executing a plan takes time
+    linear in the graph.
+    """
+    node_map = {n["id"]: n for n in nodes}
+    parents = defaultdict(list)
+    children = defaultdict(list)
+    incoming = defaultdict(list)
+    for e in edges:
+        for end in (e["source"], e["target"]):
+            if end not in node_map:
+                raise WorkflowError(f"Edge refers to unknown node '{end}'.")
+        parents[e["target"]].append(e["source"])
+        children[e["source"]].append(e["target"])
+        incoming[e["target"]].append(e)
+
+    connected_nodes = set(parents) | set(children)
+    roots = [n for n in connected_nodes if not parents[n]]
+    if len(roots) != 1:
+        raise WorkflowError(f"Workflow must have exactly one starting tool. Found {len(roots)}: {roots}")
+
+    # Topological sort
+    in_degree = {n: len(parents[n]) for n in connected_nodes}
+    order = []
+    queue = deque(roots)
+    while queue:
+        current = queue.popleft()
+        order.append(current)
+        for neighbor in children[current]:
+            in_degree[neighbor] -= 1
+            if in_degree[neighbor] == 0:
+                queue.append(neighbor)
+
+    if len(order) != len(connected_nodes):
+        raise WorkflowError("Workflow contains disconnected or cyclic paths.")
+
+    # Tool nodes get a directory named after their tool, plus the node id when a tool appears twice
+    label_counts = defaultdict(int)
+    for n in nodes:
+        label_counts[n["data"]["label"]] += 1
+
+    plan_nodes = {}
+    for node_id in order:
+        data = node_map[node_id]["data"]
+        label = data["label"]
+        plan_node = {
+            "label": label,
+            "dir": label if label_counts[label] == 1 else f"{label}_{node_id}",
+            "parents": parents[node_id],
+            "children": children[node_id],
+            "inputs": [],
+            "options": [],
+        }
+        plan_nodes[node_id] = plan_node
+        if label == SCATTER:
+            parameters = data.get("parameters", {})
+            if not parameters.get("pattern") and not parameters.get("files"):
+                raise WorkflowError(f'Scatter node "{node_id}" needs a "pattern" or a list of "files".')
+        if label == GATHER and not parents[node_id]:
+            raise WorkflowError(f'Gather node "{node_id}" has nothing to collect.')
+        if label in CONTROL_NODES:
+            continue
+
+        for edge in incoming[node_id]:
+            source_id = edge["source"]
+            source_data = node_map[source_id]["data"]
+            if source_data["label"] in (SCATTER, GATHER):
+                plan_node["inputs"].append({"param": edge["data"].get("param"), source_data["label"]: source_id})
+                continue
+            filename = source_data.get("parameters", {}).get("filename")
+            if not filename:
+                continue
+            if source_data["label"] == FILE:
+                # A file node either stands for an upstream tool's output or for a file in media/my_files
+                producer = parents[source_id][0] if parents[source_id] else None
+            else:
+                producer = source_id
+            plan_node["inputs"].append({"param": edge["data"].get("param"), "filename": filename, "producer": producer})
+
+        # Validate mandatory fields before execution
+        parameters = data.get("parameters", {})
+        bound_params = {e["data"].get("param") for e in incoming[node_id]}
+        for opt in data.get("toolDef", {}).get("options", []):
+            param_label = opt.get("label")
+            if opt.get("mandatory"):
+                val = parameters.get(param_label)
+                filled_by_user = val is not None and str(val).strip() != ""
+                if not filled_by_user and param_label not in bound_params:
+                    raise WorkflowError(f'Mandatory input "{param_label}" is missing for tool "{label}".')
+
+            plan_node["options"].append({
+                "label": param_label,
+                "flag": opt.get("flag"),
+                "output": is_output_option(opt),
+                "file": opt.get("type") == "file",
+                "stream": bool(opt.get("stream")),
+            })
+
+    return {
+        "version": PLAN_VERSION,
+        "order": order,
+        "nodes": plan_nodes,
+    }
+
+
+def scatter_files(parameters):
+    """
+    Returns the paths (relative to media/my_files) a scatter node expands to.
+    """
+    root = os.path.abspath(os.path.join(settings.MEDIA_ROOT, "my_files"))
+    listed = parameters.get("files") or []
+    if isinstance(listed, str):
+        listed = listed.splitlines()
+    pattern = (parameters.get("pattern") or "").strip()
+
+    paths = [os.path.join(root, name.strip()) for name in listed if name.strip()]
+    if pattern:
+        paths.extend(sorted(glob.glob(os.path.join(root, pattern), recursive=True)))
+
+    files = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if not path.startswith(root + os.sep):
+            raise WorkflowError(f"Scatter input outside of My Files: {path}")
+        if not os.path.exists(path):
+            raise WorkflowError(f"File not found: {path}")
+        rel = os.path.relpath(path, root)
+        if rel not in files:
+            files.append(rel)
+    return files
+
+
+def tool_commands(nodes):
+    """
+    Maps the executable of every tool node to the ids of the nodes that run it.
+    """
+    commands = defaultdict(list)
+    for node in nodes:
+        data = node.get("data", {})
+        if data.get("label") in CONTROL_NODES:
+            continue
+        commands[(data.get("toolDef") or {}).get("command") or data.get("label")].append(node["id"])
+    return dict(commands)
+
+
+def sample_name(path):
+    """
+    Names a scattered copy after its input: "reads/S1_R1.fastq.gz" -> "S1_R1".
+    """
+    name = os.path.basename(path.rstrip("/"))
+    for ext in (".gz", ".bz2", ".xz", ".zst"):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    name = os.path.splitext(name)[0] or name
+    return "".join(c for c in name if c.isalnum() or c in ("_", "-", ".")) or "sample"
+
+
+def _topological_order(plan_nodes):
+    in_degree = {n: len(p["parents"]) for n, p in plan_nodes.items()}
+    queue = deque(n for n, d in in_degree.items() if d == 0)
+    order = []
+    while queue:
+        current = queue.popleft()
+        order.append(current)
+        for child in plan_nodes[current]["children"]:
+            in_degree[child] -= 1
+            if in_degree[child] == 0:
+                queue.append(child)
+    return order
+
+
+def expand_scatters(plan, node_map):
+    """
+    Returns (plan, copies) with the nodes below every scatter node copied once per file.
+
+    copies maps each scattered node id to the ids of its copies, "<id>#<n>".
+    The given plan is not modified.
+    """
+    nodes = dict(plan["nodes"])
+    copies = {}
+    position = {node_id: i for i, node_id in enumerate(plan["order"])}
+
+    for scatter_id in [n for n in plan["order"] if nodes[n]["label"] == SCATTER]:
+        # Everything below the scatter node up to the gather nodes is run per file
+        in_region = set()
+        queue = deque(nodes[scatter_id]["children"])
+        while queue:
+            node_id = queue.popleft()
+            if node_id in in_region or nodes.get(node_id, {}).get("label") == GATHER:
+                continue
+            if node_id not in nodes or nodes[node_id]["label"] == SCATTER:
+                raise WorkflowError(f'Nodes below scatter node "{scatter_id}" cannot be scattered again.')
+            in_region.add(node_id)
+            queue.extend(nodes[node_id]["children"])
+        region = sorted(in_region, key=position.get)
+
+        files = scatter_files(node_map[scatter_id]["data"].get("parameters", {}))
+        if not files:
+            raise WorkflowError(f'Scatter node "{scatter_id}" matched no files.')
+        samples = []
+        for rel in files:
+            name, counter = sample_name(rel), 1
+            while name in samples:
+                name = f"{sample_name(rel)}_{counter}"
+                counter += 1
+            samples.append(name)
+
+        for i, (rel, sample) in enumerate(zip(files, samples)):
+            def copy_of(node_id):
+                return f"{node_id}#{i}" if node_id in in_region else node_id
+
+            for node_id in region:
+                template = nodes[node_id]
+                inputs = []
+                for binding in template["inputs"]:
+                    if binding.get(SCATTER) == scatter_id:
+                        # The scattered file is read from media/my_files like a file node without parents
+                        inputs.append({"param": binding["param"], "filename": rel, "producer": None})
+                    elif binding.get("producer") in in_region:
+                        inputs.append(dict(binding, producer=copy_of(binding["producer"])))
+                    else:
+                        inputs.append(binding)
+                nodes[copy_of(node_id)] = dict(
+                    template,
+                    dir=os.path.join(template["dir"], sample),
+                    parents=[copy_of(p) for p in template["parents"]],
+                    children=[copy_of(c) for c in template["children"]],
+                    inputs=inputs,
+                    sample=sample,
+                )
+                copies.setdefault(node_id, []).append(copy_of(node_id))
+
+        def expand(ids):
+            return [c for node_id in ids for c in (copies[node_id] if node_id in in_region else [node_id])]
+
+        # Nodes around the region (the scatter node, shared inputs, gather nodes) now point at every copy
+        for node_id in region:
+            template = nodes.pop(node_id)
+            for neighbor in template["parents"] + template["children"]:
+                if neighbor not in in_region:
+                    nodes[neighbor] = dict(
+                        nodes[neighbor],
+                        parents=expand(nodes[neighbor]["parents"]),
+                        children=expand(nodes[neighbor]["children"]),
+                    )
+
+    if not copies:
+        return plan, copies
+    return dict(plan, nodes=nodes, order=_topological_order(nodes)), copies
+
+
+def is_output_option(opt):
+    opt_label = opt.get("label") or ""
+    opt_flag = opt.get("flag")
+    return bool(opt_flag) and (opt_flag == "-o" or opt_flag == "--output" or "output" in opt_label.lower())
+
+
+def sanitize_output_name(val):
+    """
+    Returns (name, is_file) for a user supplied output name.
+    """
+    base = os.path.basename(str(val))
+    has_extension = "." in base and len(base.split(".")[-1]) > 1
+    if has_extension:
+        return "".join(c for c in base if c.isalnum() or c in ("_", "-", ".")), True
+    return "".join(c for c in base if c.isalnum() or c in ("_", "-")), False
+
+
+def run_output_dir(workflow_name, run_id):
+    return os.path.join(settings.MEDIA_ROOT, "my_files", workflow_name, f"run_{run_id}")
+
+
+class WorkflowExecutor:
+    """
+    Runs a validated workflow graph, launching every ready node concurrently.
+    """
+
+    def __init__(self, workflow_name, nodes, edges, max_workers=None, failure_policy=None,
+                 on_node_update=None, on_output=None, log_dir=None, use_cache=None,
+                 targets=None, completed=None, run_id=None, plan=None, cancel_event=None, stream=None):
+        self.workflow_name = workflow_name
+        # Every execution writes into its own directory, so names never have to be probed
+        self.run_id = str(run_id) if run_id is not None else uuid.uuid4().hex[:12]
+        self.run_dir = run_output_dir(workflow_name, self.run_id)
+        self.nodes = nodes
+        self.edges = edges
+        self.max_workers = max(1, int(max_workers or getattr(settings, "WORKFLOW_MAX_WORKERS", None) or os.cpu_count() or 1))
+        self.failure_policy = failure_policy or getattr(settings, "WORKFLOW_FAILURE_POLICY", FAIL_FAST)
+        if self.failure_policy not in FAILURE_POLICIES:
+            raise WorkflowError(f"Unknown failure policy '{self.failure_policy}'. Use one of: {', '.join(FAILURE_POLICIES)}")
+
+        # A plan compiled when the workflow was saved or queued is trusted as is
+        plan = plan if plan and plan.get("version") == PLAN_VERSION else compile_workflow(nodes, edges)
+        self.node_map = {n["id"]: n for n in nodes}
+        # Scatter regions are expanded per run so a glob sees the files present now
+        self.plan, self.copies = expand_scatters(plan, self.node_map)
+        for node_id, copy_ids in self.copies.items():
+            for copy_id in copy_ids:
+                self.node_map[copy_id] = self.node_map[node_id]
+        self.plan_nodes = self.plan["nodes"]
+        self.sorted_ids = self.plan["order"]
+
+        # Only the targets and their ancestors are executed when targets are given
+        if targets:
+            targets = [c for t in targets for c in self.copies.get(t, [t])]
+        self.selected = self._select(targets) if targets else set(self.sorted_ids)
+        # node id -> {"key", "outputs"} of nodes that succeeded in a previous run
+        self.completed = completed or {}
+        # Same records for the nodes that succeeded in this run
+        self.node_records = {}
+
+        self.status = {node_id: "pending" for node_id in self.sorted_ids}
+        self.node_logs = defaultdict(list)
+        self.errors = {}
+        # Called as on_node_update(node_id, status) from the scheduling thread
+        self.on_node_update = on_node_update
+        # Called as on_output(node_id, line) from worker threads while tools run
+        self.on_output = on_output
+        # Full per-node output is written here; only a tail is kept in memory
+        self.log_dir = log_dir or os.path.join(settings.MEDIA_ROOT, "logs", workflow_name, self.run_id)
+        self.log_files = {}
+        self.use_cache = cache.cache_enabled() if use_cache is None else use_cache
+        self.node_inputs = {}
+        self.node_outputs = {}
+        self.output_dirs = {}
+        self.cached_nodes = set()
+        # node id -> ProcessResult of the tool process, for resource accounting
+        self.process_results = {}
+        self.schedule_resources = getattr(settings, "WORKFLOW_RESOURCE_SCHEDULING", True)
+        # node id -> resource pool token while the node runs
+        self.reservations = {}
+        self.unfit_sizes = []
+        self.key_ignored_args = {}
+        # node id -> {"label", "dir", "outputs", "files"}; written to <run_dir>/manifest.json
+        self.manifest = {}
+        # node id -> seconds the tool may run, None for no limit
+        self.node_timeouts = {}
+        # Set by cancel(); running tools are terminated and nothing new starts
+        self.cancel_event = cancel_event or threading.Event()
+
+        # producer id -> {output option label: consumer id} for outputs passed through named pipes
+        self.stream_outputs = defaultdict(dict)
+        # consumer id -> producer ids it reads from through named pipes
+        self.stream_inputs = defaultdict(set)
+        # consumer id -> its parents that stand for a streamed output (the producer or its file node)
+        self.stream_feeders = defaultdict(set)
+        # node id -> all tool nodes (in plan order) that have to start together with it
+        self.stream_groups = {}
+        # node id -> named pipes the node writes or reads
+        self.node_fifos = defaultdict(list)
+        # node id -> set once a streamed node's tool has exited
+        self.stream_exited = {}
+        # node id -> bgzf.DecompressedStreams feeding BGZF inputs to a tool without "gzip_input"
+        self.decompressed = {}
+        # node id -> {pipe path: BGZF file it decompresses}, so cache keys see the file
+        self.decompressed_inputs = defaultdict(dict)
+        self.stream = getattr(settings, "WORKFLOW_STREAMING", True) if stream is None else stream
+        if self.stream:
+            self._plan_streams()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def run(self):
+        """
+        Executes the workflow and returns a dict with success, log, per-node status and error.
+        """
+        in_degree = {node_id: 0 for node_id in self.selected}
+        for node_id in self.selected:
+            for parent in self.plan_nodes[node_id]["parents"]:
+                if parent in self.selected:
+                    self._count_edge(parent, node_id, in_degree, 1)
+
+        ready = deque(
+            n for n in self.sorted_ids
+            if n in self.selected and in_degree[n] == 0 and self.stream_groups.get(n, [n])[0] == n
+        )
+        running = {}
+        stop = False
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while ready or running:
+                stop = stop or self.cancelled
+                stop = self._launch_ready(ready, running, in_degree, pool, stop)
+
+                if not running:
+                    if ready and not stop:
+                        # Every ready node waits for capacity held by other runs
+                        time.sleep(RESOURCE_POLL_INTERVAL)
+                        continue
+                    break
+
+                # Nodes waiting for capacity are retried when something finishes or after a short poll
+                timeout = RESOURCE_POLL_INTERVAL if ready and not stop else None
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node_id = running.pop(future)
+                    resource_pool.release(self.reservations.pop(node_id, None))
+                    try:
+                        future.result()
+                    except NodeCancelled:
+                        self._set_status(node_id, "cancelled")
+                        continue
+                    except Exception as e:
+                        stop = self._fail(node_id, str(e)) or stop
+                        continue
+                    self._record_outputs(node_id)
+                    self._set_status(node_id, "success")
+                    self._release_children(node_id, in_degree, ready)
+
+        # Pipes of nodes whose command was built but that never started
+        for streams in self.decompressed.values():
+            streams.__exit__(None, None, None)
+        self.decompressed.clear()
+
+        # Whatever never became ready depends on a failed node (or was cut off by fail-fast)
+        for node_id, state in self.status.items():
+            if state == "pending":
+                self._set_status(node_id, "skipped")
+
+        log = []
+        for node_id in self.sorted_ids:
+            log.extend(self.node_logs[node_id])
+
+        result = {
+            "success": not self.errors and not self.cancelled,
+            "cancelled": self.cancelled,
+            "log": log,
+            "nodes": dict(self.status),
+            "log_files": dict(self.log_files),
+            "cached": [n for n in self.sorted_ids if n in self.cached_nodes],
+            "node_records": {n: r for n, r in self.node_records.items() if self.status[n] == "success"},
+            "run_dir": os.path.relpath(self.run_dir, settings.MEDIA_ROOT),
+            "usage": {n: r.usage for n, r in self.process_results.items()},
+            "streamed": [
+                {"producer": producer, "output": output, "consumer": consumer}
+                for producer, outputs in self.stream_outputs.items() for output, consumer in outputs.items()
+            ],
+        }
+        if self.errors:
+            first_failed = next(n for n in self.sorted_ids if n in self.errors)
+            result["error"] = self.errors[first_failed]
+        elif self.cancelled:
+            result["error"] = "Run cancelled"
+        return result
+
+    def _launch_ready(self, ready, running, in_degree, pool, stop):
+        """
+        Starts every ready node that fits in the worker and resource budget.
+        Nodes that do not fit stay in ready. Returns the updated stop flag.
+        """
+        # Requests that did not fit in this pass; as large ones are not tried again until the next
+        self.unfit_sizes = []
+        progressed = True
+        while progressed and ready and not stop:
+            progressed = False
+            for _ in range(len(ready)):
+                if stop or len(running) >= self.max_workers:
+                    break
+                node_id = ready.popleft()
+                label = self.plan_nodes[node_id]["label"]
+
+                if label in CONTROL_NODES:
+                    if label == GATHER:
+                        try:
+                            self._gather(node_id)
+                        except (WorkflowError, OSError) as e:
+                            stop = self._fail(node_id, str(e))
+                            continue
+                    self._set_status(node_id, "success")
+                    self._release_children(node_id, in_degree, ready)
+                    progressed = True
+                    continue
+
+                if node_id in self.stream_groups:
+                    started, stop = self._launch_group(node_id, ready, running, pool)
+                    progressed = progressed or started
+                    continue
+
+                threads = self._reserve(node_id)
+                if threads is False:
+                    ready.append(node_id)
+                    continue
+                progressed = True
+
+                try:
+                    command, output_dir = self.build_command(node_id, threads=threads)
+                except WorkflowError as e:
+                    resource_pool.release(self.reservations.pop(node_id, None))
+                    stop = self._fail(node_id, str(e))
+                    continue
+
+                self._set_status(node_id, "running")
+                future = pool.submit(self.run_command, node_id, command, output_dir)
+                running[future] = node_id
+        return stop
+
+    def _launch_group(self, node_id, ready, running, pool):
+        """
+        Starts the first node of a stream group together with the rest of the group: a
+        tool writing into a pipe nobody reads would wait forever, so all of them start
+        or none. Returns (started, stop); the node goes back to ready if the group has to wait.
+        """
+        group = self.stream_groups[node_id]
+        if len(running) + len(group) > self.max_workers:
+            ready.append(node_id)
+            return False, False
+
+        threads = {}
+        for member in group:
+            granted = self._reserve(member)
+            if granted is False:
+                for reserved in threads:
+                    resource_pool.release(self.reservations.pop(reserved, None))
+                ready.append(node_id)
+                return False, False
+            threads[member] = granted
+
+        commands = {}
+        for member in group:
+            try:
+                commands[member] = self.build_command(member, threads=threads[member])
+            except WorkflowError as e:
+                # The rest of the group is not started and ends up skipped
+                for reserved in group:
+                    resource_pool.release(self.reservations.pop(reserved, None))
+                for prepared in list(commands) + [member]:
+                    self._close_streams(prepared)
+                    self.manifest.pop(prepared, None)
+                return True, self._fail(member, str(e))
+
+        for member in group:
+            self._set_status(member, "running")
+            future = pool.submit(self.run_command, member, *commands[member])
+            running[future] = member
+        return True, False
+
+    def _resources(self, node_id):
+        """
+        Returns the (cpus, memory_mb) a node's tool declares.
+        """
+        data = self.node_map[node_id]["data"]
+        resources = scheduler.tool_resources(data["label"], data.get("toolDef"))
+        threads_option = resources.get("threads_option")
+        requested = data.get("parameters", {}).get(threads_option) if threads_option else None
+        try:
+            # A thread count typed by the user is what the tool will really use
+            cpus = int(requested) if requested not in (None, "") else int(resources.get("cpus", 1))
+        except (TypeError, ValueError):
+            cpus = int(resources.get("cpus", 1))
+        return cpus, resources.get("memory_mb", 0)
+
+    def _reserve(self, node_id):
+        """
+        Reserves the CPUs and memory a node's tool declares. Returns the granted
+        thread count, None when scheduling is off, or False if it does not fit yet.
+        """
+        if not self.schedule_resources:
+            return None
+
+        cpus, memory_mb = self._resources(node_id)
+        if any(cpus >= c and memory_mb >= m for c, m in self.unfit_sizes):
+            return False
+        token = resource_pool.try_acquire(cpus, memory_mb)
+        if token is None:
+            self.unfit_sizes.append((cpus, memory_mb))
+            return False
+        self.reservations[node_id] = token
+        return max(1, min(cpus, scheduler.total_cpus()))
+
+    def _gather(self, node_id):
+        """
+        Links the outputs of every scattered copy above a gather node into <gather dir>/<sample>/.
+        """
+        gather_dir = os.path.join(self.run_dir, self.plan_nodes[node_id]["dir"])
+        os.makedirs(gather_dir, exist_ok=True)
+        for parent_id in self.plan_nodes[node_id]["parents"]:
+            parent = self.plan_nodes[parent_id]
+            target_dir = os.path.join(gather_dir, parent.get("sample") or parent_id)
+            if parent["label"] == FILE:
+                filename = self.node_map[parent_id]["data"].get("parameters", {}).get("filename")
+                producer = parent["parents"][0] if parent["parents"] else None
+                sources = [self._input_path({"filename": filename, "producer": producer})]
+            elif parent_id in self.manifest:
+                entry = self.manifest[parent_id]
+                # Declared outputs, or the whole node directory for tools that write into their working directory
+                sources = [os.path.join(self.run_dir, p) for p in entry["outputs"].values()] or [os.path.join(self.run_dir, entry["dir"])]
+            else:
+                continue
+            for source in sources:
+                if os.path.exists(source):
+                    cache.link_tree(source, os.path.join(target_dir, os.path.basename(source.rstrip("/"))))
+
+        self.output_dirs[node_id] = gather_dir
+        self.manifest[node_id] = {
+            "label": GATHER, "dir": self.plan_nodes[node_id]["dir"], "outputs": {}, "final": self._is_final(node_id),
+        }
+        self._record_outputs(node_id)
+
+    def _input_path(self, binding):
+        """
+        Returns the path an input binding of the plan refers to.
+        """
+        if binding.get(GATHER):
+            return os.path.join(self.run_dir, self.plan_nodes[binding[GATHER]]["dir"])
+        if binding.get("producer") is None:
+            return os.path.join(settings.MEDIA_ROOT, "my_files", binding["filename"])
+        return self.resolve_output(binding["producer"], binding["filename"])
+
+    def _set_status(self, node_id, state):
+        self.status[node_id] = state
+        if self.on_node_update:
+            self.on_node_update(node_id, state)
+
+    def _select(self, targets):
+        """
+        Returns the target nodes plus everything they depend on.
+        """
+        missing = [t for t in targets if t not in self.node_map]
+        if missing:
+            raise WorkflowError(f"Unknown target nodes: {missing}")
+
+        selected = set()
+        queue = deque(targets)
+        while queue:
+            node_id = queue.popleft()
+            if node_id in selected:
+                continue
+            selected.add(node_id)
+            queue.extend(self.plan_nodes[node_id]["parents"])
+        return selected
+
+    def _is_final(self, node_id):
+        """
+        True for nodes whose outputs no other node of this run consumes; the retention
+        sweeper (retention.py) treats the outputs of the others as intermediates.
+        """
+        return not any(child in self.selected for child in self.plan_nodes[node_id]["children"])
+
+    def _plan_streams(self):
+        """
+        Picks the edges to pass through named pipes and groups the nodes that start together.
+
+        An output is streamed when the producer declares it "stream": true, exactly one
+        node reads it, through an input declared "stream": true, and nothing needs it as
+        a file: it is not gathered, the producer's result is not reused from a previous
+        run and the consumer reads nothing else of the producer. Groups that cannot run
+        at once (more tools than workers or than the machine's capacity, or inputs that
+        wait for a member to finish) keep their files.
+        """
+        readers = defaultdict(list)
+        for node_id in self.sorted_ids:
+            if node_id not in self.selected:
+                continue
+            for binding in self.plan_nodes[node_id]["inputs"]:
+                if binding.get("filename") and binding.get("producer") is not None:
+                    readers[(binding["producer"], binding["filename"])].append((node_id, binding["param"]))
+
+        pairs = []
+        for (producer, filename), consumers in readers.items():
+            consumer, param = consumers[0]
+            if len(consumers) > 1 or producer not in self.selected or producer in self.completed:
+                continue
+            if consumer in self.completed or self._gathered(producer):
+                continue
+            if sum(1 for b in self.plan_nodes[consumer]["inputs"] if b.get("producer") == producer) > 1:
+                continue
+            output = self._stream_output(producer, filename)
+            consumer_options = {opt["label"]: opt for opt in self.plan_nodes[consumer]["options"]}
+            if output is None or not consumer_options.get(param, {}).get("stream"):
+                continue
+            pairs.append((producer, output, consumer))
+
+        groups = self._stream_group_map(pairs)
+        pairs = [pair for pair in pairs if self._can_stream(groups[pair[0]], pairs)]
+        self.stream_groups = self._stream_group_map(pairs)
+        for producer, output, consumer in pairs:
+            self.stream_outputs[producer][output] = consumer
+            self.stream_inputs[consumer].add(producer)
+            self.stream_feeders[consumer].update(self._feeders(producer, consumer))
+        for node_id in self.stream_groups:
+            self.stream_exited[node_id] = threading.Event()
+
+    def _stream_output(self, producer, filename):
+        """
+        Returns the label of the producer's stream-capable output file named filename, or None.
+        """
+        parameters = self.node_map[producer]["data"].get("parameters", {})
+        for opt in self.plan_nodes[producer]["options"]:
+            if not (opt["output"] and opt.get("stream") and parameters.get(opt["label"])):
+                continue
+            name, is_file = sanitize_output_name(parameters[opt["label"]])
+            if is_file and name == filename:
+                return opt["label"]
+        return None
+
+    def _gathered(self, node_id):
+        for child in self.plan_nodes[node_id]["children"]:
+            child_node = self.plan_nodes[child]
+            if child_node["label"] == GATHER:
+                return True
+            if child_node["label"] == FILE and any(self.plan_nodes[c]["label"] == GATHER for c in child_node["children"]):
+                return True
+        return False
+
+    def _feeders(self, producer, consumer):
+        """
+        Returns the parents of consumer that stand for producer's output: the producer or its file node.
+        """
+        return {
+            parent for parent in self.plan_nodes[consumer]["parents"]
+            if parent == producer or (self.plan_nodes[parent]["label"] == FILE and self.plan_nodes[parent]["parents"] == [producer])
+        }
+
+    def _stream_group_map(self, pairs):
+        """
+        Returns node id -> the nodes connected to it by streamed edges, in plan order.
+        """
+        group_of = {}
+        for producer, _, consumer in pairs:
+            merged = group_of.get(producer, {producer}) | group_of.get(consumer, {consumer})
+            for node_id in merged:
+                group_of[node_id] = merged
+        position = {node_id: i for i, node_id in enumerate(self.sorted_ids)}
+        return {node_id: sorted(group, key=position.get) for node_id, group in group_of.items()}
+
+    def _can_stream(self, group, pairs):
+        if len(group) > self.max_workers:
+            return False
+        if self.schedule_resources:
+            cpus = memory_mb = 0
+            for node_id in group:
+                node_cpus, node_memory_mb = self._resources(node_id)
+                # Capped like resource_pool.try_acquire does
+                cpus += max(1, min(int(node_cpus), scheduler.total_cpus()))
+                memory_mb += int(node_memory_mb)
+            if cpus > scheduler.total_cpus() or (scheduler.total_memory_mb() and memory_mb > scheduler.total_memory_mb()):
+                return False
+
+        # The group starts once all inputs from outside it exist, so none of them may depend on a member
+        members = set(group)
+        inside = set(group)
+        for producer, _, consumer in pairs:
+            if consumer in members:
+                inside |= self._feeders(producer, consumer)
+        queue = deque(c for node_id in group for c in self.plan_nodes[node_id]["children"] if c not in inside)
+        downstream = set()
+        while queue:
+            node_id = queue.popleft()
+            if node_id in downstream or node_id not in self.selected:
+                continue
+            downstream.add(node_id)
+            queue.extend(self.plan_nodes[node_id]["children"])
+        return not any(
+            parent in downstream
+            for node_id in group for parent in self.plan_nodes[node_id]["parents"] if parent not in inside
+        )
+
+    def _count_edge(self, parent, child, in_degree, delta):
+        """
+        Adds delta to the dependencies of child, or of the first node of child's stream
+        group, which waits for the inputs of the whole group. Returns the node counted.
+        Edges inside a group (and from the file nodes standing for its pipes) are not counted.
+        """
+        group = self.stream_groups.get(child)
+        if group:
+            if parent in group or parent in self.stream_feeders[child]:
+                return None
+            child = group[0]
+        in_degree[child] += delta
+        return child
+
+    def _release_children(self, node_id, in_degree, ready):
+        for child in self.plan_nodes[node_id]["children"]:
+            if child not in self.selected:
+                continue
+            child = self._count_edge(node_id, child, in_degree, -1)
+            if child is not None and in_degree[child] == 0:
+                ready.append(child)
+
+    def _fail(self, node_id, error):
+        """
+        Records a node failure and returns True when no further nodes should be launched.
+        """
+        self.errors[node_id] = error
+        self._set_status(node_id, "failed")
+        return self.failure_policy == FAIL_FAST
+
+    def _record_outputs(self, node_id):
+        """
+        Adds a finished node's outputs to the run manifest and rewrites it atomically.
+        """
+        node_dir = self.output_dirs[node_id]
+        files = []
+        for root, _, names in os.walk(node_dir):
+            files.extend(os.path.relpath(os.path.join(root, name), self.run_dir) for name in names)
+        self.manifest[node_id]["files"] = sorted(files)
+
+        manifest_path = os.path.join(self.run_dir, "manifest.json")
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"workflow": self.workflow_name, "run_id": self.run_id, "nodes": self.manifest}, f, indent=4)
+        os.replace(tmp_path, manifest_path)
+
+    def resolve_output(self, producer_id, filename):
+        """
+        Finds a file produced by an upstream node in this run through the manifest.
+        """
+        entry = self.manifest.get(producer_id)
+        producer_label = self.node_map[producer_id]["data"]["label"]
+        if entry is None:
+            raise WorkflowError(f"Node '{producer_label}' has not produced any outputs in this run.")
+
+        node_dir = os.path.join(self.run_dir, entry["dir"])
+        outputs = [os.path.join(self.run_dir, p) for p in entry["outputs"].values()]
+        # A declared output by name, a file in the node's directory, or a file inside an output directory
+        candidates = [p for p in outputs if os.path.basename(p) == filename]
+        candidates.append(os.path.join(node_dir, filename))
+        candidates.extend(os.path.join(p, filename) for p in outputs if os.path.isdir(p))
+        for path in candidates:
+            if os.path.exists(path):
+                return path
+        raise WorkflowError(f"File not found: '{filename}' in the outputs of '{producer_label}'")
+
+    def build_command(self, node_id, threads=None):
+        """
+        Resolves inputs and outputs of a tool node and returns (command, output_dir).
+
+        threads fills the tool's declared thread option unless the user set it.
+        """
+        node = self.node_map[node_id]
+        plan_node = self.plan_nodes[node_id]
+        label = plan_node["label"]
+        log = self.node_logs[node_id]
+        parameters = dict(node["data"].get("parameters", {}))
+        tool_def = node["data"].get("toolDef", {})
+        threads_option = scheduler.tool_resources(label, tool_def).get("threads_option")
+        gzip_input = (load_tools_config().get(label) or tool_def).get("gzip_input")
+        if threads and threads_option and str(parameters.get(threads_option) or "").strip() == "":
+            parameters[threads_option] = threads
+        command = [tool_def.get("command", label)]
+        resolved_params = {}
+
+        output_dir = os.path.join(self.run_dir, plan_node["dir"])
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dirs[node_id] = output_dir
+
+        for binding in plan_node["inputs"]:
+            source_path = self._input_path(binding)
+            if not os.path.exists(source_path):
+                raise WorkflowError(f"File not found: {source_path}")
+
+            resolved_params[binding["param"]] = source_path
+            if binding.get("producer") in self.stream_inputs.get(node_id, ()):
+                self.node_fifos[node_id].append(source_path)
+
+        inputs = []
+        outputs = []
+        output_names = set()
+        self.manifest[node_id] = {
+            "label": label,
+            "dir": os.path.relpath(output_dir, self.run_dir),
+            "outputs": {},
+            "final": self._is_final(node_id),
+        }
+
+        for opt in plan_node["options"]:
+            opt_label = opt["label"]
+            opt_flag = opt["flag"]
+            val = resolved_params.get(opt_label) or parameters.get(opt_label)
+
+            if val:
+                if opt["output"]:
+                    sanitized_output, is_file = sanitize_output_name(val)
+                    # The node directory is new, so only names given out for this node can clash
+                    name = sanitized_output
+                    base, ext = os.path.splitext(sanitized_output)
+                    counter = 1
+                    while name in output_names:
+                        name = f"{base}_{counter}{ext}"
+                        counter += 1
+                    output_names.add(name)
+                    final_output_path = os.path.join(output_dir, name)
+                    streamed = opt_label in self.stream_outputs.get(node_id, {})
+                    if streamed:
+                        try:
+                            os.mkfifo(final_output_path)
+                        except OSError as e:
+                            raise WorkflowError(f"Could not create a pipe for output '{name}' of '{label}': {e}")
+                        self.node_fifos[node_id].append(final_output_path)
+                        # Consumed while it is written; the file never exists
+                        self.manifest[node_id].setdefault("streamed", []).append(opt_label)
+                    elif is_file:
+                        os.makedirs(os.path.dirname(final_output_path), exist_ok=True)
+                    else:
+                        os.makedirs(final_output_path, exist_ok=True)
+
+                    command += [opt_flag, final_output_path]
+                    if not streamed:
+                        outputs.append(final_output_path)
+                    self.manifest[node_id]["outputs"][opt_label] = os.path.relpath(final_output_path, self.run_dir)
+
+                    # Save only filename so downstream nodes can reference it
+                    resolved_params[opt_label] = os.path.basename(final_output_path)
+
+                else:
+                    arg = str(val)
+                    # Tools that cannot read gzip get block-compressed inputs through a pipe, like on the tool page
+                    is_input = opt_label in resolved_params or opt["file"]
+                    if is_input and not gzip_input and os.path.isfile(arg) and bgzf.is_bgzf(arg):
+                        streams = self.decompressed.setdefault(node_id, bgzf.DecompressedStreams())
+                        arg = streams.add(val)
+                        self.decompressed_inputs[node_id][arg] = str(val)
+                    command += [opt_flag, arg] if opt_flag else [arg]
+
+                if opt_label == threads_option:
+                    # The thread count does not change results, so it is left out of the cache key
+                    self.key_ignored_args[node_id] = len(command) - 1
+
+                if not opt["output"] and (opt_label in resolved_params or opt["file"]) and os.path.exists(str(val)):
+                    inputs.append(str(val))
+            else:
+                log.append(f"[WARN] Missing parameter '{opt_label}' for tool '{label}'")
+
+        self.node_inputs[node_id] = inputs
+        self.node_outputs[node_id] = outputs
+        self.node_timeouts[node_id] = self._timeout(node_id)
+        return command, output_dir
+
+    def _timeout(self, node_id):
+        """
+        Returns the node's "timeout", else the tool's from tools.json, else TOOL_TIMEOUT_SECONDS.
+        """
+        data = self.node_map[node_id]["data"]
+        registered = load_tools_config().get(data["label"]) or data.get("toolDef") or {}
+        try:
+            return tool_timeout(data.get("timeout"), registered.get("timeout"))
+        except (TypeError, ValueError):
+            raise WorkflowError(f"Invalid timeout for node '{data['label']}': {data.get('timeout') or registered.get('timeout')}")
+
+    def run_command(self, node_id, command, output_dir):
+        """
+        Runs one tool process; raises on a non-zero exit code. Called from worker threads.
+        """
+        if node_id not in self.stream_exited:
+            with self._decompressing(node_id):
+                self._run_tool(node_id, command, output_dir)
+            return
+        try:
+            with self._decompressing(node_id):
+                self._run_tool(node_id, command, output_dir)
+        finally:
+            self._close_streams(node_id)
+
+        # A consumer that exited cleanly may still have read a truncated stream
+        for producer in self.stream_inputs.get(node_id, ()):
+            self.stream_exited[producer].wait()
+            result = self.process_results.get(producer)
+            if result is None or result.terminated or result.returncode != 0:
+                producer_label = self.node_map[producer]["data"]["label"]
+                raise Exception(f"Streamed input from '{producer_label}' is incomplete: '{producer_label}' failed")
+
+    def _decompressing(self, node_id):
+        """
+        Returns the context that feeds the node's decompressed inputs while its tool runs.
+        """
+        return self.decompressed.pop(node_id, None) or contextlib.nullcontext()
+
+    def _close_streams(self, node_id):
+        """
+        Removes the named pipes of a node whose tool has exited, so the tool at the other
+        end never waits for it: a reader gets end of file, a writer a broken pipe.
+        """
+        for fifo in self.node_fifos.get(node_id, ()):
+            try:
+                # Opening both ends releases a peer still blocked opening its own end
+                fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+            except FileNotFoundError:
+                continue
+            try:
+                os.remove(fifo)
+            except FileNotFoundError:
+                pass
+            finally:
+                os.close(fd)
+        if node_id in self.stream_exited:
+            self.stream_exited[node_id].set()
+
+    def _run_tool(self, node_id, command, output_dir):
+        log = self.node_logs[node_id]
+        command_str = ' '.join(command)
+
+        # Nodes without declared outputs write to their working directory and cannot be cached
+        outputs = self.node_outputs.get(node_id, [])
+        # The key is recorded even with the cache off so a later run can tell whether this result is stale
+        previous = self.completed.get(node_id)
+        # A pipe is keyed by the BGZF file behind it
+        key_command = [self.decompressed_inputs[node_id].get(arg, arg) for arg in command]
+        if node_id in self.key_ignored_args:
+            key_command[self.key_ignored_args[node_id]] = "<threads>"
+        # Hashing a pipe would consume it; streamed nodes are neither cached nor resumed
+        node_key = None if node_id in self.stream_exited else cache.node_cache_key(
+            key_command, self.node_inputs.get(node_id, []), outputs,
+        )
+        self.node_records[node_id] = {
+            "key": node_key,
+            "outputs": [os.path.relpath(p, settings.MEDIA_ROOT) for p in outputs],
+        }
+
+        if node_key and previous and previous.get("key") == node_key and self._reuse_previous(previous, outputs):
+            log.append(f"[RESUME] Reused result of previous run for: {command_str}")
+            self._output(node_id, f"[RESUME] Reused result of previous run for: {command_str}\n")
+            self.cached_nodes.add(node_id)
+            return
+
+        cache_key = node_key if self.use_cache and node_key and outputs else None
+        if cache_key and cache.restore(cache_key, outputs):
+            log.append(f"[CACHE] Reused cached result for: {command_str}")
+            self._output(node_id, f"[CACHE] Reused cached result for: {command_str}\n")
+            self.cached_nodes.add(node_id)
+            return
+
+        log.append(f"Running: {command_str}")
+        self._output(node_id, f"Running: {command_str}\n")
+
+        log_path = os.path.join(self.log_dir, f"{node_id}.log")
+        self.log_files[node_id] = os.path.relpath(log_path, settings.MEDIA_ROOT)
+        timeout = self.node_timeouts.get(node_id)
+        result = run_process(
+            command, cwd=output_dir, log_path=log_path, on_line=lambda line: self._output(node_id, line),
+            timeout=timeout, cancel=self.cancel_event,
+        )
+        self.process_results[node_id] = result
+        log.append(result.output)
+        if result.terminated == CANCELLED:
+            log.append(f"[CANCELLED] Stopped: {command_str}")
+            raise NodeCancelled(command_str)
+        if result.terminated == TIMEOUT:
+            raise Exception(f"Command timed out after {timeout:g} seconds: {result.output}")
+        if result.returncode != 0:
+            raise Exception(f"Command failed: {result.output}")
+
+        if cache_key:
+            cache.store(cache_key, outputs)
+
+    def _reuse_previous(self, previous, outputs):
+        """
+        Links a previous run's outputs into this run's output paths. False if any are gone.
+        """
+        previous_outputs = [os.path.join(settings.MEDIA_ROOT, p) for p in previous.get("outputs", [])]
+        if len(previous_outputs) != len(outputs) or not all(os.path.exists(p) for p in previous_outputs):
+            return False
+        for old, new in zip(previous_outputs, outputs):
+            if os.path.abspath(old) != os.path.abspath(new):
+                cache.link_tree(old, new)
+        return True
+
+    def _output(self, node_id, line):
+        if self.on_output:
+            self.on_output(node_id, line)
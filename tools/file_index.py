@@ -0,0 +1,211 @@
+"""
+Incrementally maintained index of media/my_files.
+
+The files page and the directory API read FileEntry rows instead of walking
+the disk. Code that writes or deletes files calls index_path, sync_directory
+or remove_path for just the part of the tree it touched; directory sizes are
+kept as the sum of their children so ancestors are updated along the way.
+"""
+import os
+import posixpath
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Sum
+
+from .models import FileEntry
+
+BATCH_SIZE = 1000
+
+
+def files_root():
+    return os.path.join(settings.MEDIA_ROOT, "my_files")
+
+
+def relative_path(full_path):
+    """
+    Returns the index path ("a/b/c") of a path under media/my_files, or None if it is outside.
+    """
+    root = os.path.abspath(files_root())
+    full_path = os.path.abspath(full_path)
+    if full_path == root:
+        return ""
+    if not full_path.startswith(root + os.sep):
+        return None
+    return os.path.relpath(full_path, root).replace(os.sep, "/")
+
+
+def _entry(rel, is_dir, size, mtime):
+    parent, name = posixpath.split(rel)
+    return FileEntry(path=rel, parent=parent, name=name, is_dir=is_dir, size=size, mtime=mtime)
+
+
+def _save(entries):
+    FileEntry.objects.bulk_create(
+        entries,
+        batch_size=BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=["path"],
+        update_fields=["parent", "name", "is_dir", "size", "mtime"],
+    )
+
+
+def _scan(full_path, rel):
+    """
+    Returns entries for a file or a whole directory tree, with directory sizes summed bottom-up.
+    """
+    if not os.path.isdir(full_path):
+        stat = os.stat(full_path)
+        return [_entry(rel, False, stat.st_size, stat.st_mtime)]
+
+    entries = []
+    dir_sizes = {}
+    for root, dirs, files in os.walk(full_path, topdown=False):
+        root_rel = posixpath.join(rel, os.path.relpath(root, full_path).replace(os.sep, "/")) if root != full_path else rel
+        total = 0
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            entries.append(_entry(posixpath.join(root_rel, name), False, stat.st_size, stat.st_mtime))
+            total += stat.st_size
+        for name in dirs:
+            total += dir_sizes.pop(posixpath.join(root_rel, name), 0)
+        dir_sizes[root_rel] = total
+        entries.append(_entry(root_rel, True, total, os.stat(root).st_mtime))
+    return entries
+
+
+def _update_ancestors(rel):
+    """
+    Recomputes the cached sizes of rel and every directory above it.
+    """
+    while rel:
+        full_path = os.path.join(files_root(), rel)
+        if not os.path.isdir(full_path):
+            FileEntry.objects.filter(path=rel).delete()
+        else:
+            size = FileEntry.objects.filter(parent=rel).aggregate(total=Sum("size"))["total"] or 0
+            _save([_entry(rel, True, size, os.stat(full_path).st_mtime)])
+        rel = posixpath.dirname(rel)
+
+
+def index_path(full_path):
+    """
+    (Re)indexes a file or directory tree that was created or changed.
+    """
+    rel = relative_path(full_path)
+    if not rel:
+        return
+    if not os.path.exists(full_path):
+        remove_path(rel)
+        return
+
+    with transaction.atomic():
+        FileEntry.objects.filter(path__startswith=rel + "/").delete()
+        _save(_scan(full_path, rel))
+        _update_ancestors(posixpath.dirname(rel))
+
+
+def remove_path(rel):
+    """
+    Drops a deleted file or directory (and everything below it) from the index.
+    """
+    rel = rel.strip("/")
+    if not rel:
+        return
+    with transaction.atomic():
+        FileEntry.objects.filter(path=rel).delete()
+        FileEntry.objects.filter(path__startswith=rel + "/").delete()
+        _update_ancestors(posixpath.dirname(rel))
+
+
+def remove_paths(rels):
+    """
+    remove_path for many deleted files, updating each affected directory once.
+    """
+    rels = [rel.strip("/") for rel in rels if rel.strip("/")]
+    with transaction.atomic():
+        for start in range(0, len(rels), BATCH_SIZE):
+            FileEntry.objects.filter(path__in=rels[start:start + BATCH_SIZE]).delete()
+        # Deepest first, so parents are summed after their children
+        for parent in sorted({posixpath.dirname(rel) for rel in rels}, key=lambda p: p.count("/"), reverse=True):
+            _update_ancestors(parent)
+
+
+def sync_directory(full_path):
+    """
+    Brings one directory's direct children in line with the disk. Only entries that
+    are new or whose size/mtime changed are rescanned.
+    """
+    rel = relative_path(full_path)
+    if rel is None or not os.path.isdir(full_path):
+        return
+
+    indexed = {e.name: e for e in FileEntry.objects.filter(parent=rel)}
+    with os.scandir(full_path) as it:
+        on_disk = {entry.name: entry for entry in it}
+
+    with transaction.atomic():
+        for name, entry in on_disk.items():
+            stat = entry.stat()
+            known = indexed.get(name)
+            if known and known.is_dir == entry.is_dir() and known.mtime == stat.st_mtime and (entry.is_dir() or known.size == stat.st_size):
+                continue
+            child_rel = posixpath.join(rel, name) if rel else name
+            FileEntry.objects.filter(path__startswith=child_rel + "/").delete()
+            _save(_scan(entry.path, child_rel))
+
+        for name in set(indexed) - set(on_disk):
+            child_rel = posixpath.join(rel, name) if rel else name
+            FileEntry.objects.filter(path=child_rel).delete()
+            FileEntry.objects.filter(path__startswith=child_rel + "/").delete()
+
+        _update_ancestors(rel)
+
+
+def rebuild_index():
+    """
+    Re-creates the whole index from disk.
+    """
+    root = files_root()
+    with transaction.atomic():
+        FileEntry.objects.all().delete()
+        if os.path.isdir(root):
+            for name in os.listdir(root):
+                _save(_scan(os.path.join(root, name), name))
+    return FileEntry.objects.count()
+
+
+def ensure_index():
+    """
+    Builds the index on first use when media/my_files already has content.
+    """
+    if not FileEntry.objects.exists() and os.path.isdir(files_root()) and os.listdir(files_root()):
+        rebuild_index()
+
+
+def list_directory(rel, page=1, page_size=100):
+    """
+    Returns one page of a directory's direct children, folders first.
+    """
+    paginator = Paginator(FileEntry.objects.filter(parent=rel.strip("/")), page_size)
+    page_obj = paginator.get_page(page)
+    return {
+        "path": rel.strip("/"),
+        "page": page_obj.number,
+        "pages": paginator.num_pages,
+        "count": paginator.count,
+        "entries": [
+            {
+                "name": e.name,
+                "path": e.path,
+                "is_dir": e.is_dir,
+                "size": e.size,
+                "mtime": e.mtime,
+            }
+            for e in page_obj.object_list
+        ],
+    }
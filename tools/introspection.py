@@ -0,0 +1,323 @@
+"""
+Cached facts about tool executables: resolved binary, version string and help text.
+
+Running "<tool> --help" or "--version" can take seconds (FastQC starts a JVM
+for either), and the answer only changes when the binary does. Results are
+keyed by the resolved binary's path, size and mtime, kept in a JSON file
+shared by all server processes, and re-probed in a background thread once
+the binary changed; until then callers get the previous answer. Tools run
+as "python3 -m <module>" are keyed by the installed package as well, since
+upgrading it leaves the interpreter as it was.
+"""
+import asyncio
+import fcntl
+import importlib.metadata
+import importlib.util
+import json
+import os
+import shlex
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from .process import capture_process_async
+
+# Seconds a resolved binary path is trusted before PATH is searched again
+RESOLVE_TTL = 30
+# Seconds one --help or --version call may take
+PROBE_TIMEOUT = 120
+
+# (executable, PATH) -> (expires, real path); misses are not memoized so new installs show up at once
+_resolved = {}
+_resolved_lock = threading.Lock()
+
+
+def resolve_binary(executable):
+    """
+    Returns the real path of the binary executable runs as, or None if it is not installed.
+    """
+    key = (executable, os.environ.get("PATH", ""))
+    now = time.monotonic()
+    with _resolved_lock:
+        hit = _resolved.get(key)
+    if hit and hit[0] > now and os.path.exists(hit[1]):
+        return hit[1]
+
+    path = shutil.which(executable)
+    if not path:
+        return None
+    path = os.path.realpath(path)
+    with _resolved_lock:
+        _resolved[key] = (now + RESOLVE_TTL, path)
+    return path
+
+
+def binary_fingerprint(executable):
+    """
+    Returns "path:size:mtime" of the resolved binary, or None if it is not installed.
+    """
+    path = resolve_binary(executable)
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _forget_resolved(executable):
+    with _resolved_lock:
+        for key in [key for key in _resolved if key[0] == executable]:
+            del _resolved[key]
+
+
+def module_fingerprint(module):
+    """
+    Returns "package:version:mtime" of the installed package providing module, or None if it is not importable.
+    """
+    package = module.split(".")[0]
+    try:
+        spec = importlib.util.find_spec(package)
+    except (ImportError, ValueError):
+        return None
+    if spec is None:
+        return None
+    location = spec.origin if spec.has_location else None
+    if location is None and spec.submodule_search_locations:
+        # Namespace packages have no __init__.py
+        location = list(spec.submodule_search_locations)[0]
+    try:
+        version = importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        version = ""
+    try:
+        mtime = os.stat(location).st_mtime_ns if location else 0
+    except OSError:
+        mtime = 0
+    return f"{package}:{version}:{mtime}"
+
+
+def _split(command):
+    try:
+        return shlex.split(command)
+    except ValueError:
+        return command.split()
+
+
+def command_fingerprint(command):
+    """
+    Returns the fingerprint of what a command (a string or argument list) runs, or None if it is not installed.
+
+    That is the resolved binary, plus the installed package for "python3 -m <module>".
+    """
+    parts = _split(command) if isinstance(command, str) else list(command)
+    if not parts:
+        return None
+    fingerprint = binary_fingerprint(parts[0])
+    if fingerprint and len(parts) >= 3 and parts[1] == "-m" and os.path.basename(parts[0]).startswith("python"):
+        # The package may live in another environment than this server's; then only the interpreter counts
+        package = module_fingerprint(parts[2])
+        if package:
+            fingerprint = f"{fingerprint}|{package}"
+    return fingerprint
+
+
+def command_executable(command):
+    parts = _split(command)
+    return parts[0] if parts else command
+
+
+def info_cache_path():
+    return getattr(settings, "TOOL_INFO_CACHE", None) or os.path.join(settings.BASE_DIR, ".tool_info.json")
+
+
+class ToolInfoCache:
+    """
+    command -> info dict, read from the shared file again whenever another process changed it.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._stat_key = None
+        self._entries = {}
+
+    @property
+    def path(self):
+        return self._path or info_cache_path()
+
+    def _current_stat_key(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, command):
+        stat_key = self._current_stat_key()
+        with self._lock:
+            if stat_key != self._stat_key:
+                self._entries = self._read()
+                self._stat_key = stat_key
+            return self._entries.get(command)
+
+    def put(self, command, info):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path + ".lock", "w") as lock_file, self._lock:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                entries = self._read()
+                entries[command] = info
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tool_info.", suffix=".json")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        json.dump(entries, f)
+                    os.chmod(tmp_path, 0o644)
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                self._entries = entries
+                self._stat_key = self._current_stat_key()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+tool_info_cache = ToolInfoCache()
+
+
+def _first_line(*texts):
+    for text in texts:
+        for line in text.splitlines():
+            if line.strip():
+                return line.strip()
+    return ""
+
+
+async def _capture(command):
+    try:
+        return await asyncio.wait_for(capture_process_async(command, shell=True), PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None, "", f"'{command}' did not finish within {PROBE_TIMEOUT} seconds."
+
+
+async def probe(command):
+    """
+    Runs "<command> --help" and "<command> --version" side by side and caches what they print.
+    """
+    fingerprint = await asyncio.to_thread(command_fingerprint, command)
+    (help_code, help_out, help_err), (_, version_out, version_err) = await asyncio.gather(
+        _capture(f"{command} --help"), _capture(f"{command} --version"),
+    )
+    info = {
+        "command": command,
+        "path": await asyncio.to_thread(resolve_binary, command_executable(command)) if fingerprint else None,
+        "fingerprint": fingerprint,
+        "help_returncode": help_code,
+        "help": help_out.strip(),
+        "help_error": help_err.strip(),
+        # Java tools tend to print their version on stderr
+        "version": _first_line(version_out, version_err),
+        "checked_at": time.time(),
+    }
+    # Nothing to key on for a missing binary; it is probed again once it is installed
+    if fingerprint:
+        await asyncio.to_thread(tool_info_cache.put, command, info)
+    return info
+
+
+def is_fresh(info, fingerprint):
+    return info is not None and fingerprint is not None and info.get("fingerprint") == fingerprint
+
+
+async def tool_info(command):
+    """
+    Returns the cached info of a command, probing it first if it was never seen.
+
+    If the binary changed since it was probed, the old info is returned marked
+    "stale" while a background thread probes the new binary.
+    """
+    info = tool_info_cache.get(command)
+    fingerprint = await asyncio.to_thread(command_fingerprint, command)
+    if is_fresh(info, fingerprint):
+        return info
+    if info is not None and fingerprint is not None:
+        refresh_in_background([command])
+        return {**info, "stale": True}
+    return await probe(command)
+
+
+def probe_sync(command):
+    """
+    Probes a command right away and replaces its cached info, e.g. after it was (re)installed.
+
+    For synchronous code; must not be called from a running event loop.
+    """
+    # The binary may now be installed somewhere else on PATH
+    _forget_resolved(command_executable(command))
+    return asyncio.run(probe(command))
+
+
+# Commands a background thread is probing right now
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _refresh(commands):
+    async def probe_all():
+        await asyncio.gather(*(probe(command) for command in commands), return_exceptions=True)
+
+    try:
+        asyncio.run(probe_all())
+    except Exception as e:
+        print(f"Refreshing tool info failed: {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.difference_update(commands)
+
+
+def refresh_in_background(commands):
+    """
+    Probes commands in a daemon thread, skipping those already being probed.
+    """
+    with _refreshing_lock:
+        pending = [command for command in dict.fromkeys(commands) if command and command not in _refreshing]
+        _refreshing.update(pending)
+    if pending:
+        threading.Thread(target=_refresh, args=(pending,), daemon=True).start()
+
+
+async def preflight(commands):
+    """
+    Resolves the binaries of a workflow's tools concurrently.
+
+    commands maps each command to the ids of the nodes running it. Returns the
+    same mapping for the commands that are not installed; the others get their
+    info refreshed in the background if their binary changed.
+    """
+    commands = dict(commands)
+    fingerprints = await asyncio.gather(
+        *(asyncio.to_thread(command_fingerprint, command) for command in commands)
+    )
+    missing = {}
+    stale = []
+    for (command, node_ids), fingerprint in zip(commands.items(), fingerprints):
+        if fingerprint is None:
+            missing[command] = node_ids
+        elif not is_fresh(tool_info_cache.get(command), fingerprint):
+            stale.append(command)
+    refresh_in_background(stale)
+    return missing
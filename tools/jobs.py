@@ -0,0 +1,415 @@
+"""
+Background execution of workflow runs.
+
+The web tier only inserts WorkflowRun rows; worker processes started with
+``manage.py run_workflow_worker`` claim queued rows from the SQLite database
+and execute them.
+
+A run is cancelled through its row as well: cancel_run sets cancel_requested
+and whichever process executes the run notices within CANCEL_POLL_INTERVAL.
+
+The executing process refreshes the run's heartbeat_at every
+HEARTBEAT_INTERVAL. Runs whose heartbeat is older than
+WORKFLOW_RUN_STALE_SECONDS belong to a process that died (a killed worker,
+a restarted web server); fail_stale_runs marks them failed so they can be
+resumed.
+
+Node states and records are written at most every NODE_STATE_FLUSH_INTERVAL
+while a run executes, and in full with its final status: saving the whole
+node_states JSON on every change would write O(nodes²) bytes per run.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from datetime import timedelta
+
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import accounting, file_index
+from .executor import PLAN_VERSION, WorkflowExecutor, WorkflowError, compile_workflow
+from .models import Workflow, WorkflowRun
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of cancel_requested while a run executes
+CANCEL_POLL_INTERVAL = 1.0
+# Seconds between heartbeats of an executing run
+HEARTBEAT_INTERVAL = 10.0
+# Seconds between writes of node_states and node_records while a run executes
+NODE_STATE_FLUSH_INTERVAL = 1.0
+
+# run id -> WorkflowExecutor of the runs executing in this process
+_active_runs = {}
+_active_runs_lock = threading.Lock()
+
+
+def run_log_dir(run_id):
+    return os.path.join(settings.MEDIA_ROOT, "logs", "runs", str(run_id))
+
+
+# Request fields that are stored with a run and passed to the executor
+RUN_OPTIONS = ("max_workers", "failure_policy", "use_cache", "targets", "resume_from", "stream")
+
+
+def run_options(data):
+    return {key: data[key] for key in RUN_OPTIONS if data.get(key) is not None}
+
+
+def run_graph(data):
+    """
+    Returns (workflow_name, nodes, edges, plan) of an execute request: the graph sent
+    by the editor, or the saved workflow given as "workflow_id".
+    """
+    if data.get("workflow_id") is not None:
+        return saved_workflow(data["workflow_id"])
+    return data.get("workflow_name") or "unnamed_workflow", data.get("nodes", []), data.get("edges", []), None
+
+
+def saved_workflow(workflow_id):
+    """
+    Returns (name, nodes, edges, plan) of a saved workflow. The plan compiled when
+    it was saved is used as is, so the graph is not validated again.
+    """
+    workflow = Workflow.objects.filter(pk=workflow_id).first()
+    if workflow is None:
+        raise WorkflowError(f"Workflow {workflow_id} not found")
+    return workflow.name, workflow.graph.get("nodes", []), workflow.graph.get("edges", []), workflow.plan
+
+
+def create_run(workflow_name, nodes, edges, options=None, status=WorkflowRun.STATUS_QUEUED, plan=None):
+    """
+    Validates the graph and stores a run with its execution plan. Raises WorkflowError on invalid graphs.
+
+    Queued runs are picked up by the workers; runs created as running are
+    executed by the caller with execute_run.
+    """
+    if not plan or plan.get("version") != PLAN_VERSION:
+        plan = compile_workflow(nodes, edges)
+    options = options or {}
+    resume_from = options.get("resume_from")
+    if resume_from is not None and not WorkflowRun.objects.filter(pk=resume_from).exists():
+        raise WorkflowError(f"Run {resume_from} not found")
+    node_ids = {n["id"] for n in nodes}
+    unknown = [t for t in options.get("targets") or [] if t not in node_ids]
+    if unknown:
+        raise WorkflowError(f"Unknown target nodes: {unknown}")
+
+    return WorkflowRun.objects.create(
+        workflow_name=workflow_name,
+        payload={"nodes": nodes, "edges": edges, "options": options, "plan": plan},
+        status=status,
+        node_states={n["id"]: "pending" for n in nodes},
+        worker="" if status == WorkflowRun.STATUS_QUEUED else "web",
+        started_at=None if status == WorkflowRun.STATUS_QUEUED else timezone.now(),
+        heartbeat_at=None if status == WorkflowRun.STATUS_QUEUED else timezone.now(),
+    )
+
+
+def submit_run(workflow_name, nodes, edges, options=None, plan=None):
+    """
+    Validates the graph and queues it for a worker.
+    """
+    return create_run(workflow_name, nodes, edges, options, plan=plan)
+
+
+def resume_run(run):
+    """
+    Queues a new run of the same workflow that reuses every node the given run finished.
+    """
+    payload = run.payload
+    options = dict(payload.get("options", {}), resume_from=run.pk)
+    return create_run(
+        run.workflow_name, payload.get("nodes", []), payload.get("edges", []), options, plan=payload.get("plan"),
+    )
+
+
+def completed_node_records(run_id):
+    """
+    Returns {node_id: record} for the nodes that succeeded in a run, following
+    earlier resumed runs so nodes finished two attempts ago are reused as well.
+    """
+    records = {}
+    seen = set()
+    while run_id is not None and run_id not in seen:
+        seen.add(run_id)
+        run = WorkflowRun.objects.filter(pk=run_id).only("node_states", "node_records", "payload").first()
+        if run is None:
+            break
+        for node_id, record in run.node_records.items():
+            if run.node_states.get(node_id) == "success":
+                records.setdefault(node_id, record)
+        run_id = run.payload.get("options", {}).get("resume_from")
+    return records
+
+
+def claim_next_run(worker_name):
+    """
+    Atomically marks the oldest queued run as running and returns it, or None if the queue is empty.
+    """
+    fail_stale_runs()
+    while True:
+        with transaction.atomic():
+            run_id = (
+                WorkflowRun.objects.filter(status=WorkflowRun.STATUS_QUEUED)
+                .order_by("created_at", "id")
+                .values_list("id", flat=True)
+                .first()
+            )
+            if run_id is None:
+                return None
+            # Another worker may have claimed it between the select and the update
+            claimed = WorkflowRun.objects.filter(id=run_id, status=WorkflowRun.STATUS_QUEUED).update(
+                status=WorkflowRun.STATUS_RUNNING,
+                worker=worker_name,
+                started_at=timezone.now(),
+                heartbeat_at=timezone.now(),
+            )
+        if claimed:
+            return WorkflowRun.objects.get(id=run_id)
+
+
+def cancel_run(run):
+    """
+    Cancels a queued or running run. Returns False if it had already finished.
+
+    A queued run is cancelled at once; a running one stops its tools within
+    CANCEL_POLL_INTERVAL, or immediately if it executes in this process.
+    """
+    if WorkflowRun.objects.filter(pk=run.pk, status=WorkflowRun.STATUS_QUEUED).update(
+        status=WorkflowRun.STATUS_CANCELLED, cancel_requested=True, finished_at=timezone.now(),
+    ):
+        return True
+    if not WorkflowRun.objects.filter(pk=run.pk, status=WorkflowRun.STATUS_RUNNING).update(cancel_requested=True):
+        return False
+    with _active_runs_lock:
+        executor = _active_runs.get(run.pk)
+    if executor is not None:
+        executor.cancel()
+    return True
+
+
+def fail_stale_runs():
+    """
+    Marks running runs whose heartbeat is older than WORKFLOW_RUN_STALE_SECONDS as failed
+    (cancelled if a cancel was requested). Returns their ids.
+    """
+    stale_seconds = getattr(settings, "WORKFLOW_RUN_STALE_SECONDS", 120)
+    if not stale_seconds:
+        return []
+    cutoff = timezone.now() - timedelta(seconds=stale_seconds)
+    stale = WorkflowRun.objects.filter(status=WorkflowRun.STATUS_RUNNING).filter(
+        Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff)
+    )
+    failed = []
+    for run in stale.only("pk", "node_states", "cancel_requested", "heartbeat_at", "worker"):
+        node_states = {
+            node_id: "failed" if state == "running" else state for node_id, state in run.node_states.items()
+        }
+        # Only if no live process refreshed it in the meantime
+        if WorkflowRun.objects.filter(pk=run.pk, status=WorkflowRun.STATUS_RUNNING, heartbeat_at=run.heartbeat_at).update(
+            status=WorkflowRun.STATUS_CANCELLED if run.cancel_requested else WorkflowRun.STATUS_FAILED,
+            node_states=node_states,
+            error=f"Worker {run.worker or 'process'} stopped responding (no heartbeat for {stale_seconds} seconds)",
+            finished_at=timezone.now(),
+        ):
+            failed.append(run.pk)
+    return failed
+
+
+class _NodeProgress:
+    """
+    Keeps a run's node_states and node_records, saving them at most every NODE_STATE_FLUSH_INTERVAL.
+
+    A change is written right away if the last write is older than that; otherwise
+    it waits for a later change or flush(), which _watch_cancel calls every second.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._last_write = 0.0
+        self._finished = False
+
+    def update(self, node_id, state, record=None):
+        with self._lock:
+            self.run.node_states[node_id] = state
+            self._dirty.add("node_states")
+            if record is not None:
+                self.run.node_records[node_id] = record
+                self._dirty.add("node_records")
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._finished or not self._dirty or time.monotonic() - self._last_write < NODE_STATE_FLUSH_INTERVAL:
+                return
+            fields = sorted(self._dirty)
+            self._dirty.clear()
+            self._last_write = time.monotonic()
+            self.run.save(update_fields=fields)
+
+    def finish(self):
+        """
+        Stops writing and returns the fields to save with the run's final status.
+        """
+        with self._lock:
+            self._finished = True
+            return {"node_states": dict(self.run.node_states), "node_records": dict(self.run.node_records)}
+
+
+def _watch_cancel(run_id, cancel_event, finished, progress=None):
+    """
+    Sets cancel_event once the run's cancel_requested is set, e.g. by another process,
+    refreshes the run's heartbeat every HEARTBEAT_INTERVAL and writes pending node progress.
+    """
+    last_beat = time.monotonic()
+    try:
+        while not finished.wait(CANCEL_POLL_INTERVAL):
+            if progress is not None:
+                progress.flush()
+            if WorkflowRun.objects.filter(pk=run_id, cancel_requested=True).exists():
+                cancel_event.set()
+                return
+            if time.monotonic() - last_beat >= HEARTBEAT_INTERVAL:
+                last_beat = time.monotonic()
+                beating = WorkflowRun.objects.filter(pk=run_id, status=WorkflowRun.STATUS_RUNNING).update(
+                    heartbeat_at=timezone.now(),
+                )
+                if not beating:
+                    # Given up on as stale while this process was stalled; its result no longer counts
+                    cancel_event.set()
+                    return
+    finally:
+        # The thread ends with the run; its connection would stay open
+        connection.close()
+
+
+def execute_run(run, on_node_update=None, on_output=None):
+    """
+    Executes a claimed run, persisting per-node progress as it changes, and returns the result.
+    """
+    payload = run.payload
+    options = payload.get("options", {})
+    executor = None
+    cancel_event = threading.Event()
+    finished = threading.Event()
+    progress = _NodeProgress(run)
+
+    def node_update(node_id, state):
+        record = None
+        if state == "success" and executor is not None and node_id in executor.node_records:
+            record = executor.node_records[node_id]
+            file_index.sync_directory(executor.output_dirs[node_id])
+        progress.update(node_id, state, record)
+        if state in ("success", "failed", "cancelled") and executor is not None and node_id in executor.process_results:
+            label = executor.node_map[node_id]["data"]["label"]
+            accounting.record_usage(label, executor.process_results[node_id], run=run, node_id=node_id)
+        if on_node_update:
+            on_node_update(node_id, state)
+
+    try:
+        completed = {}
+        if options.get("resume_from") is not None:
+            completed = completed_node_records(options["resume_from"])
+        executor = WorkflowExecutor(
+            run.workflow_name, payload.get("nodes", []), payload.get("edges", []),
+            max_workers=options.get("max_workers"),
+            failure_policy=options.get("failure_policy"),
+            use_cache=options.get("use_cache"),
+            stream=options.get("stream"),
+            targets=options.get("targets"),
+            completed=completed,
+            on_node_update=node_update,
+            on_output=on_output,
+            log_dir=run_log_dir(run.pk),
+            run_id=run.pk,
+            plan=payload.get("plan"),
+            cancel_event=cancel_event,
+        )
+        if executor.copies:
+            # Scattered nodes are tracked per copy
+            run.node_states = {node_id: "pending" for node_id in executor.sorted_ids}
+            run.save(update_fields=["node_states"])
+        with _active_runs_lock:
+            _active_runs[run.pk] = executor
+        threading.Thread(target=_watch_cancel, args=(run.pk, cancel_event, finished, progress), daemon=True).start()
+        result = executor.run()
+    except (WorkflowError, ValueError) as e:
+        result = {"success": False, "error": str(e), "log": []}
+    except Exception as e:
+        result = {"success": False, "error": f"Unexpected error: {e}", "log": []}
+    finally:
+        finished.set()
+        with _active_runs_lock:
+            _active_runs.pop(run.pk, None)
+
+    if result.get("run_dir"):
+        # Picks up the manifest next to the node directories indexed as they finished
+        file_index.sync_directory(os.path.join(settings.MEDIA_ROOT, result["run_dir"]))
+
+    if result.get("cancelled"):
+        run.status = WorkflowRun.STATUS_CANCELLED
+    else:
+        run.status = WorkflowRun.STATUS_SUCCESS if result["success"] else WorkflowRun.STATUS_FAILED
+    run.log = result.get("log", [])
+    run.error = result.get("error", "")
+    run.finished_at = timezone.now()
+    # A run given up on as stale (see fail_stale_runs) keeps that outcome
+    if not WorkflowRun.objects.filter(pk=run.pk, status=WorkflowRun.STATUS_RUNNING).update(
+        status=run.status, log=run.log, error=run.error, finished_at=run.finished_at, **progress.finish(),
+    ):
+        run.refresh_from_db()
+
+    result["run_id"] = run.pk
+    return result
+
+
+def worker_loop(poll_interval=1.0, once=False, log=None):
+    """
+    Claims and executes runs until interrupted. With once=True, returns when the queue is empty.
+
+    Progress messages go to log (the management command's stdout), or to the logger of this module.
+    """
+    log = log or logger.info
+    worker_name = f"{socket.gethostname()}:{os.getpid()}"
+    log(f"Workflow worker {worker_name} started")
+
+    while True:
+        close_old_connections()
+        run = claim_next_run(worker_name)
+        if run is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        log(f"[{worker_name}] Running workflow run #{run.pk} ({run.workflow_name})")
+        execute_run(run)
+        log(f"[{worker_name}] Workflow run #{run.pk} finished: {run.status}")
+
+
+def run_to_dict(run, include_log=False):
+    data = {
+        "id": run.pk,
+        "workflow_name": run.workflow_name,
+        "status": run.status,
+        "nodes": run.node_states,
+        "error": run.error,
+        "cancel_requested": run.cancel_requested,
+        "created_at": run.created_at.isoformat() if run.created_at else None,
+        "started_at": run.started_at.isoformat() if run.started_at else None,
+        "finished_at": run.finished_at.isoformat() if run.finished_at else None,
+        "heartbeat_at": run.heartbeat_at.isoformat() if run.heartbeat_at else None,
+        "usage": {u.node_id: accounting.usage_to_dict(u) for u in run.usage.all()},
+    }
+    if include_log:
+        data["log"] = run.log
+    return data
@@ -0,0 +1,60 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from tools.benchmarks import run_benchmarks
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks workflow execution, directory listing and folder downloads with stub tools "
+        "and prints the results as JSON. Uses a temporary database and media directory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=_int_list, default=[10, 100, 1000],
+                            help="Comma separated DAG sizes in nodes (e.g. 10,100,1000,10000).")
+        parser.add_argument("--shapes", default="wide,deep", help="Comma separated DAG shapes: wide, deep.")
+        parser.add_argument("--max-workers", type=int, default=1, help="Parallel nodes per workflow.")
+        parser.add_argument("--files", type=int, default=100000,
+                            help="Files in the directory listing benchmark (0 to skip).")
+        parser.add_argument("--download-mb", type=int, default=512,
+                            help="Size of the folder in the download benchmark (0 to skip).")
+        parser.add_argument("--output", help="Write the JSON report to this file instead of stdout.")
+
+    def handle(self, *args, **options):
+        shapes = [s.strip() for s in options["shapes"].split(",") if s.strip()]
+        unknown = set(shapes) - {"wide", "deep"}
+        if unknown:
+            self.stderr.write(f"Unknown shapes: {', '.join(sorted(unknown))}")
+            return
+
+        # Runs, uploads and index rows go to a throwaway database
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            report = run_benchmarks(
+                sizes=options["sizes"],
+                shapes=shapes,
+                max_workers=max(1, options["max_workers"]),
+                file_count=options["files"],
+                download_mb=options["download_mb"],
+                log=lambda message: self.stderr.write(message),
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=4)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+            self.stderr.write(f"Wrote {options['output']}")
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from tools.file_index import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the index of media/my_files used by the My Files page (e.g. after files were changed by hand)."
+
+    def handle(self, *args, **options):
+        count = rebuild_index()
+        self.stdout.write(f"Indexed {count} files and folders.")
@@ -0,0 +1,35 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from tools.jobs import worker_loop
+
+
+class Command(BaseCommand):
+    help = "Runs background worker processes that execute queued workflow runs."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1, help="Number of worker processes to start.")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to wait when the queue is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        processes = max(1, options["processes"])
+        kwargs = {"poll_interval": options["poll_interval"], "once": options["once"], "log": self.stdout.write}
+
+        if processes == 1:
+            worker_loop(**kwargs)
+            return
+
+        # Forked children must not share the parent's database connection
+        connections.close_all()
+        workers = [multiprocessing.Process(target=worker_loop, kwargs=kwargs) for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
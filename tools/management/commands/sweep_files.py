@@ -0,0 +1,94 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from tools.retention import EVICTED, EXPIRED, sweep
+
+
+def _size(value):
+    """
+    Parses a byte count with an optional K, M, G or T suffix (powers of 1024).
+    """
+    value = value.strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def _human(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes expired workflow intermediates from media/my_files and evicts least recently used files "
+        "above the size cap (RETENTION_* settings). Use --dry-run to see what would be reclaimed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Report what would be deleted without deleting.")
+        parser.add_argument("--intermediate-days", type=float,
+                            help="Delete intermediates older than this (default RETENTION_INTERMEDIATE_DAYS).")
+        parser.add_argument("--max-bytes", type=_size,
+                            help="Size cap for media/my_files, e.g. 500G (default RETENTION_MAX_BYTES).")
+        parser.add_argument("--evict-final-outputs", action="store_true",
+                            help="Let final workflow outputs be evicted above the size cap too.")
+        parser.add_argument("--batch-size", type=int, help="Files deleted per batch (default RETENTION_BATCH_SIZE).")
+        parser.add_argument("--batch-pause", type=float,
+                            help="Seconds to pause between batches (default RETENTION_BATCH_PAUSE).")
+        parser.add_argument("--interval", type=float,
+                            help="Keep running and sweep every this many seconds instead of once.")
+        parser.add_argument("--list", action="store_true", help="List every file that is (or would be) deleted.")
+        parser.add_argument("--json", action="store_true", help="Print the full report as JSON.")
+
+    def handle(self, *args, **options):
+        overrides = {
+            "intermediate_days": options["intermediate_days"],
+            "max_bytes": options["max_bytes"],
+            "keep_final_outputs": False if options["evict_final_outputs"] else None,
+            "batch_size": options["batch_size"],
+            "batch_pause": options["batch_pause"],
+        }
+        while True:
+            close_old_connections()
+            report = sweep(
+                dry_run=options["dry_run"],
+                log=lambda message: self.stderr.write(message),
+                **overrides,
+            )
+            self._print(report, options)
+            if not options["interval"]:
+                return
+            time.sleep(options["interval"])
+
+    def _print(self, report, options):
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=4))
+            return
+
+        if options["list"]:
+            for entry in report["files"]:
+                self.stdout.write(f"{entry['reason']:8} {entry['kind']:12} {_human(entry['freed']):>12}  {entry['path']}")
+        action = "Would delete" if report["dry_run"] else "Deleted"
+        for reason in (EXPIRED, EVICTED):
+            self.stdout.write(
+                f"{action} {report[reason]['files']} {reason} files, reclaiming {_human(report[reason]['bytes'])}"
+            )
+        self.stdout.write(
+            f"media/my_files: {_human(report['total_bytes'])} -> {_human(report['total_bytes_after'])} "
+            f"({report['candidates']} files eligible, {report['seconds']:.1f}s)"
+        )
+        if report["pinned"]["files"]:
+            self.stdout.write(
+                f"Kept {report['pinned']['files']} files ({_human(report['pinned']['bytes'])}) whose data "
+                "other links, such as the node cache, still hold"
+            )
+        for error in report["errors"]:
+            self.stderr.write(f"Could not delete {error['path']}: {error['error']}")
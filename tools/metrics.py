@@ -0,0 +1,360 @@
+"""
+Metrics exposed in the Prometheus text format.
+
+Request latency per view and bytes served by downloads are kept in memory by
+the server process that observed them. Updating them takes one short
+per-metric lock and no I/O, so the middleware can stay enabled in production.
+
+Tool processes also run in the workflow workers, which serve no requests, so
+their metrics are shared: each process writes its in-flight count to a file in
+METRICS_DIR, and tool durations are read from the ProcessUsage table. Those,
+run queue depth and reserved scheduler capacity are read when /tools/metrics/
+is scraped.
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.models import Case, Count, Q, Sum, Value, When
+
+from .models import ProcessUsage, WorkflowRun
+from .scheduler import resource_pool
+
+# Seconds; the last bucket is +Inf
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TOOL_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200, 14400, 43200, 86400)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self):
+        """
+        Returns (suffix, label values, extra labels, value) tuples.
+        """
+        with self._lock:
+            return [("", key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labels, key, extra)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class SharedGauge(Gauge):
+    """
+    A gauge summed over all live processes of the deployment.
+
+    Every change rewrites this process's values to <METRICS_DIR>/<name>.<pid>;
+    files left by processes that have exited are removed when read.
+    """
+
+    def _path(self, pid):
+        return os.path.join(settings.METRICS_DIR, f"{self.name}.{pid}")
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            self._write()
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+            self._write()
+
+    def _write(self):
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        path = self._path(os.getpid())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as handle:
+            json.dump([[list(key), value] for key, value in self._values.items()], handle)
+        os.replace(tmp_path, path)
+
+    def samples(self):
+        totals = {}
+        try:
+            names = os.listdir(settings.METRICS_DIR)
+        except FileNotFoundError:
+            names = []
+        prefix = f"{self.name}."
+        for name in names:
+            pid = name[len(prefix):]
+            if not name.startswith(prefix) or not pid.isdigit():
+                continue
+            path = os.path.join(settings.METRICS_DIR, name)
+            if not _alive(int(pid)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(path) as handle:
+                    values = json.load(handle)
+            except (FileNotFoundError, ValueError):
+                continue
+            for key, value in values:
+                key = tuple(key)
+                totals[key] = totals.get(key, 0) + value
+        return [("", key, (), value) for key, value in totals.items()]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=REQUEST_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (not cumulative), then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def replace(self, states):
+        """
+        Replaces all series with {label values: (per-bucket counts, sum, count)}.
+        """
+        with self._lock:
+            self._values = {key: [list(counts), total, count] for key, (counts, total, count) in states.items()}
+
+    def samples(self):
+        with self._lock:
+            snapshot = [(key, list(counts), total, count) for key, (counts, total, count) in self._values.items()]
+
+        samples = []
+        for key, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", key, (("le", bound),), cumulative))
+            samples.append(("_sum", key, (), total))
+            samples.append(("_count", key, (), count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.register(Histogram(
+    "dynamic_tools_request_duration_seconds", "Time until the response of a view was returned.",
+    labels=("view", "method", "status"),
+))
+REQUESTS_IN_FLIGHT = registry.register(Gauge(
+    "dynamic_tools_requests_in_flight", "Requests currently being handled.",
+))
+DOWNLOAD_BYTES = registry.register(Counter(
+    "dynamic_tools_download_bytes_total", "Bytes sent by streamed file and archive downloads.",
+    labels=("view",),
+))
+TOOL_PROCESSES_IN_FLIGHT = registry.register(SharedGauge(
+    "dynamic_tools_tool_processes_in_flight", "Tool processes currently running in the server and the workers.",
+))
+TOOL_DURATION = registry.register(Histogram(
+    "dynamic_tools_tool_duration_seconds", "Wall time of tool processes recorded in ProcessUsage.",
+    labels=("tool", "outcome"), buckets=TOOL_BUCKETS,
+))
+WORKFLOW_RUNS = registry.register(Gauge(
+    "dynamic_tools_workflow_runs", "Workflow runs that are queued or running.",
+    labels=("status",),
+))
+RESERVED_CPUS = registry.register(Gauge(
+    "dynamic_tools_reserved_cpus", "CPUs reserved by running workflow nodes on this machine.",
+))
+RESERVED_MEMORY = registry.register(Gauge(
+    "dynamic_tools_reserved_memory_mb", "Memory reserved by running workflow nodes on this machine.",
+))
+
+
+def _count_bytes(content, view):
+    for chunk in content:
+        DOWNLOAD_BYTES.inc(len(chunk), view=view)
+        yield chunk
+
+
+async def _count_bytes_async(content, view):
+    async for chunk in content:
+        DOWNLOAD_BYTES.inc(len(chunk), view=view)
+        yield chunk
+
+
+class MetricsMiddleware:
+    """
+    Times every request by view name and counts the bytes of streamed downloads.
+
+    Works in both modes, so under ASGI async views are not pushed onto the
+    single thread Django reserves for synchronous code.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = self.get_response(request)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+        return self._observe(request, response, start)
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = await self.get_response(request)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+        return self._observe(request, response, start)
+
+    def _observe(self, request, response, start):
+        match = getattr(request, "resolver_match", None)
+        view = (match.url_name or match.view_name) if match else "unmatched"
+        REQUEST_LATENCY.observe(
+            time.perf_counter() - start, view=view, method=request.method, status=response.status_code,
+        )
+
+        # Server-sent event streams are not downloads
+        if response.streaming and not response.get("Content-Type", "").startswith("text/event-stream"):
+            if response.has_header("Content-Length"):
+                # Files may be sent with wsgi.file_wrapper, which never iterates streaming_content
+                DOWNLOAD_BYTES.inc(int(response["Content-Length"]), view=view)
+            elif response.is_async:
+                response.streaming_content = _count_bytes_async(response.streaming_content, view)
+            else:
+                response.streaming_content = _count_bytes(response.streaming_content, view)
+        return response
+
+
+def _tool_durations():
+    """
+    Returns TOOL_DURATION series aggregated from the ProcessUsage table.
+    """
+    bounds = {f"le_{index}": Count("id", filter=Q(wall_seconds__lte=bound)) for index, bound in enumerate(TOOL_BUCKETS)}
+    rows = (
+        ProcessUsage.objects.annotate(outcome=Case(
+            When(returncode=0, then=Value("success")), default=Value("failure"),
+        ))
+        .values("tool", "outcome")
+        .annotate(count=Count("id"), total=Sum("wall_seconds"), **bounds)
+        .order_by("tool", "outcome")
+    )
+
+    states = {}
+    for row in rows:
+        # Cumulative counts from the database, per-bucket counts in the histogram
+        cumulative = [row[f"le_{index}"] for index in range(len(TOOL_BUCKETS))] + [row["count"]]
+        counts = [value - previous for value, previous in zip(cumulative, [0] + cumulative[:-1])]
+        states[(row["tool"], row["outcome"])] = (counts, row["total"] or 0.0, row["count"])
+    return states
+
+
+def render_metrics():
+    """
+    Refreshes the metrics read from shared state and returns the exposition text.
+    """
+    TOOL_DURATION.replace(_tool_durations())
+
+    counts = dict(
+        WorkflowRun.objects.filter(status__in=[WorkflowRun.STATUS_QUEUED, WorkflowRun.STATUS_RUNNING])
+        .values_list("status").annotate(n=Count("id"))
+    )
+    for status in (WorkflowRun.STATUS_QUEUED, WorkflowRun.STATUS_RUNNING):
+        WORKFLOW_RUNS.set(counts.get(status, 0), status=status)
+
+    usage = resource_pool.usage()
+    RESERVED_CPUS.set(usage["cpus_used"])
+    RESERVED_MEMORY.set(usage["memory_mb_used"])
+    return registry.render()
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tools', '0003_workflowrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflowrun',
+            name='node_records',
+            field=models.JSONField(default=dict),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tools', '0005_upload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1024, unique=True)),
+                ('parent', models.CharField(db_index=True, max_length=1024)),
+                ('name', models.CharField(max_length=255)),
+                ('is_dir', models.BooleanField(default=False)),
+                ('size', models.BigIntegerField(default=0)),
+                ('mtime', models.FloatField(default=0)),
+            ],
+            options={
+                'ordering': ['-is_dir', 'name'],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tools', '0006_fileentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('node_id', models.CharField(blank=True, default='', max_length=255)),
+                ('tool', models.CharField(db_index=True, max_length=255)),
+                ('command', models.TextField()),
+                ('returncode', models.IntegerField()),
+                ('wall_seconds', models.FloatField()),
+                ('user_seconds', models.FloatField(blank=True, null=True)),
+                ('system_seconds', models.FloatField(blank=True, null=True)),
+                ('max_rss_kb', models.BigIntegerField(blank=True, null=True)),
+                ('read_bytes', models.BigIntegerField(blank=True, null=True)),
+                ('write_bytes', models.BigIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('run', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='usage', to='tools.workflowrun')),
+            ],
+        ),
+    ]
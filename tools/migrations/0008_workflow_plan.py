@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tools', '0007_processusage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='plan',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
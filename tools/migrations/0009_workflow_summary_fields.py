@@ -0,0 +1,34 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def fill_summary_fields(apps, schema_editor):
+    Workflow = apps.get_model("tools", "Workflow")
+    for workflow in Workflow.objects.all():
+        graph = workflow.graph if isinstance(workflow.graph, dict) else {}
+        Workflow.objects.filter(pk=workflow.pk).update(
+            node_count=len(graph.get("nodes") or []),
+            updated_at=workflow.created_at,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tools', '0008_workflow_plan'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflow',
+            name='node_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='workflow',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_summary_fields, migrations.RunPython.noop),
+    ]
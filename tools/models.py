@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 # Or for SQLite:
 from django.db.models import JSONField
@@ -5,7 +7,113 @@ from django.db.models import JSONField
 class Workflow(models.Model):
     name = models.CharField(max_length=255, unique=True)
     graph = JSONField()  # stores nodes, edges, tool parameters
+    plan = JSONField(null=True, blank=True)  # compiled execution plan, None while the graph is invalid
+    node_count = models.PositiveIntegerField(default=0)  # kept so listings do not have to load the graph
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
+
+
+class WorkflowRun(models.Model):
+    """
+    A workflow execution submitted as a job. Queued rows double as the run queue
+    that background workers (manage.py run_workflow_worker) pull from.
+    """
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCESS = "success"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_SUCCESS, "Success"),
+        (STATUS_FAILED, "Failed"),
+        (STATUS_CANCELLED, "Cancelled"),
+    ]
+
+    workflow_name = models.CharField(max_length=255)
+    payload = JSONField()  # nodes, edges and execution options as submitted
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    node_states = JSONField(default=dict)  # node id -> pending/running/success/failed/skipped
+    node_records = JSONField(default=dict)  # node id -> {"key", "outputs"} of finished nodes, used to resume
+    log = JSONField(default=list)
+    error = models.TextField(blank=True, default="")
+    worker = models.CharField(max_length=255, blank=True, default="")
+    cancel_requested = models.BooleanField(default=False)  # set by the cancel API, polled by whoever executes the run
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # refreshed while the run executes; stale means its process died
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.workflow_name} #{self.pk} ({self.status})"
+
+
+class Upload(models.Model):
+    """
+    A resumable chunked upload (see tools/uploads.py).
+    """
+    STATUS_UPLOADING = "uploading"
+    STATUS_COMPLETE = "complete"
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, "Uploading"),
+        (STATUS_COMPLETE, "Complete"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    filename = models.CharField(max_length=255)
+    path = models.CharField(max_length=1024)  # final location, relative to MEDIA_ROOT
+    size = models.BigIntegerField(null=True, blank=True)  # total bytes, if known up front
+    offset = models.BigIntegerField(default=0)  # bytes received and acknowledged
+    expected_sha256 = models.CharField(max_length=64, blank=True, default="")
+    sha256 = models.CharField(max_length=64, blank=True, default="")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_UPLOADING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
+
+
+class FileEntry(models.Model):
+    """
+    Index of media/my_files, kept up to date as tools write and files are deleted
+    (see tools/file_index.py). Paths are relative to media/my_files.
+    """
+    path = models.CharField(max_length=1024, unique=True)
+    parent = models.CharField(max_length=1024, db_index=True)  # "" for top-level entries
+    name = models.CharField(max_length=255)
+    is_dir = models.BooleanField(default=False)
+    size = models.BigIntegerField(default=0)  # total size of everything below for directories
+    mtime = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ["-is_dir", "name"]
+
+    def __str__(self):
+        return self.path
+
+
+class ProcessUsage(models.Model):
+    """
+    Resources used by one tool process, from a workflow node or the tool page
+    (see tools/process.py). Summed per tool by tools/accounting.py.
+    """
+    run = models.ForeignKey(WorkflowRun, null=True, blank=True, on_delete=models.CASCADE, related_name="usage")
+    node_id = models.CharField(max_length=255, blank=True, default="")  # empty outside workflows
+    tool = models.CharField(max_length=255, db_index=True)
+    command = models.TextField()
+    returncode = models.IntegerField()
+    wall_seconds = models.FloatField()
+    user_seconds = models.FloatField(null=True, blank=True)
+    system_seconds = models.FloatField(null=True, blank=True)
+    max_rss_kb = models.BigIntegerField(null=True, blank=True)  # peak resident set size
+    read_bytes = models.BigIntegerField(null=True, blank=True)
+    write_bytes = models.BigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.tool} ({self.wall_seconds:.1f}s)"
@@ -0,0 +1,319 @@
+"""
+Random access to the records of large FASTQ and FASTA files.
+
+The file is memory-mapped and a sparse index of (record number, byte offset)
+pairs, one per BLOCK_SIZE bytes, is built on first access and stored under
+settings.PREVIEW_INDEX_DIR. Building it counts newlines (FASTQ) or record
+starts (FASTA) block by block, so it runs at memory speed. Looking up record
+n bisects the index and parses at most one block forward, however large the
+file is. An index is rebuilt when its file's size or mtime changes.
+
+BGZF-compressed files (see bgzf.py) are read through their block index
+instead of a memory map; other compressed files cannot be previewed.
+"""
+import hashlib
+import json
+import mmap
+import os
+import random
+import tempfile
+import threading
+from array import array
+from bisect import bisect_right
+
+from django.conf import settings
+
+from .bgzf import BgzfReader, is_bgzf
+
+INDEX_VERSION = 1
+BLOCK_SIZE = 256 * 1024
+# Longer sequences (assembled contigs, long reads) are cut in previews
+MAX_SEQUENCE_CHARS = 10000
+MAX_RECORDS = 1000
+
+FASTQ = "fastq"
+FASTA = "fasta"
+EXTENSIONS = {
+    ".fastq": FASTQ, ".fq": FASTQ,
+    ".fasta": FASTA, ".fa": FASTA, ".fna": FASTA, ".faa": FASTA, ".ffn": FASTA, ".fas": FASTA,
+}
+COMPRESSED_EXTENSIONS = (".gz", ".bgz", ".bz2", ".xz", ".zst")
+
+# path -> lock, so concurrent first requests build an index once
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+
+class PreviewError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def index_dir():
+    return getattr(settings, "PREVIEW_INDEX_DIR", None) or os.path.join(settings.MEDIA_ROOT, "preview_index")
+
+
+def index_path(path):
+    return os.path.join(index_dir(), hashlib.sha1(os.path.realpath(path).encode()).hexdigest() + ".idx")
+
+
+def detect_format(path, data):
+    name = path.lower()
+    if name.endswith(COMPRESSED_EXTENSIONS):
+        if not isinstance(data, BgzfReader):
+            raise PreviewError("Only uncompressed or BGZF-compressed files can be previewed.", status=415)
+        name = os.path.splitext(name)[0]
+    fmt = EXTENSIONS.get(os.path.splitext(name)[1])
+    if fmt:
+        return fmt
+    first = data[0:1]
+    if first == b"@":
+        return FASTQ
+    if first == b">":
+        return FASTA
+    raise PreviewError("Not a FASTQ or FASTA file.", status=415)
+
+
+def _index_fastq(mm, entries):
+    """
+    Adds an entry for the first record starting in every block; returns the number of records.
+
+    Records are four lines, so a line starts a record when its number is a multiple of four.
+    """
+    size = len(mm)
+    lines = 0  # newlines before the current block
+    for start in range(0, size, BLOCK_SIZE):
+        if start == 0:
+            pos, line = 0, 0
+        else:
+            newline = mm.find(b"\n", start - 1)
+            pos = newline + 1 if newline != -1 else size
+            line = lines if newline == start - 1 else lines + 1
+        while line % 4 and pos < size:
+            newline = mm.find(b"\n", pos)
+            pos = newline + 1 if newline != -1 else size
+            line += 1
+        if pos < size and (not entries or line // 4 > entries[-2]):
+            entries.extend((line // 4, pos))
+        lines += mm[start:start + BLOCK_SIZE].count(b"\n")
+
+    if size and mm[size - 1:size] != b"\n":
+        lines += 1
+    return lines // 4
+
+
+def _index_fasta(mm, entries):
+    """
+    Same as _index_fastq for FASTA, where a record starts at every line beginning with ">".
+    """
+    size = len(mm)
+    records = 0  # record starts before the current block
+    for start in range(0, size, BLOCK_SIZE):
+        if start == 0 and mm[0:1] == b">":
+            pos = 0
+            records_in_block = 1
+        else:
+            found = mm.find(b"\n>", max(start - 1, 0))
+            pos = found + 1 if found != -1 else size
+            records_in_block = 0
+        if pos < size and (not entries or records > entries[-2]):
+            entries.extend((records, pos))
+        # A "\n>" pair split between blocks belongs to the block holding the ">"
+        records += records_in_block + mm[max(start - 1, 0):start + BLOCK_SIZE].count(b"\n>")
+    return records
+
+
+def _open_data(path):
+    """
+    Returns (file, data) where data is a read-only mmap or a BgzfReader; b"" for an empty file.
+    """
+    if is_bgzf(path):
+        reader = BgzfReader(path)
+        return reader, reader
+    f = open(path, "rb")
+    if not os.fstat(f.fileno()).st_size:
+        return f, b""
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # Lookups jump around the file; read-ahead would only waste page cache
+    mm.madvise(mmap.MADV_RANDOM)
+    return f, mm
+
+
+def _close_data(f, data):
+    if isinstance(data, mmap.mmap):
+        data.close()
+    f.close()
+
+
+def _build_index(data, fmt, stat, target):
+    entries = array("Q")
+    records = 0
+    if len(data):
+        if isinstance(data, mmap.mmap):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        records = _index_fastq(data, entries) if fmt == FASTQ else _index_fasta(data, entries)
+        if isinstance(data, mmap.mmap):
+            data.madvise(mmap.MADV_RANDOM)
+
+    header = {
+        "version": INDEX_VERSION,
+        "format": fmt,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "records": records,
+        "entries": len(entries) // 2,
+    }
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            f.write(entries.tobytes())
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _read_header(target, stat):
+    """
+    Returns (header, entries offset) of an index that still matches the file, or None.
+    """
+    try:
+        with open(target, "rb") as f:
+            line = f.readline()
+    except FileNotFoundError:
+        return None
+    try:
+        header = json.loads(line)
+    except ValueError:
+        return None
+    if (header.get("version"), header.get("size"), header.get("mtime_ns")) != (INDEX_VERSION, stat.st_size, stat.st_mtime_ns):
+        return None
+    return header, len(line)
+
+
+class SequenceFile:
+    """
+    A memory-mapped FASTQ/FASTA file and its index. Use as a context manager.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self._file, self._mm = _open_data(path)
+        try:
+            self._load_index(stat)
+        except BaseException:
+            self.close()
+            raise
+
+    def _load_index(self, stat):
+        self.format = detect_format(self.path, self._mm)
+        target = index_path(self.path)
+
+        found = _read_header(target, stat)
+        if found is None:
+            with _build_locks_lock:
+                lock = _build_locks.setdefault(target, threading.Lock())
+            with lock:
+                found = _read_header(target, stat)
+                if found is None:
+                    _build_index(self._mm, self.format, stat, target)
+                    found = _read_header(target, stat)
+            if found is None:
+                raise PreviewError("The file changed while it was being indexed, try again.", status=409)
+
+        header, offset = found
+        self.records = header["records"]
+        self._entries = array("Q")
+        with open(target, "rb") as f:
+            f.seek(offset)
+            self._entries.frombytes(f.read())
+        self._entry_records = self._entries[0::2]
+
+    def close(self):
+        _close_data(self._file, self._mm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _line(self, pos):
+        """
+        Returns (line without its line break, start of the next line).
+        """
+        end = self._mm.find(b"\n", pos)
+        if end == -1:
+            end = len(self._mm)
+        return bytes(self._mm[pos:end]).rstrip(b"\r"), end + 1
+
+    def _next_record(self, pos):
+        if self.format == FASTQ:
+            for _ in range(4):
+                _, pos = self._line(pos)
+            return pos
+        found = self._mm.find(b"\n>", pos)
+        return found + 1 if found != -1 else len(self._mm)
+
+    def _offset(self, number):
+        """
+        Returns the byte offset of record number (0-based).
+        """
+        slot = bisect_right(self._entry_records, number) - 1
+        record, pos = self._entries[2 * slot], self._entries[2 * slot + 1]
+        for _ in range(number - record):
+            pos = self._next_record(pos)
+        return pos
+
+    def _read(self, number, pos):
+        """
+        Parses the record at pos; returns (record, offset of the next record).
+        """
+        record = {"number": number + 1, "offset": pos}
+        header, pos = self._line(pos)
+        record["id"] = header[1:].decode(errors="replace")
+        if self.format == FASTQ:
+            sequence, pos = self._line(pos)
+            _, pos = self._line(pos)
+            quality, pos = self._line(pos)
+            record["sequence"] = sequence[:MAX_SEQUENCE_CHARS].decode(errors="replace")
+            record["quality"] = quality[:MAX_SEQUENCE_CHARS].decode(errors="replace")
+            record["truncated"] = len(sequence) > MAX_SEQUENCE_CHARS
+            return record, pos
+
+        end = self._next_record(pos)
+        # Enough raw bytes for MAX_SEQUENCE_CHARS bases even with short lines
+        raw = bytes(self._mm[pos:min(end, pos + 2 * MAX_SEQUENCE_CHARS + 2)])
+        sequence = raw.replace(b"\r", b"").replace(b"\n", b"")
+        record["sequence"] = sequence[:MAX_SEQUENCE_CHARS].decode(errors="replace")
+        record["truncated"] = len(sequence) > MAX_SEQUENCE_CHARS or pos + len(raw) < end
+        return record, end
+
+    def read_range(self, start, count):
+        """
+        Returns up to count records from record start (0-based) on.
+        """
+        if start < 0 or count < 1:
+            raise PreviewError("start must be at least 1 and count at least 1.")
+        count = min(count, MAX_RECORDS, max(self.records - start, 0))
+        if not count:
+            return []
+        pos = self._offset(start)
+        records = []
+        for number in range(start, start + count):
+            record, pos = self._read(number, pos)
+            records.append(record)
+        return records
+
+    def sample(self, count, seed=None):
+        """
+        Returns count records picked at random, in file order.
+        """
+        count = min(max(count, 0), MAX_RECORDS, self.records)
+        numbers = sorted(random.Random(seed).sample(range(self.records), count))
+        return [self._read(number, self._offset(number))[0] for number in numbers]
@@ -0,0 +1,401 @@
+"""
+Running tool processes without buffering their whole output in memory.
+
+Output is read line by line as it is produced, written in full to a log file
+on disk, forwarded to an optional callback and only the last few lines are
+kept in memory. Each process also reports what it cost: wall, user and
+system time and peak RSS from wait4(), and bytes read and written from
+/proc/<pid>/io, both including the children it waited for.
+
+run_process_async() does the same on the event loop, so async views can
+supervise many tools without holding a thread each. Every tool process, sync
+or async, takes a slot from process_limiter first.
+
+Tools run in their own process group. When one times out or is cancelled
+the whole group gets SIGTERM, and SIGKILL after TOOL_KILL_GRACE_SECONDS, so
+children started by wrapper scripts (spades.py) stop with it.
+"""
+import asyncio
+import codecs
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import TOOL_PROCESSES_IN_FLIGHT
+
+# Seconds between attempts of async callers waiting for a free process slot
+SLOT_POLL_INTERVAL = 0.05
+READ_CHUNK_SIZE = 64 * 1024
+# Seconds between checks of the cancel event of a running tool
+CANCEL_POLL_INTERVAL = 0.2
+
+# ProcessResult.terminated values
+TIMEOUT = "timeout"
+CANCELLED = "cancelled"
+
+
+class ProcessResult:
+    def __init__(self, returncode, tail, log_path, usage=None, command=None, terminated=None):
+        self.returncode = returncode
+        self.command = command
+        self.tail = tail            # last lines of combined stdout/stderr
+        self.log_path = log_path    # full output on disk, or None
+        self.usage = usage or {}    # see _wait_with_usage
+        self.terminated = terminated  # TIMEOUT or CANCELLED if the process was stopped
+
+    @property
+    def output(self):
+        return "".join(self.tail)
+
+
+def log_tail_lines():
+    return getattr(settings, "TOOL_LOG_TAIL_LINES", 200)
+
+
+def kill_grace_seconds():
+    return getattr(settings, "TOOL_KILL_GRACE_SECONDS", 10)
+
+
+def tool_timeout(*values):
+    """
+    Returns the first of values that is set, else TOOL_TIMEOUT_SECONDS, as seconds.
+
+    None means no limit, as does a value of 0 (to lift the default for one
+    tool). Raises ValueError for values that are not numbers.
+    """
+    for value in values:
+        if value not in (None, ""):
+            seconds = float(value)
+            return seconds if seconds > 0 else None
+    default = getattr(settings, "TOOL_TIMEOUT_SECONDS", None)
+    return float(default) if default else None
+
+
+class ProcessLimiter:
+    """
+    Caps the tool processes this server process runs at once.
+
+    One semaphore is shared by worker threads (with) and event loops (async with).
+    """
+
+    def __init__(self, limit=None):
+        self._limit = limit
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return self._limit or getattr(settings, "TOOL_MAX_CONCURRENT_PROCESSES", 256)
+
+    @property
+    def semaphore(self):
+        with self._lock:
+            if self._semaphore is None:
+                self._semaphore = threading.BoundedSemaphore(self.limit)
+            return self._semaphore
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.semaphore.release()
+
+    async def __aenter__(self):
+        # Polling keeps the wait cancellable and never parks a thread per waiter
+        while not self.semaphore.acquire(blocking=False):
+            await asyncio.sleep(SLOT_POLL_INTERVAL)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+
+
+process_limiter = ProcessLimiter()
+
+
+def _read_proc_io(pid):
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            fields = dict(line.split(": ", 1) for line in f.read().splitlines() if ": " in line)
+    except OSError:
+        return {}
+    # rchar/wchar count everything passed through read()/write(), including page cache hits
+    return {"read_bytes": int(fields.get("rchar", 0)), "write_bytes": int(fields.get("wchar", 0))}
+
+
+def _signal_group(process, sig):
+    try:
+        # start_new_session made the tool the leader of its own process group
+        os.killpg(process.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _terminate_group(process, finished):
+    """
+    Sends SIGTERM to the tool's process group, and SIGKILL once the grace period is over.
+
+    finished is set when the tool's output was closed and the tool reaped; the
+    group still gets SIGKILL then, for children that ignored SIGTERM.
+    """
+    _signal_group(process, signal.SIGTERM)
+    finished.wait(kill_grace_seconds())
+    _signal_group(process, signal.SIGKILL)
+
+
+def _watch(process, finished, timeout, cancel, terminated):
+    """
+    Terminates the process when timeout seconds have passed or cancel is set.
+    Runs in a thread next to run_process until finished is set.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    while not finished.is_set():
+        if cancel is not None and cancel.is_set():
+            terminated.append(CANCELLED)
+            break
+        remaining = deadline - time.monotonic() if deadline else None
+        if remaining is not None and remaining <= 0:
+            terminated.append(TIMEOUT)
+            break
+        if cancel is not None:
+            remaining = CANCEL_POLL_INTERVAL if remaining is None else min(remaining, CANCEL_POLL_INTERVAL)
+        finished.wait(remaining)
+    if terminated:
+        _terminate_group(process, finished)
+
+
+def _wait_with_usage(process, started):
+    """
+    Reaps the process and returns (returncode, usage).
+    """
+    io = {}
+    try:
+        # Wait without reaping so /proc/<pid>/io still describes the finished process
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        io = _read_proc_io(process.pid)
+        _, status, rusage = os.wait4(process.pid, 0)
+    except (AttributeError, ChildProcessError):
+        # No wait4 on this platform, or the process was already reaped
+        return process.wait(), {"wall_seconds": time.monotonic() - started}
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+    usage = {
+        "wall_seconds": time.monotonic() - started,
+        "user_seconds": rusage.ru_utime,
+        "system_seconds": rusage.ru_stime,
+        "max_rss_kb": rusage.ru_maxrss,
+        "read_bytes": io.get("read_bytes"),
+        "write_bytes": io.get("write_bytes"),
+    }
+    return process.returncode, usage
+
+
+def run_process(command, cwd=None, log_path=None, on_line=None, shell=False, timeout=None, cancel=None):
+    """
+    Runs a command with stderr merged into stdout and returns a ProcessResult.
+
+    on_line(line) is called for every output line as soon as the tool prints it.
+    The tool's process group is terminated after timeout seconds or once the
+    threading.Event cancel is set; result.terminated tells which.
+    """
+    tail = deque(maxlen=log_tail_lines())
+    log_file = None
+    if log_path:
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        log_file = open(log_path, "w", buffering=1)
+
+    try:
+        with process_limiter:
+            started = time.monotonic()
+            TOOL_PROCESSES_IN_FLIGHT.inc()
+            try:
+                process = subprocess.Popen(
+                    command,
+                    shell=shell,
+                    cwd=cwd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    text=True,
+                    errors="replace",
+                    bufsize=1,
+                    start_new_session=True,
+                )
+                finished = threading.Event()
+                terminated = []
+                watchdog = None
+                if timeout or cancel is not None:
+                    watchdog = threading.Thread(
+                        target=_watch, args=(process, finished, timeout, cancel, terminated), daemon=True,
+                    )
+                    watchdog.start()
+                try:
+                    with process.stdout:
+                        for line in process.stdout:
+                            tail.append(line)
+                            if log_file:
+                                log_file.write(line)
+                            if on_line:
+                                on_line(line)
+                    returncode, usage = _wait_with_usage(process, started)
+                finally:
+                    finished.set()
+                    if watchdog is not None:
+                        watchdog.join()
+            finally:
+                TOOL_PROCESSES_IN_FLIGHT.dec()
+    finally:
+        if log_file:
+            log_file.close()
+
+    return ProcessResult(returncode, list(tail), log_path, usage, command, terminated[0] if terminated else None)
+
+
+def _split_lines(text, final=False):
+    """
+    Returns the complete lines of text and the unfinished rest.
+
+    Line endings are translated like the text mode pipe of run_process does.
+    """
+    rest_cr = ""
+    if text.endswith("\r") and not final:
+        # May be the first half of a \r\n split between two reads
+        text, rest_cr = text[:-1], "\r"
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    rest = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if final and rest:
+        lines.append(rest)
+        rest = ""
+    return lines, rest + rest_cr
+
+
+async def _wait_with_usage_async(process, started):
+    """
+    Waits on the event loop until the process exits, then reaps it like _wait_with_usage.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        # No pidfd (old kernel or not Linux): wait in a thread instead
+        return await asyncio.to_thread(_wait_with_usage, process, started)
+
+    exited = loop.create_future()
+    try:
+        # The pidfd becomes readable once the process has exited
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+    finally:
+        os.close(pidfd)
+    return _wait_with_usage(process, started)
+
+
+async def _terminate_group_async(process, started):
+    """
+    _terminate_group on the event loop; returns what _wait_with_usage does.
+    """
+    _signal_group(process, signal.SIGTERM)
+    waiter = asyncio.ensure_future(_wait_with_usage_async(process, started))
+    await asyncio.wait({waiter}, timeout=kill_grace_seconds())
+    _signal_group(process, signal.SIGKILL)
+    return await asyncio.shield(waiter)
+
+
+async def run_process_async(command, cwd=None, log_path=None, on_line=None, shell=False, timeout=None):
+    """
+    Async version of run_process; output is read from the pipe on the event loop.
+
+    The process is started with Popen rather than asyncio's subprocess API so it
+    can still be reaped with wait4() for its resource usage. Its process group is
+    terminated after timeout seconds, or when the awaiting task is cancelled (the
+    client went away).
+    """
+    tail = deque(maxlen=log_tail_lines())
+    log_file = None
+    if log_path:
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        log_file = open(log_path, "w", buffering=1)
+
+    loop = asyncio.get_running_loop()
+    try:
+        async with process_limiter:
+            started = time.monotonic()
+            TOOL_PROCESSES_IN_FLIGHT.inc()
+            try:
+                process = subprocess.Popen(
+                    command, shell=shell, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    start_new_session=True,
+                )
+                reader = asyncio.StreamReader()
+                transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), process.stdout)
+                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+                terminated = None
+
+                async def pump():
+                    pending = ""
+                    while True:
+                        chunk = await reader.read(READ_CHUNK_SIZE)
+                        lines, pending = _split_lines(pending + decoder.decode(chunk, final=not chunk), final=not chunk)
+                        for line in lines:
+                            tail.append(line)
+                            if log_file:
+                                log_file.write(line)
+                            if on_line:
+                                on_line(line)
+                        if not chunk:
+                            break
+                    return await _wait_with_usage_async(process, started)
+
+                try:
+                    # wait_for rather than asyncio.timeout(), which needs Python 3.11
+                    returncode, usage = await asyncio.wait_for(pump(), timeout)
+                except asyncio.TimeoutError:
+                    terminated = TIMEOUT
+                    returncode, usage = await _terminate_group_async(process, started)
+                except asyncio.CancelledError:
+                    await _terminate_group_async(process, started)
+                    raise
+                finally:
+                    transport.close()
+            finally:
+                TOOL_PROCESSES_IN_FLIGHT.dec()
+    finally:
+        if log_file:
+            log_file.close()
+
+    return ProcessResult(returncode, list(tail), log_path, usage, command, terminated)
+
+
+async def capture_process_async(command, cwd=None, shell=False):
+    """
+    Runs a short command and returns (returncode, stdout, stderr) as text.
+
+    For commands whose whole output is wanted (help texts, versions), not tool runs.
+    """
+    async with process_limiter:
+        if shell:
+            process = await asyncio.create_subprocess_shell(
+                command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                start_new_session=True,
+            )
+        else:
+            process = await asyncio.create_subprocess_exec(
+                *command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                start_new_session=True,
+            )
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            # Also stops the JVM or interpreter a wrapper script started
+            _signal_group(process, signal.SIGKILL)
+            raise
+    return process.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
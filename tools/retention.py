@@ -0,0 +1,319 @@
+"""
+Retention policy for media/my_files (manage.py sweep_files).
+
+Files fall in three groups:
+
+- final outputs: files of workflow nodes no other node of their run consumes,
+  as marked in the run's manifest.json (see WorkflowExecutor._is_final)
+- intermediates: files of the other nodes of finished runs
+- everything else: uploads and tool page outputs
+
+Intermediates older than RETENTION_INTERMEDIATE_DAYS are deleted. If
+media/my_files is then still larger than RETENTION_MAX_BYTES, intermediates
+and other files are evicted least recently used first (by access time, or
+modification time where that is later), final outputs too unless
+RETENTION_KEEP_FINAL_OUTPUTS. Runs that are queued or running, their
+manifests, uploads in progress and anything modified in the last
+RETENTION_MIN_AGE_HOURS are never touched; neither are files of runs whose
+manifest predates the "final" flag.
+
+Files are deleted in batches of RETENTION_BATCH_SIZE with a pause of
+RETENTION_BATCH_PAUSE seconds in between, so a large sweep does not take
+the disk away from running tools. Hard-linked files (node cache entries,
+deduplicated uploads) only count as reclaimed once their last link goes.
+Files whose data another link still holds (the node cache, a file that is
+not eligible yet) are pinned: deleting them would free nothing, so they are
+kept and reported. Data held outside media/my_files does not count towards
+RETENTION_MAX_BYTES; the node cache has its own cap.
+"""
+import json
+import os
+import re
+import stat as stat_module
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+from . import bgzf, blobs, file_index
+from .models import WorkflowRun
+from .uploads import PART_SUFFIX
+
+FINAL = "final"
+INTERMEDIATE = "intermediate"
+OTHER = "other"
+
+EXPIRED = "expired"
+EVICTED = "evicted"
+
+MANIFEST = "manifest.json"
+RUN_DIR = re.compile(r"^run_(.+)$")
+
+
+def policy(**overrides):
+    """
+    Returns the retention settings, with overrides (from command line options) applied when not None.
+    """
+    values = {
+        "intermediate_days": getattr(settings, "RETENTION_INTERMEDIATE_DAYS", None),
+        "max_bytes": getattr(settings, "RETENTION_MAX_BYTES", None),
+        "keep_final_outputs": getattr(settings, "RETENTION_KEEP_FINAL_OUTPUTS", True),
+        "min_age_hours": getattr(settings, "RETENTION_MIN_AGE_HOURS", 1),
+        "batch_size": getattr(settings, "RETENTION_BATCH_SIZE", 200),
+        "batch_pause": getattr(settings, "RETENTION_BATCH_PAUSE", 1.0),
+    }
+    values.update({key: value for key, value in overrides.items() if value is not None})
+    return values
+
+
+class FileInfo:
+    __slots__ = ("path", "rel", "kind", "size", "mtime", "last_access", "inode", "links", "blob")
+
+    def __init__(self, path, rel, kind, stat):
+        self.path = path
+        self.rel = rel
+        self.kind = kind
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.last_access = max(stat.st_atime, stat.st_mtime)
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.links = stat.st_nlink
+        # Deleting the last link in my_files also frees the upload's blob (see blobs.py)
+        self.blob = stat.st_nlink > 1 and blobs.blob_of(stat) is not None
+
+
+def _active_run_ids():
+    active = (WorkflowRun.STATUS_QUEUED, WorkflowRun.STATUS_RUNNING)
+    return {str(pk) for pk in WorkflowRun.objects.filter(status__in=active).values_list("pk", flat=True)}
+
+
+def _manifest_kinds(run_dir):
+    """
+    Returns {path relative to run_dir: FINAL or INTERMEDIATE} from a run's manifest,
+    or None if the run has no manifest or it predates the "final" flag.
+    """
+    try:
+        with open(os.path.join(run_dir, MANIFEST)) as f:
+            nodes = json.load(f).get("nodes", {})
+    except (OSError, ValueError):
+        return None
+    kinds = {}
+    for entry in nodes.values():
+        if "final" not in entry:
+            return None
+        kind = FINAL if entry["final"] else INTERMEDIATE
+        for path in entry.get("files", []):
+            # A file both nodes list (a gather link) is kept if either keeps it
+            if kinds.get(path) != FINAL:
+                kinds[path] = kind
+    return kinds
+
+
+def scan(min_age_hours):
+    """
+    Walks media/my_files and returns (files that may be deleted, total bytes on disk).
+
+    Hard links are counted once in the total, and data also linked from outside
+    media/my_files (other than an upload's blob) not at all.
+    """
+    root = file_index.files_root()
+    active_runs = _active_run_ids()
+    min_mtime = time.time() - min_age_hours * 3600
+    candidates = []
+    # inode -> [size, links other than an upload's blob, links seen in my_files]
+    inodes = {}
+    # run directory -> its manifest kinds (None: keep everything in it)
+    runs = {}
+
+    for current, dirs, names in os.walk(root):
+        rel_dir = os.path.relpath(current, root)
+        depth = 0 if rel_dir == "." else rel_dir.count(os.sep) + 1
+        if depth == 1:
+            # my_files/<workflow>/run_<id>: skip runs that are still executing
+            kept = []
+            for name in dirs:
+                match = RUN_DIR.match(name)
+                if match and match.group(1) in active_runs:
+                    continue
+                if match:
+                    runs[os.path.join(current, name)] = _manifest_kinds(os.path.join(current, name))
+                kept.append(name)
+            dirs[:] = kept
+
+        run_dir = None
+        if depth >= 2:
+            parts = rel_dir.split(os.sep)
+            run_dir = os.path.join(root, parts[0], parts[1])
+            if run_dir not in runs:
+                run_dir = None
+
+        for name in names:
+            path = os.path.join(current, name)
+            try:
+                stat = os.lstat(path)
+            except OSError:
+                continue
+            if not stat_module.S_ISREG(stat.st_mode):
+                continue
+            inode = (stat.st_dev, stat.st_ino)
+            if inode not in inodes:
+                inodes[inode] = [stat.st_size, stat.st_nlink - (1 if blobs.blob_of(stat) else 0), 0]
+            inodes[inode][2] += 1
+
+            if name.endswith(PART_SUFFIX) or name.endswith(bgzf.INDEX_SUFFIX):
+                # Uploads in progress, and block indexes that go with their .gz file
+                continue
+            if stat.st_mtime > min_mtime:
+                continue
+
+            kind = OTHER
+            if run_dir is not None:
+                kinds = runs[run_dir]
+                run_rel = os.path.relpath(path, run_dir)
+                if kinds is None or run_rel == MANIFEST:
+                    continue
+                kind = kinds.get(run_rel, FINAL)
+            rel = os.path.relpath(path, root).replace(os.sep, "/")
+            candidates.append(FileInfo(path, rel, kind, stat))
+
+    total = sum(size for size, links, seen in inodes.values() if links <= seen)
+    return candidates, total
+
+
+def plan(candidates, total, rules):
+    """
+    Picks the files to delete. Returns [(FileInfo, reason, bytes freed)], the total
+    afterwards and the pinned files, which are kept.
+    """
+    links_of = defaultdict(list)
+    for info in candidates:
+        links_of[info.inode].append(info)
+    # Links of each inode that will still exist; the data is freed when none are left
+    remaining = {inode: infos[0].links - (1 if infos[0].blob else 0) for inode, infos in links_of.items()}
+    # Held by a link that is not a candidate, e.g. in the node cache
+    pinned = [info for info in candidates if len(links_of[info.inode]) < remaining[info.inode]]
+    pinned_inodes = {info.inode for info in pinned}
+
+    def take(info):
+        remaining[info.inode] -= 1
+        return info.size if remaining[info.inode] == 0 else 0
+
+    selected = []
+    chosen = set()
+    now = time.time()
+    days = rules["intermediate_days"]
+    if days:
+        cutoff = now - days * 86400
+        for info in candidates:
+            if info.kind == INTERMEDIATE and info.mtime < cutoff and info.inode not in pinned_inodes:
+                freed = take(info)
+                total -= freed
+                selected.append((info, EXPIRED, freed))
+                chosen.add(info.path)
+
+    max_bytes = rules["max_bytes"]
+    if max_bytes and total > max_bytes:
+        def evictable(info):
+            return info.kind != FINAL or not rules["keep_final_outputs"]
+
+        lru = sorted((info for info in candidates if info.path not in chosen and evictable(info)), key=lambda info: info.last_access)
+        for info in lru:
+            if total <= max_bytes:
+                break
+            if info.inode in pinned_inodes or info.path in chosen:
+                continue
+            # All links of the data go together, or deleting them frees nothing
+            links = [other for other in links_of[info.inode] if other.path not in chosen]
+            if not all(evictable(other) for other in links):
+                continue
+            for other in links:
+                freed = take(other)
+                total -= freed
+                selected.append((other, EVICTED, freed))
+                chosen.add(other.path)
+
+    return selected, total, pinned
+
+
+def _delete(info):
+    blobs.remove_file(info.path)
+    deleted = [info.rel]
+    if os.path.isfile(info.path + bgzf.INDEX_SUFFIX):
+        blobs.remove_file(info.path + bgzf.INDEX_SUFFIX)
+        deleted.append(info.rel + bgzf.INDEX_SUFFIX)
+    return deleted
+
+
+def _remove_empty_dirs(paths):
+    """
+    Removes directories the deleted files leave empty, up to (not including) the top-level ones.
+    """
+    root = os.path.abspath(file_index.files_root())
+    removed = []
+    for directory in sorted({os.path.dirname(path) for path in paths}, key=len, reverse=True):
+        directory = os.path.abspath(directory)
+        while os.path.dirname(directory) != root and directory.startswith(root + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            removed.append(os.path.relpath(directory, root).replace(os.sep, "/"))
+            directory = os.path.dirname(directory)
+    return removed
+
+
+def sweep(dry_run=False, log=print, **overrides):
+    """
+    Applies the retention policy once and returns a report of what was (or, with dry_run, would be) deleted.
+    """
+    rules = policy(**overrides)
+    started = time.monotonic()
+    candidates, total = scan(rules["min_age_hours"])
+    selected, total_after, pinned = plan(candidates, total, rules)
+
+    report = {
+        "dry_run": dry_run,
+        "rules": rules,
+        "total_bytes": total,
+        "candidates": len(candidates),
+        EXPIRED: {"files": 0, "bytes": 0},
+        EVICTED: {"files": 0, "bytes": 0},
+        "reclaimed_bytes": 0,
+        "total_bytes_after": total_after,
+        "pinned": {
+            "files": len(pinned),
+            "bytes": sum({info.inode: info.size for info in pinned}.values()),
+        },
+        "files": [],
+        "errors": [],
+    }
+    for info, reason, freed in selected:
+        report[reason]["files"] += 1
+        report[reason]["bytes"] += freed
+        report["reclaimed_bytes"] += freed
+        report["files"].append({
+            "path": info.rel,
+            "reason": reason,
+            "kind": info.kind,
+            "size": info.size,
+            "freed": freed,
+            "last_access": info.last_access,
+        })
+
+    if not dry_run:
+        batch_size = max(1, int(rules["batch_size"]))
+        for start in range(0, len(selected), batch_size):
+            if start:
+                time.sleep(rules["batch_pause"])
+            batch = selected[start:start + batch_size]
+            deleted = []
+            for info, _, _ in batch:
+                try:
+                    deleted.extend(_delete(info))
+                except OSError as e:
+                    report["errors"].append({"path": info.rel, "error": str(e)})
+            file_index.remove_paths(deleted + _remove_empty_dirs(info.path for info, _, _ in batch))
+            log(f"Deleted {min(start + batch_size, len(selected))}/{len(selected)} files")
+
+    report["seconds"] = time.monotonic() - started
+    return report
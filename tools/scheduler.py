@@ -0,0 +1,178 @@
+"""
+Admission control for tool processes based on the CPU and memory they declare.
+
+Tools describe their needs in tools.json:
+
+    "resources": {"cpus": 4, "memory_mb": 8000, "threads_option": "threads"}
+
+A node is only started when the machine has that much capacity left.
+Reservations live in a small JSON file guarded by an flock, so the web
+process and every workflow worker process share one budget. Entries of
+processes that died without releasing are dropped on the next access.
+
+The file is only rewritten when reservations change. Each process keeps the
+free capacity it last read in memory: while the file is unchanged, a request
+that does not fit is refused without taking the lock.
+"""
+import fcntl
+import json
+import os
+import time
+import uuid
+
+from django.conf import settings
+
+from .utils import load_tools_config
+
+# Seconds a refusal may be answered from memory while the state file looks unchanged;
+# then the file is read again, which also drops reservations of processes that died
+STATE_RECHECK_SECONDS = 5.0
+
+
+def total_cpus():
+    return int(getattr(settings, "WORKFLOW_CPUS", None) or os.cpu_count() or 1)
+
+
+def total_memory_mb():
+    configured = getattr(settings, "WORKFLOW_MEMORY_MB", None)
+    if configured:
+        return int(configured)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def state_path():
+    return getattr(settings, "WORKFLOW_RESOURCE_STATE", None) or os.path.join(settings.BASE_DIR, ".workflow_resources.json")
+
+
+def tool_resources(label, tool_def):
+    """
+    Returns the resource declaration of a tool, preferring the current tools.json entry.
+    """
+    registered = load_tools_config().get(label, {})
+    return registered.get("resources") or (tool_def or {}).get("resources") or {}
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _fingerprint(stat):
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class ResourcePool:
+    def __init__(self, path=None):
+        self._path = path
+        # (state file fingerprint, free cpus, free memory, monotonic time) as last read
+        self._snapshot = None
+
+    @property
+    def path(self):
+        return self._path or state_path()
+
+    def _locked(self, update):
+        """
+        Runs update(reservations) under an exclusive lock. update returns (result, changed);
+        the file is rewritten only when changed is true.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    reservations = json.loads(f.read() or "{}")
+                except json.JSONDecodeError:
+                    reservations = {}
+
+                # Forget reservations of processes that are gone (saved with the next change)
+                reservations = {
+                    token: r for token, r in reservations.items()
+                    if _pid_alive(int(token.split(":", 1)[0]))
+                }
+                result, changed = update(reservations)
+
+                if changed:
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(reservations, f)
+                    f.flush()
+                self._snapshot = (
+                    _fingerprint(os.fstat(f.fileno())),
+                    total_cpus() - sum(r["cpus"] for r in reservations.values()),
+                    total_memory_mb() - sum(r["memory_mb"] for r in reservations.values()),
+                    time.monotonic(),
+                )
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _cannot_fit(self, cpus, memory_mb):
+        """
+        True if the capacity last read is too small for the request and the state file has not changed since.
+        """
+        snapshot = self._snapshot
+        if snapshot is None or time.monotonic() - snapshot[3] > STATE_RECHECK_SECONDS:
+            return False
+        try:
+            if _fingerprint(os.stat(self.path)) != snapshot[0]:
+                return False
+        except OSError:
+            return False
+        return cpus > snapshot[1] or bool(total_memory_mb()) and memory_mb > snapshot[2]
+
+    def try_acquire(self, cpus, memory_mb):
+        """
+        Reserves capacity and returns a token, or None if it is not available right now.
+
+        Requests larger than the machine are capped to it so they can still run alone.
+        """
+        cpus = max(1, min(int(cpus), total_cpus()))
+        memory_mb = max(0, int(memory_mb))
+        if total_memory_mb():
+            memory_mb = min(memory_mb, total_memory_mb())
+        if self._cannot_fit(cpus, memory_mb):
+            return None
+
+        def acquire(reservations):
+            used_cpus = sum(r["cpus"] for r in reservations.values())
+            used_memory = sum(r["memory_mb"] for r in reservations.values())
+            if used_cpus + cpus > total_cpus():
+                return None, False
+            if total_memory_mb() and used_memory + memory_mb > total_memory_mb():
+                return None, False
+            token = f"{os.getpid()}:{uuid.uuid4().hex}"
+            reservations[token] = {"cpus": cpus, "memory_mb": memory_mb}
+            return token, True
+
+        return self._locked(acquire)
+
+    def release(self, token):
+        if token:
+            self._locked(lambda reservations: (None, reservations.pop(token, None) is not None))
+
+    def usage(self):
+        """
+        Returns the currently reserved and total capacity.
+        """
+        def summarize(reservations):
+            return {
+                "cpus_used": sum(r["cpus"] for r in reservations.values()),
+                "cpus_total": total_cpus(),
+                "memory_mb_used": sum(r["memory_mb"] for r in reservations.values()),
+                "memory_mb_total": total_memory_mb(),
+                "reservations": len(reservations),
+            }, False
+        return self._locked(summarize)
+
+
+resource_pool = ResourcePool()
@@ -0,0 +1,95 @@
+"""
+Server-sent events helpers for streaming tool output to the browser, and
+streaming responses that work under both WSGI and ASGI.
+"""
+import json
+import queue
+import threading
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+_END = object()
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_events(target):
+    """
+    Runs target(emit) in a background thread and yields the events it emits as SSE.
+
+    Emitting a "log" line never blocks the tool: when the browser falls behind
+    the bounded queue drops lines (the full log stays on disk) and reports how
+    many were skipped. target's return value is sent as the final "done" event.
+    """
+    events = queue.Queue(maxsize=1000)
+    dropped = [0]
+    dropped_lock = threading.Lock()
+
+    def emit(event, data):
+        if event != "log":
+            events.put((event, data))
+            return
+        try:
+            events.put_nowait((event, data))
+        except queue.Full:
+            with dropped_lock:
+                dropped[0] += 1
+
+    def worker():
+        try:
+            result = target(emit)
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+        # The final event must not be dropped
+        events.put(("done", result))
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    while True:
+        event, data = events.get()
+        with dropped_lock:
+            skipped, dropped[0] = dropped[0], 0
+        if skipped:
+            yield sse_event("dropped", {"lines": skipped})
+        yield sse_event(event, data)
+        if event == "done":
+            return
+
+
+async def iterate_in_thread(iterator):
+    """
+    Yields the items of a synchronous iterator, each one produced in a worker thread.
+    """
+    iterator = iter(iterator)
+    next_item = sync_to_async(next, thread_sensitive=False)
+    while True:
+        item = await next_item(iterator, _END)
+        if item is _END:
+            return
+        yield item
+
+
+def for_server(request, response):
+    """
+    Returns a streaming response ready for the server handling request.
+
+    Under ASGI, Django 4.2 reads a synchronous iterator completely into a list
+    before sending anything, so a ZIP download or an event stream would be
+    held in memory until it ends. There the content is pulled chunk by chunk
+    through a worker thread instead; under WSGI it is left as it is.
+    """
+    if isinstance(request, ASGIRequest) and not response.is_async:
+        response.streaming_content = iterate_in_thread(response.streaming_content)
+    return response
+
+
+def event_stream_response(request, events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return for_server(request, response)
@@ -1,3 +1,1412 @@
-from django.test import TestCase
+"""
+Tests of the workflow executor, runs, uploads and retention against stub tools,
+and of the modules around them (scheduler, metrics, previews, BGZF, ...).
 
-# Create your tests here.
+Every test gets its own temporary MEDIA_ROOT and scheduler state, so nothing
+touches media/ or another test. Tool nodes use the benchmark stub (see
+benchmarks.py), which copies its input to its output, or small sh scripts.
+"""
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import signal
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from unittest import mock
+
+from . import accounting, bgzf, blobs, file_index, introspection, metrics, preview, retention, zipstream
+from .benchmarks import build_workflow, stub_tool_def, write_stub
+from .executor import CONTINUE, FAIL_FAST, PLAN_VERSION, WorkflowError, WorkflowExecutor, compile_workflow
+from .jobs import cancel_run, create_run, execute_run, resume_run, saved_workflow
+from .models import ProcessUsage, Upload, Workflow, WorkflowRun
+from .process import CANCELLED, TIMEOUT, ProcessLimiter, ProcessResult, run_process, run_process_async, tool_timeout
+from .scheduler import ResourcePool, resource_pool
+from .streaming import iterate_in_thread, stream_events
+from .uploads import UploadError, append_chunk, create_upload, finish_upload
+from .utils import ToolRegistry, ToolsConfigError
+
+SEED = "seed.txt"
+
+# Runs "sh -c <script> <input> -o <output>": the input is $0 and the output $2
+SH_TOOL = {
+    "command": "sh",
+    "options": [
+        {"label": "script", "flag": "-c", "type": "text", "mandatory": True},
+        {"label": "input", "flag": None, "type": "file", "mandatory": True},
+        {"label": "output", "flag": "-o", "type": "text", "mandatory": True},
+    ],
+}
+
+# Same, with the output of the producer streamed into the consumer through a named pipe
+STREAM_PRODUCER = {
+    "command": "sh",
+    "options": [
+        {"label": "script", "flag": "-c", "type": "text", "mandatory": True},
+        {"label": "input", "flag": None, "type": "file", "mandatory": True},
+        {"label": "output", "flag": "-o", "type": "text", "mandatory": True, "stream": True},
+    ],
+}
+STREAM_CONSUMER = {
+    "command": "sh",
+    "options": [
+        {"label": "script", "flag": "-c", "type": "text", "mandatory": True},
+        {"label": "input", "flag": None, "type": "file", "mandatory": True, "stream": True},
+        {"label": "output", "flag": "-o", "type": "text", "mandatory": True},
+    ],
+}
+
+
+def sh_node(node_id, script, output, tool_def=SH_TOOL):
+    # "filename" lets downstream nodes pick up this node's output
+    return {
+        "id": node_id,
+        "data": {
+            "label": node_id,
+            "parameters": {"script": script, "output": output, "filename": output},
+            "toolDef": tool_def,
+        },
+    }
+
+
+def file_node(node_id, filename):
+    return {"id": node_id, "data": {"label": "file", "parameters": {"filename": filename}}}
+
+
+def edge(source, target, param="input"):
+    return {"source": source, "target": target, "data": {"param": param} if param else {}}
+
+
+class MediaTestMixin:
+    """
+    Points MEDIA_ROOT and every file the tools app shares between processes at a temporary directory.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.workdir = tempfile.mkdtemp(prefix="dynamic_tools_test_")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        media = os.path.join(self.workdir, "media")
+        settings_override = override_settings(
+            MEDIA_ROOT=media,
+            WORKFLOW_CACHE_DIR=os.path.join(media, "cache"),
+            UPLOAD_BLOB_DIR=os.path.join(media, "blobs"),
+            PREVIEW_INDEX_DIR=os.path.join(media, "preview_index"),
+            WORKFLOW_RESOURCE_STATE=os.path.join(self.workdir, "resources.json"),
+            TOOL_INFO_CACHE=os.path.join(self.workdir, "tool_info.json"),
+            METRICS_DIR=os.path.join(self.workdir, "metrics"),
+            WORKFLOW_CPUS=8,
+            UPLOAD_COMPRESSION="",
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        os.makedirs(file_index.files_root())
+        self.write_file(SEED, "ACGT\n")
+        self.stub = stub_tool_def(write_stub(self.workdir))
+
+    def write_file(self, name, content):
+        path = os.path.join(file_index.files_root(), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def run_path(self, result, *parts):
+        return os.path.join(settings.MEDIA_ROOT, result["run_dir"], *parts)
+
+    def read_output(self, result, *parts):
+        with open(self.run_path(result, *parts)) as f:
+            return f.read()
+
+    def execute(self, nodes, edges, **options):
+        options.setdefault("use_cache", False)
+        return WorkflowExecutor("test", nodes, edges, **options).run()
+
+
+class ExecutorTests(MediaTestMixin, TestCase):
+    def test_deep_workflow_passes_outputs_down(self):
+        nodes, edges = build_workflow("deep", 4, self.stub, SEED)
+        result = self.execute(nodes, edges, max_workers=1)
+
+        self.assertTrue(result["success"], result.get("error"))
+        self.assertEqual(set(result["nodes"].values()), {"success"})
+        self.assertEqual(self.read_output(result, "bench_stub_n3", "out.txt"), "ACGT\n")
+
+    def test_independent_nodes_run_concurrently(self):
+        nodes = [file_node("seed", SEED)]
+        edges = []
+        for i in range(4):
+            nodes.append(sh_node(f"sleep{i}", 'sleep 1; cat "$0" > "$2"', f"out{i}.txt"))
+            edges.append(edge("seed", f"sleep{i}"))
+
+        start = time.monotonic()
+        result = self.execute(nodes, edges, max_workers=4)
+        elapsed = time.monotonic() - start
+
+        self.assertTrue(result["success"], result.get("error"))
+        self.assertLess(elapsed, 3)
+
+    def _failing_workflow(self):
+        # seed -> bad -> after, and seed -> slow, which is still running when bad fails
+        nodes = [
+            file_node("seed", SEED),
+            sh_node("bad", "exit 3", "bad.txt"),
+            sh_node("after", 'cat "$0" > "$2"', "after.txt"),
+            sh_node("slow", 'sleep 0.5; cat "$0" > "$2"', "slow.txt"),
+            sh_node("later", 'cat "$0" > "$2"', "later.txt"),
+        ]
+        edges = [edge("seed", "bad"), edge("bad", "after"), edge("seed", "slow"), edge("slow", "later")]
+        return nodes, edges
+
+    def test_fail_fast_stops_launching_nodes(self):
+        nodes, edges = self._failing_workflow()
+        result = self.execute(nodes, edges, max_workers=2, failure_policy=FAIL_FAST)
+
+        self.assertFalse(result["success"])
+        self.assertIn("Command failed", result["error"])
+        self.assertEqual(result["nodes"]["bad"], "failed")
+        self.assertEqual(result["nodes"]["after"], "skipped")
+        # Running nodes finish, nothing new starts
+        self.assertEqual(result["nodes"]["slow"], "success")
+        self.assertEqual(result["nodes"]["later"], "skipped")
+
+    def test_continue_runs_independent_branches(self):
+        nodes, edges = self._failing_workflow()
+        result = self.execute(nodes, edges, max_workers=2, failure_policy=CONTINUE)
+
+        self.assertFalse(result["success"])
+        self.assertEqual(result["nodes"]["bad"], "failed")
+        self.assertEqual(result["nodes"]["after"], "skipped")
+        self.assertEqual(result["nodes"]["later"], "success")
+
+    def test_targets_run_only_their_ancestors(self):
+        nodes, edges = build_workflow("deep", 4, self.stub, SEED)
+        nodes.append(sh_node("side", 'cat "$0" > "$2"', "side.txt"))
+        edges.append(edge("seed", "side"))
+
+        result = self.execute(nodes, edges, targets=["n2"])
+
+        self.assertTrue(result["success"], result.get("error"))
+        self.assertEqual(result["nodes"]["n1"], "success")
+        self.assertEqual(result["nodes"]["n2"], "success")
+        self.assertEqual(result["nodes"]["n3"], "skipped")
+        self.assertEqual(result["nodes"]["side"], "skipped")
+
+    def test_resume_reuses_unchanged_nodes(self):
+        nodes, edges = build_workflow("deep", 3, self.stub, SEED)
+        # The cache is off: results are reused through the recorded keys alone
+        first = self.execute(nodes, edges)
+        self.assertTrue(first["success"], first.get("error"))
+        self.assertTrue(all(record["key"] for record in first["node_records"].values()))
+
+        second = self.execute(nodes, edges, completed=first["node_records"])
+        self.assertEqual(second["cached"], ["n1", "n2"])
+
+        # A changed input invalidates every node that reads it, directly or not
+        self.write_file(SEED, "TTTT\n")
+        third = self.execute(nodes, edges, completed=first["node_records"])
+        self.assertEqual(third["cached"], [])
+        self.assertEqual(self.read_output(third, "bench_stub_n2", "out.txt"), "TTTT\n")
+
+    def test_node_cache_restores_outputs(self):
+        nodes, edges = build_workflow("deep", 3, self.stub, SEED)
+        first = self.execute(nodes, edges, use_cache=True)
+        self.assertEqual(first["cached"], [])
+
+        second = self.execute(nodes, edges, use_cache=True)
+        self.assertTrue(second["success"], second.get("error"))
+        self.assertEqual(second["cached"], ["n1", "n2"])
+        self.assertEqual(second["usage"], {})
+        self.assertEqual(self.read_output(second, "bench_stub_n2", "out.txt"), "ACGT\n")
+
+    def test_scatter_runs_once_per_file_and_gather_collects(self):
+        for sample in ("S1", "S2", "S3"):
+            self.write_file(f"reads/{sample}.txt", f"{sample}\n")
+        nodes = [
+            {"id": "scatter", "data": {"label": "scatter", "parameters": {"pattern": "reads/*.txt"}}},
+            sh_node("copy", 'cat "$0" > "$2"', "copy.txt"),
+            {"id": "gather", "data": {"label": "gather", "parameters": {}}},
+            sh_node("merge", 'cat "$0"/*/copy.txt > "$2"', "merged.txt"),
+        ]
+        edges = [edge("scatter", "copy"), edge("copy", "gather", None), edge("gather", "merge")]
+
+        result = self.execute(nodes, edges, max_workers=2)
+
+        self.assertTrue(result["success"], result.get("error"))
+        copies = [node_id for node_id in result["nodes"] if node_id.startswith("copy#")]
+        self.assertEqual(len(copies), 3)
+        self.assertEqual(self.read_output(result, "merge", "merged.txt"), "S1\nS2\nS3\n")
+
+    def test_scatter_without_files_is_rejected(self):
+        nodes = [
+            {"id": "scatter", "data": {"label": "scatter", "parameters": {"pattern": "missing/*"}}},
+            sh_node("copy", 'cat "$0" > "$2"', "copy.txt"),
+        ]
+        with self.assertRaisesMessage(Exception, "matched no files"):
+            self.execute(nodes, [edge("scatter", "copy")])
+
+    def _stream_workflow(self, consumer_script):
+        nodes = [
+            file_node("seed", SEED),
+            sh_node("produce", 'seq 1 50000 > "$2"', "numbers.txt", STREAM_PRODUCER),
+            sh_node("consume", consumer_script, "count.txt", STREAM_CONSUMER),
+        ]
+        return nodes, [edge("seed", "produce"), edge("produce", "consume")]
+
+    def test_streamed_edge_uses_a_pipe(self):
+        nodes, edges = self._stream_workflow('wc -l < "$0" | tr -d " " > "$2"')
+        result = self.execute(nodes, edges, max_workers=2)
+
+        self.assertTrue(result["success"], result.get("error"))
+        self.assertEqual(result["streamed"], [{"producer": "produce", "output": "output", "consumer": "consume"}])
+        self.assertEqual(self.read_output(result, "consume", "count.txt"), "50000\n")
+        # The data never reached the disk
+        self.assertFalse(os.path.exists(self.run_path(result, "produce", "numbers.txt")))
+
+    def test_streamed_edge_falls_back_to_a_file(self):
+        nodes, edges = self._stream_workflow('wc -l < "$0" | tr -d " " > "$2"')
+        result = self.execute(nodes, edges, max_workers=2, stream=False)
+
+        self.assertTrue(result["success"], result.get("error"))
+        self.assertEqual(result["streamed"], [])
+        self.assertEqual(self.read_output(result, "produce", "numbers.txt").count("\n"), 50000)
+
+    def test_failed_stream_consumer_does_not_hang_the_producer(self):
+        nodes, edges = self._stream_workflow("exit 1")
+        start = time.monotonic()
+        result = self.execute(nodes, edges, max_workers=2, failure_policy=CONTINUE)
+
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertFalse(result["success"])
+        self.assertEqual(result["nodes"]["consume"], "failed")
+
+
+class CompressedInputTests(MediaTestMixin, TestCase):
+    READS = "".join(f"@r{i}\nACGT\n+\nIIII\n" for i in range(2000))
+
+    def setUp(self):
+        super().setUp()
+        plain = self.write_file("reads.fastq", self.READS)
+        bgzf.compress_file(plain, plain + ".gz", workers=1)
+        os.remove(plain)
+
+    def workflow(self, tool_def):
+        nodes = [file_node("reads", "reads.fastq.gz"), sh_node("count", 'echo "$0" > "$2"; wc -l < "$0" >> "$2"', "count.txt", tool_def)]
+        return nodes, [edge("reads", "count")]
+
+    def test_tools_without_gzip_input_read_decompressed_data(self):
+        nodes, edges = self.workflow(SH_TOOL)
+        result = self.execute(nodes, edges)
+
+        self.assertTrue(result["success"], result.get("error"))
+        seen_path, lines = self.read_output(result, "count", "count.txt").split()
+        self.assertFalse(seen_path.endswith(".gz"))
+        self.assertEqual(int(lines), 8000)
+        # The pipes are gone with the run
+        self.assertFalse(os.path.exists(seen_path))
+
+    def test_gzip_input_tools_get_the_file_itself(self):
+        nodes, edges = self.workflow(dict(SH_TOOL, gzip_input=True))
+        result = self.execute(nodes, edges)
+
+        self.assertTrue(result["success"], result.get("error"))
+        seen_path = self.read_output(result, "count", "count.txt").split()[0]
+        self.assertTrue(seen_path.endswith("reads.fastq.gz"))
+
+    def test_decompressed_inputs_are_cached_by_their_file(self):
+        nodes, edges = self.workflow(SH_TOOL)
+        self.execute(nodes, edges, use_cache=True)
+        second = self.execute(nodes, edges, use_cache=True)
+        self.assertEqual(second["cached"], ["count"])
+
+
+class RunTests(MediaTestMixin, TransactionTestCase):
+    def test_resume_run_reuses_finished_nodes(self):
+        nodes, edges = build_workflow("deep", 3, self.stub, SEED)
+        nodes[2]["data"]["toolDef"] = SH_TOOL
+        nodes[2]["data"]["parameters"]["script"] = "exit 1"
+
+        run = create_run("test", nodes, edges, {"use_cache": False}, status=WorkflowRun.STATUS_RUNNING)
+        result = execute_run(run)
+        self.assertFalse(result["success"])
+        self.assertEqual(WorkflowRun.objects.get(pk=run.pk).status, WorkflowRun.STATUS_FAILED)
+
+        # Fix the failing node in the stored graph; the node before it is reused
+        payload = run.payload
+        payload["nodes"][2]["data"]["parameters"]["script"] = 'cat "$0" > "$2"'
+        WorkflowRun.objects.filter(pk=run.pk).update(payload=payload)
+        retry = resume_run(WorkflowRun.objects.get(pk=run.pk))
+        self.assertEqual(retry.status, WorkflowRun.STATUS_QUEUED)
+
+        result = execute_run(retry)
+        self.assertTrue(result["success"], result.get("error"))
+        self.assertEqual(result["cached"], ["n1"])
+
+
+    def test_node_progress_is_written_in_batches(self):
+        nodes, edges = build_workflow("wide", 41, self.stub, SEED)
+        run = create_run("test", nodes, edges, {"use_cache": False}, status=WorkflowRun.STATUS_RUNNING)
+
+        with mock.patch.object(WorkflowRun, "save", autospec=True, side_effect=WorkflowRun.save) as save:
+            result = execute_run(run)
+
+        self.assertTrue(result["success"], result.get("error"))
+        # 80 node state changes, a few writes
+        self.assertLess(save.call_count, 10)
+        stored = WorkflowRun.objects.get(pk=run.pk)
+        self.assertEqual(set(stored.node_states.values()), {"success"})
+        self.assertEqual(len(stored.node_records), 40)
+
+
+class UploadTests(MediaTestMixin, TestCase):
+    def upload(self, data, filename="reads.fastq", tool="qc", chunk=1000):
+        upload = create_upload(filename, tool, size=len(data), checksum=hashlib.sha256(data).hexdigest())
+        for offset in range(0, len(data), chunk):
+            part = data[offset:offset + chunk]
+            upload = append_chunk(upload, offset, io.BytesIO(part), len(part))
+        return upload
+
+    def test_chunked_upload_completes(self):
+        data = os.urandom(3500)
+        upload = self.upload(data)
+
+        self.assertEqual(upload.status, Upload.STATUS_COMPLETE)
+        self.assertEqual(upload.sha256, hashlib.sha256(data).hexdigest())
+        with open(os.path.join(settings.MEDIA_ROOT, upload.path), "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_chunk_at_wrong_offset_is_refused(self):
+        upload = create_upload("reads.fastq", "qc", size=10)
+        append_chunk(upload, 0, io.BytesIO(b"12345"), 5)
+        with self.assertRaises(UploadError) as raised:
+            append_chunk(upload, 2, io.BytesIO(b"345"), 3)
+        self.assertEqual(raised.exception.status, 409)
+
+    def test_checksum_mismatch_starts_over(self):
+        upload = create_upload("reads.fastq", "qc", size=4, checksum="0" * 64)
+        with self.assertRaises(UploadError) as raised:
+            append_chunk(upload, 0, io.BytesIO(b"ACGT"), 4)
+        self.assertEqual(raised.exception.status, 422)
+        upload.refresh_from_db()
+        self.assertEqual(upload.offset, 0)
+        self.assertEqual(upload.status, Upload.STATUS_UPLOADING)
+
+    def test_upload_without_size_is_finished_explicitly(self):
+        upload = create_upload("notes.txt", "qc")
+        upload = append_chunk(upload, 0, io.BytesIO(b"hello"), 5)
+        self.assertNotEqual(upload.status, Upload.STATUS_COMPLETE)
+        upload = finish_upload(upload)
+        self.assertEqual(upload.status, Upload.STATUS_COMPLETE)
+        self.assertEqual(upload.size, 5)
+
+    def test_identical_uploads_share_one_blob(self):
+        data = os.urandom(2000)
+        first = os.path.join(settings.MEDIA_ROOT, self.upload(data, tool="a").path)
+        second = os.path.join(settings.MEDIA_ROOT, self.upload(data, tool="b").path)
+        blob = blobs.blob_path(hashlib.sha256(data).hexdigest())
+
+        self.assertTrue(os.path.samefile(first, blob))
+        self.assertTrue(os.path.samefile(second, blob))
+        # The blob and two links
+        self.assertEqual(os.stat(blob).st_nlink, 3)
+        self.assertFalse(os.stat(blob).st_mode & stat.S_IWUSR)
+
+        blobs.remove_file(first)
+        self.assertTrue(os.path.exists(blob))
+        blobs.remove_tree(os.path.dirname(second))
+        self.assertFalse(os.path.exists(blob))
+
+
+class RetentionPlanTests(MediaTestMixin, TestCase):
+    DAY = 86400
+
+    def setUp(self):
+        super().setUp()
+        os.remove(os.path.join(file_index.files_root(), SEED))
+
+    def write_old(self, name, size, days):
+        path = self.write_file(name, "x" * size)
+        when = time.time() - days * self.DAY
+        os.utime(path, (when, when))
+        return path
+
+    def write_run(self, files):
+        """
+        Writes my_files/wf/run_1 with {name: (size, days old, final)} and its manifest.
+        """
+        run_dir = os.path.join(file_index.files_root(), "wf", "run_1")
+        nodes = {}
+        for name, (size, days, final) in files.items():
+            self.write_old(os.path.join("wf", "run_1", name), size, days)
+            nodes[name] = {"files": [name], "final": final}
+        with open(os.path.join(run_dir, retention.MANIFEST), "w") as f:
+            json.dump({"nodes": nodes}, f)
+
+    def plan(self, **rules):
+        candidates, total = retention.scan(min_age_hours=0)
+        selected, total, pinned = retention.plan(candidates, total, retention.policy(**rules))
+        return {info.rel: reason for info, reason, _ in selected}, total, [info.rel for info in pinned]
+
+    def test_old_intermediates_expire(self):
+        self.write_run({"mid.txt": (100, 10, False), "new.txt": (100, 1, False), "final.txt": (100, 10, True)})
+
+        selected, total, pinned = self.plan(intermediate_days=5, max_bytes=None)
+
+        self.assertEqual(selected, {"wf/run_1/mid.txt": retention.EXPIRED})
+        self.assertEqual(pinned, [])
+
+    def test_eviction_is_least_recently_used_and_keeps_final_outputs(self):
+        self.write_run({"final.txt": (1000, 30, True)})
+        self.write_old("old.txt", 1000, 20)
+        self.write_old("older.txt", 1000, 25)
+        self.write_old("recent.txt", 1000, 2)
+
+        selected, total, _ = self.plan(intermediate_days=None, max_bytes=2500)
+
+        self.assertEqual(selected, {"older.txt": retention.EVICTED, "old.txt": retention.EVICTED})
+        self.assertLessEqual(total, 2500)
+
+    def test_files_held_by_the_node_cache_are_pinned(self):
+        self.write_run({"mid.txt": (100, 10, False)})
+        cached = os.path.join(settings.WORKFLOW_CACHE_DIR, "mid.txt")
+        os.makedirs(os.path.dirname(cached))
+        os.link(os.path.join(file_index.files_root(), "wf", "run_1", "mid.txt"), cached)
+
+        selected, total, pinned = self.plan(intermediate_days=5, max_bytes=1)
+
+        self.assertEqual(selected, {})
+        self.assertEqual(pinned, ["wf/run_1/mid.txt"])
+        # Data held outside my_files does not count, only the manifest is left
+        self.assertLess(total, 100)
+
+    def test_hard_linked_files_are_counted_once(self):
+        path = self.write_old("a.txt", 1000, 10)
+        os.link(path, os.path.join(file_index.files_root(), "b.txt"))
+
+        selected, total, _ = self.plan(intermediate_days=None, max_bytes=500)
+
+        # Both links go together, only then is the data freed
+        self.assertEqual(selected, {"a.txt": retention.EVICTED, "b.txt": retention.EVICTED})
+        self.assertEqual(total, 0)
+
+
+class AsgiStreamingTests(MediaTestMixin, TestCase):
+    async def test_zip_download_is_streamed_under_asgi(self):
+        self.write_file("reads/a.txt", "A" * 5000)
+        self.write_file("reads/sub/b.txt", "B" * 5000)
+
+        response = await self.async_client.get("/tools/download-folder/reads/")
+        self.assertTrue(response.is_async)
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(sorted(archive.namelist()), ["a.txt", "sub/b.txt"])
+            self.assertEqual(archive.read("sub/b.txt"), b"B" * 5000)
+
+    def test_zip_download_stays_synchronous_under_wsgi(self):
+        self.write_file("reads/a.txt", "A")
+        response = self.client.get("/tools/download-folder/reads/")
+        self.assertFalse(response.is_async)
+        self.assertEqual(zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))).namelist(), ["a.txt"])
+
+    async def test_events_arrive_while_the_target_runs(self):
+        release = threading.Event()
+
+        def target(emit):
+            emit("node", {"node": "a", "status": "running"})
+            # Only finishes once the first event reached the client
+            release.wait(5)
+            return {"success": release.is_set()}
+
+        events = []
+        async for event in iterate_in_thread(stream_events(target)):
+            events.append(event)
+            release.set()
+        self.assertTrue(events[0].startswith("event: node"))
+        self.assertEqual(events[-1], 'event: done\ndata: {"success": true}\n\n')
+
+
+class IntrospectionTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.bin_dir = os.path.join(self.workdir, "bin")
+        os.makedirs(self.bin_dir)
+        path = mock.patch.dict(os.environ, {"PATH": f"{self.bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"})
+        path.start()
+        self.addCleanup(path.stop)
+
+    def write_tool(self, name, version):
+        path = os.path.join(self.bin_dir, name)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\nif [ "$1" = "--version" ]; then echo "{name} {version}"; else echo "usage: {name}"; fi\n')
+        os.chmod(path, 0o755)
+        # Same size for every version: the mtime has to tell them apart
+        stat_result = os.stat(path)
+        os.utime(path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 1_000_000_000))
+        return path
+
+    def write_package(self, name, version):
+        site = os.path.join(self.workdir, "site")
+        os.makedirs(os.path.join(site, name), exist_ok=True)
+        with open(os.path.join(site, name, "__init__.py"), "w") as f:
+            f.write(f"VERSION = {version!r}\n")
+        for entry in os.listdir(site):
+            if entry.endswith(".dist-info"):
+                shutil.rmtree(os.path.join(site, entry))
+        dist_info = os.path.join(site, f"{name}-{version}.dist-info")
+        os.makedirs(dist_info)
+        with open(os.path.join(dist_info, "METADATA"), "w") as f:
+            f.write(f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n")
+        if site not in sys.path:
+            sys.path.insert(0, site)
+            self.addCleanup(sys.path.remove, site)
+
+    def test_tool_info_is_cached_until_the_binary_changes(self):
+        self.write_tool("fake_tool", "1.0")
+        info = introspection.probe_sync("fake_tool")
+        self.assertEqual(info["version"], "fake_tool 1.0")
+        self.assertEqual(info["help"], "usage: fake_tool")
+
+        self.write_tool("fake_tool", "2.0")
+        with mock.patch.object(introspection, "refresh_in_background") as refresh:
+            stale = async_to_sync(introspection.tool_info)("fake_tool")
+        self.assertEqual(stale["version"], "fake_tool 1.0")
+        self.assertTrue(stale["stale"])
+        refresh.assert_called_once_with(["fake_tool"])
+
+    def test_install_reports_the_new_version(self):
+        self.write_tool("fake_tool", "1.0")
+        introspection.probe_sync("fake_tool")
+        self.write_tool("fake_tool", "2.0")
+
+        with mock.patch("tools.views.INSTALL_DIR", self.workdir):
+            response = self.client.post(
+                "/tools/install-tool/", json.dumps({"name": "fake_tool", "install_command": "true"}),
+                content_type="application/json",
+            )
+        self.assertEqual(response.json()["version"], "fake_tool 2.0")
+        self.assertEqual(introspection.tool_info_cache.get("fake_tool")["version"], "fake_tool 2.0")
+
+    def test_module_tools_are_keyed_by_their_package(self):
+        self.write_package("fake_module_tool", "1.0")
+        before = introspection.command_fingerprint("python3 -m fake_module_tool")
+        self.assertIn("|fake_module_tool:1.0:", before)
+
+        self.write_package("fake_module_tool", "2.0")
+        after = introspection.command_fingerprint("python3 -m fake_module_tool")
+        self.assertIn("|fake_module_tool:2.0:", after)
+        # Same interpreter, different package
+        self.assertEqual(before.split("|")[0], after.split("|")[0])
+
+    def test_preflight_reports_missing_tools(self):
+        self.write_tool("fake_tool", "1.0")
+        with mock.patch.object(introspection, "refresh_in_background") as refresh:
+            missing = async_to_sync(introspection.preflight)({"fake_tool": ["a"], "no_such_tool_xyz": ["b", "c"]})
+        self.assertEqual(missing, {"no_such_tool_xyz": ["b", "c"]})
+        # Never probed: its info is fetched in the background
+        refresh.assert_called_once_with(["fake_tool"])
+
+
+class FileIndexTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            self.write_file(f"data/file_{i}.txt", "x" * (i + 1))
+        self.write_file("data/sub/inner.txt", "abc")
+
+    def list_files(self, **params):
+        return self.client.get("/tools/api/files/", {"path": "data", **params})
+
+    def test_directories_come_first_and_pages_split_the_rest(self):
+        first = self.list_files(page_size=4).json()
+        self.assertEqual(first["count"], 6)
+        self.assertEqual(first["pages"], 2)
+        self.assertEqual([e["name"] for e in first["entries"]], ["sub", "file_0.txt", "file_1.txt", "file_2.txt"])
+        self.assertTrue(first["entries"][0]["is_dir"])
+        # Directory sizes are the sum of their contents
+        self.assertEqual(first["entries"][0]["size"], 3)
+
+        second = self.list_files(page_size=4, page=2).json()
+        self.assertEqual([e["name"] for e in second["entries"]], ["file_3.txt", "file_4.txt"])
+
+    def test_out_of_range_values_are_clamped(self):
+        response = self.list_files(page_size=0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["entries"]), 1)
+        self.assertEqual(self.list_files(page_size=-5).json()["pages"], 6)
+        # Past the last page: the last page
+        self.assertEqual(self.list_files(page_size=4, page=99).json()["page"], 2)
+
+    def test_non_numeric_values_are_rejected(self):
+        self.assertEqual(self.list_files(page_size="many").status_code, 400)
+        self.assertEqual(self.list_files(page="x").status_code, 400)
+
+    def test_sync_directory_picks_up_changes(self):
+        file_index.ensure_index()
+        os.remove(os.path.join(file_index.files_root(), "data", "file_0.txt"))
+        self.write_file("data/new.txt", "new")
+        file_index.sync_directory(os.path.join(file_index.files_root(), "data"))
+
+        names = [e["name"] for e in file_index.list_directory("data", page_size=100)["entries"]]
+        self.assertIn("new.txt", names)
+        self.assertNotIn("file_0.txt", names)
+
+
+class ZipStreamTests(MediaTestMixin, TestCase):
+    def test_archive_is_built_chunk_by_chunk(self):
+        data = os.urandom(300_000)
+        path = os.path.join(file_index.files_root(), "random.bin")
+        with open(path, "wb") as f:
+            f.write(data)
+
+        chunks = list(zipstream.stream_zip([(path, "random.bin")], chunk_size=64 * 1024))
+        # Random data does not compress: every read of the file is sent on
+        self.assertGreater(len(chunks), 4)
+        self.assertLess(max(len(chunk) for chunk in chunks), 100_000)
+        with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+            self.assertEqual(archive.read("random.bin"), data)
+            self.assertIsNone(archive.testzip())
+
+    def test_compressed_formats_are_stored(self):
+        gz = self.write_file("reads/a.fastq.gz", "already compressed")
+        text = self.write_file("reads/b.txt", "A" * 10_000)
+
+        with zipfile.ZipFile(io.BytesIO(b"".join(zipstream.stream_zip([(gz, "a.fastq.gz"), (text, "b.txt")])))) as archive:
+            self.assertEqual(archive.getinfo("a.fastq.gz").compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(archive.getinfo("b.txt").compress_type, zipfile.ZIP_DEFLATED)
+            self.assertLess(archive.getinfo("b.txt").compress_size, 1000)
+
+    def test_files_deleted_meanwhile_are_left_out(self):
+        kept = self.write_file("kept.txt", "kept")
+        entries = [(os.path.join(file_index.files_root(), "gone.txt"), "gone.txt"), (kept, "kept.txt")]
+        with zipfile.ZipFile(io.BytesIO(b"".join(zipstream.stream_zip(entries)))) as archive:
+            self.assertEqual(archive.namelist(), ["kept.txt"])
+
+    def test_download_selection_does_not_repeat_files(self):
+        self.write_file("reads/a.txt", "a")
+        self.write_file("reads/sub/b.txt", "b")
+
+        response = self.client.get("/tools/download-selection/", {"paths": ["reads", "reads/a.txt"]})
+        with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as archive:
+            self.assertEqual(sorted(archive.namelist()), ["reads/a.txt", "reads/sub/b.txt"])
+
+    def test_paths_outside_my_files_are_refused(self):
+        response = self.client.get("/tools/download-selection/", {"paths": ["../../etc"]})
+        self.assertEqual(response.status_code, 404)
+
+
+class ToolRegistryTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.registry = ToolRegistry(os.path.join(self.workdir, "tools.json"))
+        self.write_tools({"cat": {"command": "cat", "options": []}})
+
+    def write_tools(self, tools, content=None):
+        with open(self.registry.path, "w") as f:
+            f.write(json.dumps(tools) if content is None else content)
+
+    def test_changes_on_disk_are_picked_up(self):
+        first, first_etag = self.registry.get_json()
+        self.assertEqual(json.loads(first), {"cat": {"command": "cat", "options": []}})
+        # Unchanged file: the same parsed dict and ETag
+        self.assertIs(self.registry.get(), self.registry.get())
+        self.assertEqual(self.registry.get_json()[1], first_etag)
+
+        self.write_tools({"cat": {"command": "cat", "options": []}, "wc": {"command": "wc", "options": []}})
+        self.assertEqual(set(self.registry.get()), {"cat", "wc"})
+        self.assertNotEqual(self.registry.get_json()[1], first_etag)
+
+    def test_update_writes_the_change_and_returns_its_result(self):
+        def add_wc(tools):
+            tools["wc"] = {"command": "wc", "options": []}
+            return len(tools)
+
+        self.assertEqual(self.registry.update(add_wc), 2)
+        with open(self.registry.path) as f:
+            self.assertEqual(set(json.load(f)), {"cat", "wc"})
+        self.assertEqual(set(self.registry.get()), {"cat", "wc"})
+        # Written through a rename: no temporary file is left behind
+        self.assertEqual([name for name in os.listdir(self.workdir) if name.startswith(".tools.")], [])
+
+    def test_failed_change_leaves_the_file_alone(self):
+        def fail(tools):
+            tools.clear()
+            raise ValueError("invalid tool")
+
+        with self.assertRaises(ValueError):
+            self.registry.update(fail)
+        self.assertEqual(set(self.registry.get()), {"cat"})
+
+    def test_malformed_file_is_not_overwritten(self):
+        self.write_tools(None, content='{"cat": ')
+        # Reads as empty...
+        self.assertEqual(self.registry.get(), {})
+        # ...but an update refuses to replace it with its change alone
+        with self.assertRaises(ToolsConfigError):
+            self.registry.update(lambda tools: tools.setdefault("wc", {}))
+        with open(self.registry.path) as f:
+            self.assertEqual(f.read(), '{"cat": ')
+
+    def test_tools_endpoint_revalidates_with_etag(self):
+        with mock.patch("tools.views.tool_registry", self.registry):
+            response = self.client.get("/tools/api/tools/")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(set(response.json()), {"cat"})
+            etag = response["ETag"]
+
+            self.assertEqual(self.client.get("/tools/api/tools/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.write_tools({"wc": {"command": "wc", "options": []}})
+            response = self.client.get("/tools/api/tools/", HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(set(response.json()), {"wc"})
+
+
+class SchedulerTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = ResourcePool(os.path.join(self.workdir, "pool.json"))
+
+    def test_reservations_are_refused_until_released(self):
+        with override_settings(WORKFLOW_MEMORY_MB=1000):
+            first = self.pool.try_acquire(6, 200)
+            self.assertIsNotNone(first)
+            self.assertIsNone(self.pool.try_acquire(4, 0))
+            self.assertIsNone(self.pool.try_acquire(1, 900))
+            second = self.pool.try_acquire(2, 800)
+            self.assertIsNotNone(second)
+            self.assertEqual(self.pool.usage(), {
+                "cpus_used": 8, "cpus_total": 8, "memory_mb_used": 1000, "memory_mb_total": 1000, "reservations": 2,
+            })
+
+            self.pool.release(first)
+            self.assertIsNotNone(self.pool.try_acquire(4, 0))
+
+    def test_requests_larger_than_the_machine_run_alone(self):
+        token = self.pool.try_acquire(64, 0)
+        self.assertIsNotNone(token)
+        self.assertEqual(self.pool.usage()["cpus_used"], 8)
+        self.assertIsNone(self.pool.try_acquire(1, 0))
+
+    def test_reservations_of_dead_processes_are_dropped(self):
+        process = subprocess.Popen(["true"])
+        process.wait()
+        with open(self.pool.path, "w") as f:
+            json.dump({f"{process.pid}:dead": {"cpus": 8, "memory_mb": 0}}, f)
+
+        self.assertEqual(self.pool.usage()["reservations"], 0)
+        self.assertIsNotNone(self.pool.try_acquire(8, 0))
+
+    def test_pools_share_one_budget_through_the_state_file(self):
+        other = ResourcePool(self.pool.path)
+        token = self.pool.try_acquire(8, 0)
+        self.assertIsNone(other.try_acquire(1, 0))
+        self.pool.release(token)
+        self.assertIsNotNone(other.try_acquire(1, 0))
+
+    def test_tools_wider_than_the_free_cpus_wait_their_turn(self):
+        # Each node records when it ran; all of them ask for the whole machine
+        heavy = dict(SH_TOOL, resources={"cpus": 8})
+        script = 'date +%s.%N > "$2"; sleep 0.3; date +%s.%N >> "$2"'
+        nodes = [file_node("seed", SEED)]
+        edges = []
+        for i in range(3):
+            nodes.append(sh_node(f"heavy{i}", script, f"heavy{i}.txt", tool_def=heavy))
+            edges.append(edge("seed", f"heavy{i}"))
+
+        result = self.execute(nodes, edges, max_workers=3)
+
+        self.assertTrue(result["success"], result.get("error"))
+        spans = sorted(
+            tuple(float(t) for t in self.read_output(result, f"heavy{i}", f"heavy{i}.txt").split())
+            for i in range(3)
+        )
+        for (_, end), (start, _) in zip(spans, spans[1:]):
+            self.assertGreaterEqual(start, end)
+        self.assertEqual(resource_pool.usage()["reservations"], 0)
+
+    def test_thread_option_gets_the_granted_cpus(self):
+        threaded = {
+            "command": "sh",
+            "options": SH_TOOL["options"] + [{"label": "threads", "flag": "-t", "type": "text", "mandatory": False}],
+            "resources": {"cpus": 16, "threads_option": "threads"},
+        }
+        # "$4" is the value given to -t
+        nodes = [file_node("seed", SEED), sh_node("threaded", 'echo "$4" > "$2"', "threads.txt", tool_def=threaded)]
+        result = self.execute(nodes, [edge("seed", "threaded")])
+
+        self.assertTrue(result["success"], result.get("error"))
+        self.assertEqual(self.read_output(result, "threaded", "threads.txt"), "8\n")
+
+
+class AccountingTests(MediaTestMixin, TransactionTestCase):
+    def record(self, tool, command, **usage):
+        result = ProcessResult(0, [], None, usage=dict({"wall_seconds": 1.0}, **usage), command=command)
+        return accounting.record_usage(tool, result)
+
+    def test_usage_of_a_real_process_is_recorded(self):
+        result = run_process(["sh", "-c", "head -c 2000000 /dev/zero > /dev/null"])
+        usage = accounting.record_usage("head", result)
+
+        self.assertEqual(usage.command, "sh -c head -c 2000000 /dev/zero > /dev/null")
+        self.assertEqual(usage.returncode, 0)
+        self.assertGreater(usage.wall_seconds, 0)
+        self.assertGreater(usage.max_rss_kb, 0)
+
+    def test_results_without_usage_are_not_recorded(self):
+        self.assertIsNone(accounting.record_usage("sh", ProcessResult(0, [], None)))
+        self.assertEqual(ProcessUsage.objects.count(), 0)
+
+    def test_summary_aggregates_per_tool(self):
+        self.record("bwa", "bwa mem", wall_seconds=10.0, user_seconds=8.0, system_seconds=1.0, max_rss_kb=1000)
+        self.record("bwa", "bwa mem", wall_seconds=20.0, user_seconds=16.0, system_seconds=2.0, max_rss_kb=3000)
+        failed = self.record("samtools", "samtools sort", wall_seconds=2.0)
+        ProcessUsage.objects.filter(pk=failed.pk).update(returncode=1)
+
+        bwa, samtools = accounting.tool_summary()
+        self.assertEqual((bwa["tool"], bwa["processes"], bwa["failures"]), ("bwa", 2, 0))
+        self.assertEqual(bwa["total_wall_seconds"], 30.0)
+        self.assertEqual(bwa["avg_cpu_seconds"], 13.5)
+        self.assertEqual(bwa["max_rss_kb"], 3000)
+        self.assertEqual((samtools["tool"], samtools["failures"]), ("samtools", 1))
+
+        self.assertEqual([row["tool"] for row in accounting.tool_summary(tool="samtools")], ["samtools"])
+        ProcessUsage.objects.filter(tool="samtools").update(created_at=timezone.now() - timedelta(days=10))
+        self.assertEqual([row["tool"] for row in accounting.tool_summary(days=7)], ["bwa"])
+
+    def test_workflow_nodes_are_recorded_with_their_run(self):
+        nodes, edges = build_workflow("deep", 3, self.stub, SEED)
+        run = create_run("test", nodes, edges, {"use_cache": False}, status=WorkflowRun.STATUS_RUNNING)
+        result = execute_run(run)
+
+        self.assertTrue(result["success"], result.get("error"))
+        self.assertEqual(sorted(run.usage.values_list("node_id", flat=True)), ["n1", "n2"])
+        self.assertEqual(set(result["usage"]), {"n1", "n2"})
+
+    def test_usage_endpoint(self):
+        self.record("bwa", "bwa mem")
+        response = self.client.get("/tools/api/tools/usage/", {"tool": "bwa"})
+        self.assertEqual([row["tool"] for row in response.json()["tools"]], ["bwa"])
+        self.assertEqual(self.client.get("/tools/api/tools/usage/", {"days": "week"}).status_code, 400)
+
+
+class MetricsTests(MediaTestMixin, TestCase):
+    def sample(self, metric, suffix="", **labels):
+        for sample_suffix, key, extra, value in metric.samples():
+            if sample_suffix == suffix and dict(zip(metric.labels, key), **dict(extra)) == labels:
+                return value
+        return None
+
+    def test_shared_gauge_sums_live_processes_and_drops_dead_ones(self):
+        gauge = metrics.SharedGauge("test_gauge", "Test.")
+        gauge.inc(2)
+        # Another live process, and one that has exited
+        dead = subprocess.Popen(["true"])
+        dead.wait()
+        for pid, value in ((os.getppid(), 3), (dead.pid, 5)):
+            with open(os.path.join(settings.METRICS_DIR, f"test_gauge.{pid}"), "w") as f:
+                json.dump([[[], value]], f)
+
+        self.assertEqual(self.sample(gauge), 5)
+        self.assertFalse(os.path.exists(os.path.join(settings.METRICS_DIR, f"test_gauge.{dead.pid}")))
+        gauge.dec(2)
+        self.assertEqual(self.sample(gauge), 3)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", labels=("view",), buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value, view="a")
+
+        self.assertEqual(self.sample(histogram, "_bucket", view="a", le=1), 2)
+        self.assertEqual(self.sample(histogram, "_bucket", view="a", le=5), 3)
+        self.assertEqual(self.sample(histogram, "_bucket", view="a", le="+Inf"), 4)
+        self.assertEqual(self.sample(histogram, "_sum", view="a"), 14.5)
+        self.assertIn('test_seconds_bucket{view="a",le="+Inf"} 4', histogram.render())
+
+    def test_tool_durations_come_from_recorded_processes(self):
+        for seconds, returncode in ((0.5, 0), (20.0, 0), (4000.0, 1)):
+            ProcessUsage.objects.create(tool="bwa", command="bwa mem", returncode=returncode, wall_seconds=seconds)
+
+        states = metrics._tool_durations()
+        counts, total, count = states[("bwa", "success")]
+        self.assertEqual((total, count), (20.5, 2))
+        # 0.5s in the first bucket (1s), 20s in the 30s bucket
+        self.assertEqual(counts[0], 1)
+        self.assertEqual(counts[metrics.TOOL_BUCKETS.index(30)], 1)
+        self.assertEqual(sum(counts), 2)
+        self.assertEqual(states[("bwa", "failure")][2], 1)
+
+    def test_metrics_endpoint(self):
+        WorkflowRun.objects.create(workflow_name="test", payload={}, status=WorkflowRun.STATUS_QUEUED)
+        ProcessUsage.objects.create(tool="bwa", command="bwa mem", returncode=0, wall_seconds=2.0)
+
+        response = self.client.get("/tools/metrics/")
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('dynamic_tools_workflow_runs{status="queued"} 1', text)
+        self.assertIn('dynamic_tools_tool_duration_seconds_count{tool="bwa",outcome="success"} 1', text)
+        self.assertIn("dynamic_tools_reserved_cpus 0", text)
+
+        with override_settings(METRICS_ALLOWED_IPS=["10.0.0.1"]):
+            self.assertEqual(self.client.get("/tools/metrics/").status_code, 403)
+
+    def test_middleware_times_views_and_counts_downloads(self):
+        self.write_file("reads/a.txt", "a" * 1000)
+        before = self.sample(metrics.DOWNLOAD_BYTES, view="download_selection") or 0
+        latency = self.sample(metrics.REQUEST_LATENCY, "_count", view="download_selection", method="GET", status="200") or 0
+
+        response = self.client.get("/tools/download-selection/", {"paths": ["reads"]})
+        size = len(b"".join(response.streaming_content))
+
+        self.assertEqual(self.sample(metrics.DOWNLOAD_BYTES, view="download_selection"), before + size)
+        self.assertEqual(
+            self.sample(metrics.REQUEST_LATENCY, "_count", view="download_selection", method="GET", status="200"),
+            latency + 1,
+        )
+
+
+class CompileTests(MediaTestMixin, TestCase):
+    def graph(self):
+        # seed -> first -> (its output as a file node) -> second; "first" and "second" share a label
+        nodes = [
+            file_node("seed", SEED),
+            sh_node("first", 'cat "$0" > "$2"', "first.txt"),
+            file_node("first_out", "first.txt"),
+            sh_node("second", 'cat "$0" > "$2"', "second.txt"),
+        ]
+        nodes[3]["data"]["label"] = "first"
+        edges = [edge("seed", "first"), edge("first", "first_out", None), edge("first_out", "second")]
+        return nodes, edges
+
+    def test_plan_binds_inputs_to_their_producers(self):
+        plan = compile_workflow(*self.graph())
+
+        self.assertEqual(plan["version"], PLAN_VERSION)
+        self.assertEqual(plan["order"], ["seed", "first", "first_out", "second"])
+        self.assertEqual(plan["nodes"]["first"]["inputs"], [{"param": "input", "filename": SEED, "producer": None}])
+        self.assertEqual(plan["nodes"]["second"]["inputs"], [{"param": "input", "filename": "first.txt", "producer": "first"}])
+        # A label used twice gets the node id in its directory
+        self.assertEqual(plan["nodes"]["first"]["dir"], "first_first")
+        self.assertEqual(
+            [(o["label"], o["output"], o["file"]) for o in plan["nodes"]["second"]["options"]],
+            [("script", False, False), ("input", False, True), ("output", True, False)],
+        )
+
+    def test_invalid_graphs_are_rejected(self):
+        nodes, edges = self.graph()
+        with self.assertRaisesMessage(WorkflowError, "cyclic"):
+            compile_workflow(nodes, edges + [edge("second", "first")])
+        with self.assertRaisesMessage(WorkflowError, "unknown node"):
+            compile_workflow(nodes, edges + [edge("second", "nowhere")])
+        with self.assertRaisesMessage(WorkflowError, "exactly one starting tool"):
+            compile_workflow(nodes + [file_node("other", SEED)], edges + [edge("other", "second")])
+
+        nodes[1]["data"]["parameters"]["script"] = ""
+        with self.assertRaisesMessage(WorkflowError, 'Mandatory input "script" is missing'):
+            compile_workflow(nodes, edges)
+
+    def save(self, name, graph):
+        return self.client.post("/tools/api/workflows/save/", json.dumps({"name": name, "graph": graph}), content_type="application/json")
+
+    def test_saved_workflows_keep_their_plan(self):
+        nodes, edges = self.graph()
+        response = self.save("valid", {"nodes": nodes, "edges": edges}).json()
+        self.assertEqual((response["created"], response["valid"], response["plan_error"]), (True, True, None))
+        workflow = Workflow.objects.get(name="valid")
+        self.assertEqual(workflow.plan, compile_workflow(nodes, edges))
+        self.assertEqual(workflow.node_count, 4)
+
+        # Runs of a saved workflow use the stored plan instead of compiling the graph again
+        with mock.patch("tools.jobs.compile_workflow") as compile_again:
+            name, saved_nodes, saved_edges, plan = saved_workflow(workflow.pk)
+            run = create_run(name, saved_nodes, saved_edges, plan=plan)
+        compile_again.assert_not_called()
+        self.assertEqual(run.payload["plan"], workflow.plan)
+
+    def test_stale_plans_are_compiled_again(self):
+        nodes, edges = self.graph()
+        stale = dict(compile_workflow(nodes, edges), version=PLAN_VERSION - 1)
+        run = create_run("test", nodes, edges, plan=stale)
+        self.assertEqual(run.payload["plan"]["version"], PLAN_VERSION)
+
+    def test_unfinished_workflows_are_saved_without_a_plan(self):
+        nodes, edges = self.graph()
+        response = self.save("unfinished", {"nodes": nodes, "edges": edges + [edge("second", "first")]}).json()
+        self.assertEqual((response["success"], response["valid"]), (True, False))
+        self.assertIn("cyclic", response["plan_error"])
+        self.assertIsNone(Workflow.objects.get(name="unfinished").plan)
+
+        response = self.save("unfinished", {"nodes": nodes, "edges": [{"source": "seed"}]}).json()
+        self.assertEqual((response["created"], response["plan_error"]), (False, "Malformed graph."))
+        self.assertFalse(self.client.get(f"/tools/api/workflows/{Workflow.objects.get(name='unfinished').pk}/").json()["valid"])
+
+
+class WorkflowSummaryTests(TestCase):
+    def setUp(self):
+        for i in range(5):
+            Workflow.objects.create(name=f"wf{i}", graph={"nodes": [{"id": str(n)} for n in range(i)], "edges": []}, node_count=i)
+
+    def summaries(self, **params):
+        return self.client.get("/tools/api/workflows/summaries/", params)
+
+    def test_pages_list_the_newest_workflows_without_graphs(self):
+        first = self.summaries(page_size=2).json()
+        self.assertEqual((first["count"], first["pages"], first["page"]), (5, 3, 1))
+        self.assertEqual([w["name"] for w in first["workflows"]], ["wf4", "wf3"])
+        self.assertEqual(first["workflows"][0]["node_count"], 4)
+        self.assertNotIn("graph", first["workflows"][0])
+
+        last = self.summaries(page_size=2, page=3).json()
+        self.assertEqual([w["name"] for w in last["workflows"]], ["wf0"])
+
+    def test_page_size_is_clamped(self):
+        self.assertEqual(self.summaries(page_size=0).json()["pages"], 5)
+        self.assertEqual(len(self.summaries(page_size=1000).json()["workflows"]), 5)
+        self.assertEqual(self.summaries(page_size="all").status_code, 400)
+
+    def test_listing_revalidates_until_a_workflow_changes(self):
+        etag = self.summaries().headers["ETag"]
+        self.assertEqual(self.client.get("/tools/api/workflows/summaries/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Another page is another response
+        self.assertNotEqual(self.summaries(page=2).headers["ETag"], etag)
+
+        workflow = Workflow.objects.get(name="wf0")
+        workflow.graph = {"nodes": [], "edges": []}
+        workflow.save()
+        self.assertEqual(self.client.get("/tools/api/workflows/summaries/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_detail_returns_the_graph(self):
+        workflow = Workflow.objects.get(name="wf2")
+        response = self.client.get(f"/tools/api/workflows/{workflow.pk}/")
+        self.assertEqual(response.json()["graph"], workflow.graph)
+        self.assertEqual(
+            self.client.get(f"/tools/api/workflows/{workflow.pk}/", HTTP_IF_NONE_MATCH=response.headers["ETag"]).status_code,
+            304,
+        )
+        self.assertEqual(self.client.get("/tools/api/workflows/999/").status_code, 404)
+
+
+def process_gone(pid):
+    # Exited children of a killed shell may linger as zombies until someone reaps them
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] == "Z"
+    except FileNotFoundError:
+        return True
+
+
+@override_settings(TOOL_KILL_GRACE_SECONDS=1)
+class AsyncProcessTests(MediaTestMixin, TestCase):
+    async def test_output_is_read_line_by_line(self):
+        lines = []
+        log_path = os.path.join(self.workdir, "logs", "tool.log")
+        result = await run_process_async(
+            ["sh", "-c", r'printf "one\r\ntwo\n"; echo three >&2; printf four; exit 3'],
+            log_path=log_path, on_line=lines.append,
+        )
+
+        self.assertEqual(result.returncode, 3)
+        self.assertIsNone(result.terminated)
+        self.assertEqual(lines, ["one\n", "two\n", "three\n", "four"])
+        self.assertEqual(result.output, "one\ntwo\nthree\nfour")
+        with open(log_path) as f:
+            self.assertEqual(f.read(), result.output)
+        self.assertGreater(result.usage["wall_seconds"], 0)
+
+    async def test_tools_that_run_too_long_are_terminated(self):
+        start = time.monotonic()
+        result = await run_process_async(["sleep", "30"], timeout=0.3)
+
+        self.assertEqual(result.terminated, TIMEOUT)
+        self.assertEqual(result.returncode, -signal.SIGTERM)
+        self.assertLess(time.monotonic() - start, 5)
+
+    async def test_cancelling_the_task_stops_the_process_group(self):
+        # The shell prints the pid of its own child before waiting on it
+        started = asyncio.Event()
+        pids = []
+
+        def on_line(line):
+            pids.append(int(line))
+            started.set()
+
+        task = asyncio.ensure_future(run_process_async(["sh", "-c", "sleep 30 & echo $!; wait"], on_line=on_line))
+        await asyncio.wait_for(started.wait(), 5)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertTrue(process_gone(pids[0]))
+
+    async def test_slots_are_shared_with_waiting_callers(self):
+        limiter = ProcessLimiter(limit=1)
+        async with limiter:
+            waiter = asyncio.ensure_future(limiter.__aenter__())
+            await asyncio.sleep(0.1)
+            self.assertFalse(waiter.done())
+        await asyncio.wait_for(waiter, 1)
+        # A synchronous caller waits for the async one
+        self.assertFalse(limiter.semaphore.acquire(blocking=False))
+        await limiter.__aexit__(None, None, None)
+        with limiter:
+            pass
+
+
+@override_settings(TOOL_KILL_GRACE_SECONDS=1)
+class TimeoutAndCancelTests(MediaTestMixin, TransactionTestCase):
+    def test_timeout_stops_the_whole_process_group(self):
+        pids = []
+        start = time.monotonic()
+        result = run_process(["sh", "-c", "sleep 30 & echo $!; wait"], on_line=lambda line: pids.append(int(line)), timeout=0.5)
+
+        self.assertEqual(result.terminated, TIMEOUT)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertTrue(process_gone(pids[0]))
+
+    def test_cancel_event_stops_the_process(self):
+        cancel = threading.Event()
+        threading.Timer(0.3, cancel.set).start()
+        result = run_process(["sleep", "30"], cancel=cancel)
+        self.assertEqual(result.terminated, CANCELLED)
+
+    def test_timeout_values(self):
+        with override_settings(TOOL_TIMEOUT_SECONDS=60):
+            self.assertEqual(tool_timeout(None, ""), 60)
+            self.assertEqual(tool_timeout("2.5", 10), 2.5)
+            # 0 lifts the default
+            self.assertIsNone(tool_timeout(0))
+        with self.assertRaises(ValueError):
+            tool_timeout("soon")
+
+    def test_node_timeout_fails_the_node(self):
+        nodes = [file_node("seed", SEED), sh_node("slow", "sleep 30", "slow.txt"), sh_node("quick", 'cat "$0" > "$2"', "quick.txt")]
+        nodes[1]["data"]["timeout"] = 0.5
+        result = self.execute(nodes, [edge("seed", "slow"), edge("seed", "quick")], failure_policy=CONTINUE)
+
+        self.assertFalse(result["success"])
+        self.assertEqual(result["nodes"]["slow"], "failed")
+        self.assertEqual(result["nodes"]["quick"], "success")
+        self.assertIn("timed out after 0.5 seconds", result["error"])
+
+        nodes[1]["data"]["timeout"] = "soon"
+        result = self.execute(nodes, [edge("seed", "slow")])
+        self.assertIn("Invalid timeout", result["error"])
+
+    def start_run(self, script):
+        nodes = [file_node("seed", SEED), sh_node("slow", script, "slow.txt")]
+        run = create_run("test", nodes, [edge("seed", "slow")], {"use_cache": False}, status=WorkflowRun.STATUS_RUNNING)
+        started = threading.Event()
+        results = []
+
+        def execute():
+            results.append(execute_run(run, on_node_update=lambda node_id, state: state == "running" and started.set()))
+
+        thread = threading.Thread(target=execute)
+        thread.start()
+        self.assertTrue(started.wait(10))
+        return run, thread, results
+
+    def test_cancel_run_stops_a_running_run(self):
+        run, thread, results = self.start_run("sleep 30")
+        self.assertTrue(cancel_run(run))
+        thread.join(10)
+
+        self.assertTrue(results[0]["cancelled"])
+        stored = WorkflowRun.objects.get(pk=run.pk)
+        self.assertEqual(stored.status, WorkflowRun.STATUS_CANCELLED)
+        self.assertEqual(stored.node_states["slow"], "cancelled")
+        # Already finished
+        self.assertFalse(cancel_run(stored))
+
+    def test_cancel_requested_by_another_process_is_picked_up(self):
+        run, thread, results = self.start_run("sleep 30")
+        WorkflowRun.objects.filter(pk=run.pk).update(cancel_requested=True)
+        thread.join(10)
+        self.assertTrue(results[0]["cancelled"])
+
+    def test_queued_runs_are_cancelled_at_once(self):
+        nodes, edges = build_workflow("deep", 2, self.stub, SEED)
+        run = create_run("test", nodes, edges)
+        self.assertTrue(cancel_run(run))
+        self.assertEqual(WorkflowRun.objects.get(pk=run.pk).status, WorkflowRun.STATUS_CANCELLED)
+
+
+def fastq_records(count):
+    # Varying lengths so records straddle index blocks at different points
+    return [(f"read{i}", "ACGT"[i % 4] * (1 + i % 37)) for i in range(count)]
+
+
+class PreviewTests(MediaTestMixin, TestCase):
+    def write_fastq(self, name, records):
+        return self.write_file(name, "".join(f"@{rid}\n{seq}\n+\n{'I' * len(seq)}\n" for rid, seq in records))
+
+    def write_fasta(self, name, records, width=10):
+        lines = []
+        for rid, seq in records:
+            lines.append(f">{rid}")
+            lines.extend(seq[i:i + width] for i in range(0, len(seq), width))
+        return self.write_file(name, "\n".join(lines) + "\n")
+
+    def test_any_record_is_found_through_the_index(self):
+        records = fastq_records(500)
+        fastq = self.write_fastq("reads.fastq", records)
+        fasta = self.write_fasta("contigs.fasta", records)
+        for block_size in (7, 100, 4096):
+            with mock.patch.object(preview, "BLOCK_SIZE", block_size):
+                shutil.rmtree(preview.index_dir(), ignore_errors=True)
+                for path, fmt in ((fastq, preview.FASTQ), (fasta, preview.FASTA)):
+                    with preview.SequenceFile(path) as sequences:
+                        self.assertEqual((sequences.format, sequences.records), (fmt, 500))
+                        for start in (0, 1, 137, 498):
+                            found = sequences.read_range(start, 2)
+                            self.assertEqual([(r["id"], r["sequence"]) for r in found], records[start:start + 2])
+                            self.assertEqual(found[0]["number"], start + 1)
+
+    def test_index_is_rebuilt_when_the_file_changes(self):
+        path = self.write_fastq("reads.fastq", fastq_records(10))
+        with preview.SequenceFile(path) as sequences:
+            self.assertEqual(sequences.records, 10)
+        self.write_fastq("reads.fastq", fastq_records(12))
+        with preview.SequenceFile(path) as sequences:
+            self.assertEqual(sequences.records, 12)
+            self.assertEqual(sequences.read_range(11, 5)[0]["id"], "read11")
+
+    def test_bgzf_files_are_previewed_and_gzip_files_refused(self):
+        records = fastq_records(3000)
+        plain = self.write_fastq("reads.fastq", records)
+        bgzf.compress_file(plain, plain + ".gz", workers=1)
+        with gzip.open(self.write_file("plain.fastq.gz", ""), "wt") as f:
+            f.write("@read0\nA\n+\nI\n")
+
+        with preview.SequenceFile(plain + ".gz") as sequences:
+            self.assertEqual(sequences.records, 3000)
+            self.assertEqual(sequences.read_range(2999, 1)[0]["id"], "read2999")
+        with self.assertRaises(preview.PreviewError) as raised:
+            preview.SequenceFile(os.path.join(file_index.files_root(), "plain.fastq.gz"))
+        self.assertEqual(raised.exception.status, 415)
+
+    def test_preview_endpoint(self):
+        self.write_fastq("reads/sample.fq", fastq_records(100))
+        url = "/tools/api/files/preview/reads/sample.fq"
+
+        page = self.client.get(url, {"start": 51, "count": 3}).json()
+        self.assertEqual((page["format"], page["total_records"]), ("fastq", 100))
+        self.assertEqual([r["number"] for r in page["records"]], [51, 52, 53])
+        self.assertEqual(self.client.get(url, {"start": 99, "count": 10}).json()["records"][-1]["id"], "read99")
+
+        sample = self.client.get(url, {"sample": 5, "seed": 1}).json()["records"]
+        self.assertEqual(len(sample), 5)
+        self.assertEqual(sample, self.client.get(url, {"sample": 5, "seed": 1}).json()["records"])
+        self.assertEqual([r["number"] for r in sample], sorted(r["number"] for r in sample))
+
+        self.assertEqual(self.client.get(url, {"start": 0}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"count": "ten"}).status_code, 400)
+        self.assertEqual(self.client.get("/tools/api/files/preview/reads/missing.fq").status_code, 404)
+        self.write_file("notes.txt", "hello\n")
+        self.assertEqual(self.client.get("/tools/api/files/preview/notes.txt").status_code, 415)
+
+
+class BgzfTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Several blocks, some of them incompressible
+        self.data = b"".join(os.urandom(20_000) + b"ACGT\n" * 8000 for _ in range(5))
+        self.source = os.path.join(self.workdir, "reads.fastq")
+        with open(self.source, "wb") as f:
+            f.write(self.data)
+
+    def compress(self, **options):
+        target = os.path.join(self.workdir, "reads.fastq.gz")
+        sizes = bgzf.compress_file(self.source, target, **options)
+        return target, sizes
+
+    def test_compressed_file_reads_as_one_gzip_stream(self):
+        target, (size, compressed) = self.compress(workers=1)
+
+        self.assertEqual(size, len(self.data))
+        self.assertEqual(compressed, os.path.getsize(target))
+        with gzip.open(target, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertTrue(bgzf.is_bgzf(target))
+        self.assertFalse(bgzf.is_bgzf(self.source))
+        with gzip.open(os.path.join(self.workdir, "plain.gz"), "wb") as f:
+            f.write(b"ACGT")
+        self.assertFalse(bgzf.is_bgzf(os.path.join(self.workdir, "plain.gz")))
+
+    def test_index_lists_every_block_but_the_first(self):
+        target, _ = self.compress(workers=1)
+        with open(target, "rb") as f:
+            blocks = bgzf._scan_blocks(f)
+        with open(target + bgzf.INDEX_SUFFIX, "rb") as f:
+            count = struct.unpack("<Q", f.read(8))[0]
+            index = [struct.unpack("<QQ", f.read(16)) for _ in range(count)]
+        # The scan also finds the empty end-of-file block
+        self.assertEqual(index, blocks[1:-1])
+        self.assertGreater(len(index), 2)
+
+    def test_pool_writes_the_same_file(self):
+        single, _ = self.compress(workers=1)
+        with open(single, "rb") as f:
+            expected = f.read()
+        os.remove(single)
+        with mock.patch.object(bgzf, "POOL_THRESHOLD", 0):
+            pooled, _ = self.compress(workers=2)
+        with open(pooled, "rb") as f:
+            self.assertEqual(f.read(), expected)
+
+    def test_reader_slices_and_searches_across_blocks(self):
+        target, _ = self.compress(workers=1)
+        boundary = bgzf.BLOCK_DATA_SIZE
+        for use_index in (True, False):
+            if not use_index:
+                os.remove(target + bgzf.INDEX_SUFFIX)
+            reader = bgzf.BgzfReader(target)
+            try:
+                self.assertEqual(len(reader), len(self.data))
+                self.assertEqual(reader[boundary - 10:boundary + 10], self.data[boundary - 10:boundary + 10])
+                self.assertEqual(reader[len(self.data) - 3:], self.data[-3:])
+                needle = self.data[boundary - 3:boundary + 3]
+                self.assertEqual(reader.find(needle, boundary - 100), self.data.find(needle, boundary - 100))
+                self.assertEqual(reader.find(b"\n", 20_000), self.data.find(b"\n", 20_000))
+                self.assertEqual(reader.find(b"NOT THERE"), -1)
+            finally:
+                reader.close()
+
+    def test_decompressed_streams_feed_pipes_and_clean_up(self):
+        target, _ = self.compress(workers=1)
+        streams = bgzf.DecompressedStreams()
+        read_pipe = streams.add(target)
+        unread_pipe = streams.add(target)
+        self.assertTrue(read_pipe.endswith("reads.fastq"))
+
+        with streams:
+            with open(read_pipe, "rb") as f:
+                self.assertEqual(f.read(), self.data)
+        # A pipe nobody opened does not keep the block from ending
+        self.assertFalse(os.path.exists(unread_pipe))
+
+    @override_settings(UPLOAD_COMPRESSION="bgzf")
+    def test_sequence_uploads_are_stored_compressed(self):
+        data = b"@r1\nACGT\n+\nIIII\n" * 500
+        upload = create_upload("reads.fastq", "qc", size=len(data))
+        upload = append_chunk(upload, 0, io.BytesIO(data), len(data))
+
+        stored = os.path.join(settings.MEDIA_ROOT, upload.path)
+        self.assertTrue(stored.endswith("reads.fastq.gz"))
+        self.assertTrue(bgzf.is_bgzf(stored))
+        self.assertTrue(os.path.exists(stored + bgzf.INDEX_SUFFIX))
+        with gzip.open(stored, "rb") as f:
+            self.assertEqual(f.read(), data)
@@ -0,0 +1,224 @@
+"""
+Resumable chunked uploads written straight to their final location.
+
+The client creates an upload, then sends the file in any number of requests
+whose raw body is appended at the "Upload-Offset" it was told to continue
+from. Bytes go directly into media/my_files/<tool>/<name>.part while a
+sha256 is computed on the fly; the part file is renamed once the last byte
+arrives and, with UPLOAD_DEDUPLICATION, moved into the blob store (see
+blobs.py) by that sha256. An interrupted upload continues from the last
+acknowledged offset.
+"""
+import hashlib
+import os
+import threading
+
+from django.conf import settings
+
+from . import bgzf, blobs, file_index
+from .models import Upload
+from .preview import EXTENSIONS as SEQUENCE_EXTENSIONS
+
+CHUNK_SIZE = 1024 * 1024
+PART_SUFFIX = ".part"
+
+# upload id -> (offset, sha256 object) so consecutive requests do not re-read the part file
+_hashers = {}
+_hashers_lock = threading.Lock()
+# Serializes appends to the same upload from concurrent requests
+_upload_locks = {}
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _allocate_path(directory, filename):
+    """
+    Picks a free name, also skipping names reserved by uploads still in progress.
+    """
+    base, ext = os.path.splitext(filename)
+    counter = 1
+    candidate = filename
+    while os.path.exists(os.path.join(directory, candidate)) or os.path.exists(os.path.join(directory, candidate + PART_SUFFIX)):
+        candidate = f"{base}_{counter}{ext}"
+        counter += 1
+    return os.path.join(directory, candidate)
+
+
+def compression_enabled():
+    return getattr(settings, "UPLOAD_COMPRESSION", "") == "bgzf"
+
+
+def compress_upload(path):
+    """
+    Replaces an uploaded FASTQ/FASTA file by a BGZF copy "<name>.gz" when
+    UPLOAD_COMPRESSION is "bgzf", and returns the path to use from now on.
+    """
+    if not compression_enabled() or os.path.splitext(path)[1].lower() not in SEQUENCE_EXTENSIONS:
+        return path
+
+    directory, filename = os.path.split(path)
+    target = _allocate_path(directory, filename + ".gz")
+    size, compressed = bgzf.compress_file(
+        path, target,
+        level=getattr(settings, "UPLOAD_COMPRESSION_LEVEL", 6),
+        workers=getattr(settings, "UPLOAD_COMPRESSION_WORKERS", None),
+    )
+    os.remove(path)
+    print(f"Compressed {filename}: {size} -> {compressed} bytes")
+    return target
+
+
+def create_upload(filename, tool, size=None, checksum=""):
+    filename = os.path.basename(filename or "").strip()
+    tool = os.path.basename(tool or "").strip() or "uploads"
+    if not filename:
+        raise UploadError("Filename is required.")
+    if size is not None and int(size) < 0:
+        raise UploadError("Size must not be negative.")
+
+    directory = os.path.join(settings.MEDIA_ROOT, "my_files", tool)
+    os.makedirs(directory, exist_ok=True)
+    with _hashers_lock:
+        path = _allocate_path(directory, filename)
+        # Reserve the name right away
+        open(path + PART_SUFFIX, "wb").close()
+
+    return Upload.objects.create(
+        filename=filename,
+        path=os.path.relpath(path, settings.MEDIA_ROOT),
+        size=int(size) if size is not None else None,
+        expected_sha256=(checksum or "").lower(),
+    )
+
+
+def full_path(upload):
+    return os.path.join(settings.MEDIA_ROOT, upload.path)
+
+
+def _hasher_for(upload, part_path):
+    """
+    Returns a sha256 object positioned at upload.offset, rebuilding it from disk if needed.
+    """
+    with _hashers_lock:
+        state = _hashers.get(upload.pk)
+    if state and state[0] == upload.offset:
+        return state[1]
+
+    # Another process handled the previous chunks, or this one restarted
+    hasher = hashlib.sha256()
+    remaining = upload.offset
+    with open(part_path, "rb") as f:
+        while remaining:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    return hasher
+
+
+def append_chunk(upload, offset, stream, length):
+    """
+    Writes length bytes from stream at offset. Returns the updated upload.
+
+    Whatever was received before a dropped connection is kept and acknowledged,
+    so the client can continue from upload.offset.
+    """
+    with _hashers_lock:
+        lock = _upload_locks.setdefault(upload.pk, threading.Lock())
+
+    with lock:
+        upload.refresh_from_db()
+        if upload.status == Upload.STATUS_COMPLETE:
+            raise UploadError("Upload is already complete.", status=409)
+        if offset != upload.offset:
+            raise UploadError(f"Expected offset {upload.offset}, got {offset}.", status=409)
+        if upload.size is not None and offset + length > upload.size:
+            raise UploadError("Chunk extends past the declared upload size.")
+
+        part_path = full_path(upload) + PART_SUFFIX
+        hasher = _hasher_for(upload, part_path)
+
+        try:
+            with open(part_path, "r+b") as f:
+                # Drop bytes of an earlier chunk that were written but never acknowledged
+                f.truncate(offset)
+                f.seek(offset)
+                remaining = length
+                while remaining:
+                    chunk = stream.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    remaining -= len(chunk)
+                    upload.offset += len(chunk)
+        finally:
+            upload.save(update_fields=["offset", "updated_at"])
+            with _hashers_lock:
+                _hashers[upload.pk] = (upload.offset, hasher)
+
+        if upload.size is not None and upload.offset == upload.size:
+            _complete(upload, part_path, hasher)
+        return upload
+
+
+def finish_upload(upload):
+    """
+    Completes an upload that was created without a size.
+    """
+    with _hashers_lock:
+        lock = _upload_locks.setdefault(upload.pk, threading.Lock())
+    with lock:
+        upload.refresh_from_db()
+        if upload.status == Upload.STATUS_COMPLETE:
+            return upload
+        part_path = full_path(upload) + PART_SUFFIX
+        upload.size = upload.offset
+        _complete(upload, part_path, _hasher_for(upload, part_path))
+        return upload
+
+
+def _complete(upload, part_path, hasher):
+    digest = hasher.hexdigest()
+    if upload.expected_sha256 and upload.expected_sha256 != digest:
+        # Start over: the data on disk does not match what the client sent
+        os.truncate(part_path, 0)
+        upload.offset = 0
+        upload.save(update_fields=["offset", "updated_at"])
+        with _hashers_lock:
+            _hashers.pop(upload.pk, None)
+        raise UploadError(f"Checksum mismatch: expected {upload.expected_sha256}, got {digest}.", status=422)
+
+    os.rename(part_path, full_path(upload))
+    # size and sha256 keep describing the data as it was sent
+    if blobs.dedup_enabled():
+        stored_path = blobs.store_file(full_path(upload), digest)
+    else:
+        stored_path = compress_upload(full_path(upload))
+    upload.path = os.path.relpath(stored_path, settings.MEDIA_ROOT)
+    if os.path.exists(stored_path + bgzf.INDEX_SUFFIX):
+        file_index.index_path(stored_path + bgzf.INDEX_SUFFIX)
+    file_index.index_path(stored_path)
+    upload.sha256 = digest
+    upload.status = Upload.STATUS_COMPLETE
+    upload.save(update_fields=["path", "size", "sha256", "status", "updated_at"])
+    with _hashers_lock:
+        _hashers.pop(upload.pk, None)
+        _upload_locks.pop(upload.pk, None)
+
+
+def upload_to_dict(upload):
+    return {
+        "upload_id": str(upload.pk),
+        "filename": upload.filename,
+        "path": upload.path,
+        "size": upload.size,
+        "offset": upload.offset,
+        "status": upload.status,
+        "sha256": upload.sha256,
+    }
@@ -5,9 +5,12 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('tool-selector/', views.tool_selector, name='tool_selector'),
     path('files/', views.files, name='files'),
+    path('api/files/', views.list_files, name='list_files'),
+    path('api/files/preview/<path:file_path>', views.preview_file, name='preview_file'),
     path('delete-file/', views.delete_file, name='delete_file'),  
     path('delete-folder/', views.delete_folder, name='delete_folder'),
     path('download-folder/<path:folder_path>/', views.download_folder, name='download_folder'),
+    path('download-selection/', views.download_selection, name='download_selection'),
     path('tool-addition/', views.add_tool, name='tool_addition'),
     path('install-tool/', views.install_tool, name='install_tool'),
     path('tool-help/', views.tool_help, name='tool_help'),
@@ -15,10 +18,24 @@ urlpatterns = [
     path('delete-tool/', views.delete_tool, name='delete_tool'),
     path('workflow/', views.workflow_editor, name='workflow_editor'),
     path('api/tools/', views.get_tools_json, name='get_tools_json'),
+    path('api/tools/usage/', views.tool_usage, name='tool_usage'),
+    path('metrics/', views.metrics, name='metrics'),
     path('api/workflows/save/', views.save_workflow, name='save_workflow'),
     path('api/workflows/', views.load_workflows, name='load_workflows'),
+    path('api/workflows/summaries/', views.list_workflow_summaries, name='list_workflow_summaries'),
+    path('api/workflows/<int:workflow_id>/', views.workflow_detail, name='workflow_detail'),
     path('api/workflows/execute/', views.execute_workflow, name='execute_workflow'),
+    path('api/workflows/execute/stream/', views.execute_workflow_stream, name='execute_workflow_stream'),
+    path('api/uploads/', views.create_chunked_upload, name='create_chunked_upload'),
+    path('api/uploads/<uuid:upload_id>/', views.chunked_upload, name='chunked_upload'),
     path('api/workflows/delete/', views.delete_workflow, name='delete_workflow'),
+    path('api/workflows/runs/', views.submit_workflow_run, name='submit_workflow_run'),
+    path('api/workflows/runs/<int:run_id>/', views.workflow_run_status, name='workflow_run_status'),
+    path('api/workflows/runs/<int:run_id>/resume/', views.resume_workflow_run, name='resume_workflow_run'),
+    path('api/workflows/runs/<int:run_id>/cancel/', views.cancel_workflow_run, name='cancel_workflow_run'),
+    path('api/workflows/runs/<int:run_id>/manifest/', views.workflow_run_manifest, name='workflow_run_manifest'),
+    path('api/workflows/runs/<int:run_id>/log/', views.workflow_run_log, name='workflow_run_log'),
+    path('api/workflows/runs/<int:run_id>/log/<str:node_id>/', views.workflow_run_node_log, name='workflow_run_node_log'),
 
 
 ]
@@ -1,41 +1,125 @@
+import fcntl
+import hashlib
 import json
 import os
+import tempfile
+import threading
+
+TOOLS_JSON_PATH = os.path.join(os.path.dirname(__file__), 'tools.json')
+
+
+class ToolsConfigError(Exception):
+    """Raised when tools.json cannot be parsed for an update."""
+    pass
+
+
+class ToolRegistry:
+    """
+    Process-wide view of tools.json.
+
+    The file is parsed once and only re-read when its mtime, inode or size
+    changes. Updates are serialized with a file lock (so they also exclude
+    other processes) and written through an atomic rename.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stat_key = None
+        self._tools = {}
+        self._json = b"{}"
+        self._etag = None
+
+    def _current_stat_key(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    def _read(self, strict=False):
+        """
+        Parses tools.json; a missing file is empty. A malformed file reads as empty
+        too, unless strict: an update must not replace it with its change alone.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            print("tools.json file not found.")
+            return {}
+        except json.JSONDecodeError as e:
+            if strict:
+                raise ToolsConfigError(f"tools.json is not properly formatted: {e}")
+            print("tools.json is not properly formatted.")
+            return {}
+
+    def _refresh(self):
+        stat_key = self._current_stat_key()
+        if stat_key == self._stat_key and self._etag is not None:
+            return
+        with self._lock:
+            stat_key = self._current_stat_key()
+            if stat_key == self._stat_key and self._etag is not None:
+                return
+            self._set(self._read(), stat_key)
+
+    def _set(self, tools, stat_key):
+        self._tools = tools
+        self._json = json.dumps(tools).encode()
+        self._etag = hashlib.sha1(self._json).hexdigest()
+        self._stat_key = stat_key
+
+    def get(self):
+        """
+        Returns the tool definitions. The dict is shared; copy it before changing it.
+        """
+        self._refresh()
+        return self._tools
+
+    def get_json(self):
+        """
+        Returns the serialized tool definitions and their ETag.
+        """
+        self._refresh()
+        return self._json, self._etag
+
+    def update(self, change):
+        """
+        Applies change(tools) to a fresh copy of tools.json under an exclusive lock
+        and writes the result atomically. change may raise to abort the update;
+        whatever it returns is returned from update. Raises ToolsConfigError,
+        leaving the file alone, if tools.json cannot be parsed.
+        """
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path + ".lock", "w") as lock_file, self._lock:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                tools = self._read(strict=True)
+                result = change(tools)
+
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tools.", suffix=".json")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        json.dump(tools, f, indent=4)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.chmod(tmp_path, 0o644)
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+
+                self._set(tools, self._current_stat_key())
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+tool_registry = ToolRegistry(TOOLS_JSON_PATH)
+
 
 def load_tools_config():
-    config_path = os.path.join(os.path.dirname(__file__), 'tools.json')
-    try:
-        with open(config_path, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        print("tools.json file not found.")
-        return {}
-    except json.JSONDecodeError:
-        print("tools.json is not properly formatted.")
-        return {}
-
-def topological_sort(nodes, edges):
-    from collections import defaultdict, deque
-
-    graph = defaultdict(list)
-    indegree = defaultdict(int)
-    node_map = {n['id']: n for n in nodes}
-
-    for edge in edges:
-        graph[edge['source']].append(edge['target'])
-        indegree[edge['target']] += 1
-
-    queue = deque([node['id'] for node in nodes if indegree[node['id']] == 0])
-    sorted_nodes = []
-
-    while queue:
-        node_id = queue.popleft()
-        sorted_nodes.append(node_map[node_id])
-        for neighbor in graph[node_id]:
-            indegree[neighbor] -= 1
-            if indegree[neighbor] == 0:
-                queue.append(neighbor)
-
-    if len(sorted_nodes) != len(nodes):
-        raise ValueError("Cycle detected in workflow")
-
-    return sorted_nodes
+    return tool_registry.get()
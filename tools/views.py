@@ -1,23 +1,55 @@
 import json
 import os
 import subprocess
+import uuid
 from django.shortcuts import render, redirect
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.conf import settings
-import zipfile
-import io
 import glob
+from asgiref.sync import async_to_sync, sync_to_async
 from django.views.decorators.csrf import csrf_exempt
-from .models import Workflow
-from django.db import IntegrityError
-from collections import defaultdict, deque
+from django.views.decorators.http import etag
+from .models import Workflow, WorkflowRun, Upload, FileEntry
+from django.core.paginator import Paginator
+from django.db import IntegrityError, connection
+from django.db.models import Count, Max
+from .executor import WorkflowError, compile_workflow, run_output_dir, tool_commands
+from .jobs import cancel_run, create_run, execute_run, submit_run, resume_run, run_graph, run_options, run_to_dict, run_log_dir
+from .metrics import render_metrics
+from .process import TIMEOUT, run_process, run_process_async, tool_timeout
+from .streaming import event_stream_response, for_server, stream_events
+from .zipstream import stream_zip, collect_entries
+from .utils import ToolsConfigError, tool_registry, load_tools_config
+from . import accounting, bgzf, blobs, file_index, introspection
+from .file_index import ensure_index, list_directory, relative_path, remove_path
+from .preview import PreviewError, SequenceFile
+from .uploads import UploadError, compress_upload, create_upload, append_chunk, finish_upload, upload_to_dict
  
 INSTALL_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "installed_tools")
 
-TOOLS_JSON_PATH = os.path.join(os.path.dirname(__file__), 'tools.json')
+def _execute_run_in_worker(run):
+    try:
+        return execute_run(run)
+    finally:
+        # Worker threads outlive the request, their connections would stay open
+        connection.close()
 
-@csrf_exempt
-def execute_workflow(request):
+
+async def _preflight(nodes):
+    """
+    Returns the 400 response if a tool of the workflow is not installed, so nothing starts; None otherwise.
+    """
+    missing = await introspection.preflight(tool_commands(nodes))
+    if not missing:
+        return None
+    return JsonResponse({
+        "success": False,
+        "error": f"Tools not found: {', '.join(sorted(missing))}",
+        "missing_tools": missing,
+    }, status=400)
+
+
+async def execute_workflow(request):
     if request.method != "POST":
         return JsonResponse({"error": "POST request required"}, status=400)
 
@@ -26,177 +58,193 @@ def execute_workflow(request):
     except Exception as e:
         return JsonResponse({"error": "Invalid JSON", "details": str(e)}, status=400)
 
-    workflow_name = data.get("workflow_name") or "unnamed_workflow"
-    nodes = data.get("nodes", [])
-    edges = data.get("edges", [])
-
-    node_map = {n["id"]: n for n in nodes}
-    edge_map = defaultdict(list)
-    for e in edges:
-        edge_map[e["target"]].append(e)
-
-    log = []
-
-    # Build dependency graph
-    graph = defaultdict(list)
-    in_degree = defaultdict(int)
-    connected_nodes = set()
-
-    for edge in edges:
-        src = edge["source"]
-        tgt = edge["target"]
-        graph[src].append(tgt)
-        in_degree[tgt] += 1
-        connected_nodes.update([src, tgt])
-
-    roots = [n for n in connected_nodes if in_degree[n] == 0]
-    if len(roots) != 1:
-        return JsonResponse({
-            "success": False,
-            "error": f"Workflow must have exactly one starting tool. Found {len(roots)}: {roots}"
-        }, status=400)
-
-    # Topological sort
-    sorted_ids = []
-    queue = deque(roots)
-    while queue:
-        current = queue.popleft()
-        sorted_ids.append(current)
-        for neighbor in graph[current]:
-            in_degree[neighbor] -= 1
-            if in_degree[neighbor] == 0:
-                queue.append(neighbor)
-
-    if len(sorted_ids) != len(connected_nodes):
-        return JsonResponse({
-            "success": False,
-            "error": "Workflow contains disconnected or cyclic paths."
-        }, status=400)
-
-    # Validate mandatory fields before execution
-    for node_id in sorted_ids:
-        node = node_map[node_id]
-        label = node["data"]["label"]
-        if label == "file":
-            continue
-
-        parameters = node["data"].get("parameters", {})
-        tool_def = node["data"].get("toolDef", {})
-        options = tool_def.get("options", [])
-        incoming = edge_map.get(node_id, [])
-
-        for opt in options:
-            if not opt.get("mandatory"):
-                continue
-
-            param_label = opt.get("label")
-            val = parameters.get(param_label)
-            filled_by_user = val is not None and str(val).strip() != ""
-            filled_by_edge = any(e["data"].get("param") == param_label for e in incoming)
-
-            if not filled_by_user and not filled_by_edge:
-                return JsonResponse({
-                    "success": False,
-                    "error": f'Mandatory input "{param_label}" is missing for tool "{label}".'
-                }, status=400)
-
-    # Now execute each tool
-    for node_id in sorted_ids:
-        node = node_map[node_id]
-        label = node["data"]["label"]
-        if label == "file":
-            continue
-
-        parameters = node["data"].get("parameters", {})
-        tool_def = node["data"].get("toolDef", {})
-        command = [tool_def.get("command", label)]
-        resolved_params = {}
-
-        output_dir = os.path.join(settings.MEDIA_ROOT, "my_files", workflow_name, label)
-        os.makedirs(output_dir, exist_ok=True)
-
-        incoming = edge_map.get(node_id, [])
-        for edge in incoming:
-            source_id = edge["source"]
-            param_name = edge["data"].get("param")
-            source_node = node_map[source_id]
-            source_label = source_node["data"]["label"]
-            filename = source_node["data"]["parameters"].get("filename")
-
-            if filename:
-                if source_label == "file":
-                    prior_edge = next((e for e in edges if e["target"] == source_id), None)
-                    if prior_edge:
-                        producer_id = prior_edge["source"]
-                        producer_label = node_map[producer_id]["data"]["label"]
-                        source_path = os.path.join(settings.MEDIA_ROOT, "my_files", workflow_name, producer_label, filename)
-                    else:
-                        source_path = os.path.join(settings.MEDIA_ROOT, "my_files", filename)
-                else:
-                    source_path = os.path.join(settings.MEDIA_ROOT, "my_files", workflow_name, source_label, filename)
+    try:
+        workflow_name, nodes, edges, plan = await sync_to_async(run_graph)(data)
 
-                if not os.path.exists(source_path):
-                    return JsonResponse({
-                        "success": False,
-                        "error": f"File not found: {source_path}",
-                        "log": log
-                    }, status=500)
-
-                resolved_params[param_name] = source_path
-
-        for opt in tool_def.get("options", []):
-            opt_label = opt.get("label")
-            opt_flag = opt.get("flag")
-            val = resolved_params.get(opt_label) or parameters.get(opt_label)
-
-            if val:
-                if opt_flag and (opt_flag == "-o" or opt_flag == "--output" or "output" in opt_label.lower()):
-                    base = os.path.basename(str(val))
-                    has_extension = "." in base and len(base.split(".")[-1]) > 1
-
-                    if has_extension:
-                        sanitized_output = "".join(c for c in base if c.isalnum() or c in ("_", "-", "."))
-                        unique_output = generate_unique_filename(output_dir, sanitized_output)
-                        final_output_path = os.path.join(output_dir, unique_output)
-                        os.makedirs(os.path.dirname(final_output_path), exist_ok=True)
-                    else:
-                        sanitized_output = "".join(c for c in base if c.isalnum() or c in ("_", "-"))
-                        unique_output = generate_unique_filename(output_dir, sanitized_output)
-                        final_output_path = os.path.join(output_dir, unique_output)
-                        os.makedirs(final_output_path, exist_ok=True)
+        missing_response = await _preflight(nodes)
+        if missing_response:
+            return missing_response
 
-                    if opt_flag:
-                        command += [opt_flag, final_output_path]
-                    else:
-                        command.append(final_output_path)
+        run = await sync_to_async(create_run)(
+            workflow_name, nodes, edges, run_options(data), status=WorkflowRun.STATUS_RUNNING, plan=plan,
+        )
+    except WorkflowError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
 
-                    # Save only filename so downstream nodes can reference it
-                    resolved_params[opt_label] = os.path.basename(final_output_path)
+    # The executor schedules nodes on its own threads and tool processes go through
+    # process_limiter; running it outside the thread shared by sync code keeps
+    # other requests answering while the workflow runs.
+    result = await sync_to_async(_execute_run_in_worker, thread_sensitive=False)(run)
+    return JsonResponse(result, status=200 if result["success"] else 500)
 
-                elif opt_flag:
-                    command += [opt_flag, str(val)]
-                else:
-                    command.append(str(val))
-            else:
-                log.append(f"[WARN] Missing parameter '{opt_label}' for tool '{label}'")
+# csrf_exempt() cannot wrap async views before Django 5.0
+execute_workflow.csrf_exempt = True
+
+
+
+@csrf_exempt
+def execute_workflow_stream(request):
+    """
+    Same as execute_workflow, but streams node status changes and tool output
+    line by line as server-sent events. The last event ("done") carries the result.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST request required"}, status=400)
+
+    try:
+        data = json.loads(request.body)
+    except Exception as e:
+        return JsonResponse({"error": "Invalid JSON", "details": str(e)}, status=400)
 
+    try:
+        # Validate before committing to a streaming response
+        workflow_name, nodes, edges, plan = run_graph(data)
+        missing_response = async_to_sync(_preflight)(nodes)
+        if missing_response:
+            return missing_response
+        run = create_run(workflow_name, nodes, edges, run_options(data), status=WorkflowRun.STATUS_RUNNING, plan=plan)
+    except WorkflowError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+
+    def execute(emit):
+        # Lets the client cancel the run through its id
+        emit("run", {"run_id": run.pk})
         try:
-            command_str = ' '.join(command)
-            log.append(f"Running: {command_str}")
-            result = subprocess.run(command, cwd=output_dir, capture_output=True, text=True)
-            log.append(result.stdout)
-            if result.stderr:
-                log.append(result.stderr)
-            if result.returncode != 0:
-                raise Exception(f"Command failed: {result.stderr}")
-        except Exception as e:
-            return JsonResponse({
-                "success": False,
-                "error": str(e),
-                "log": log
-            }, status=500)
+            return execute_run(
+                run,
+                on_node_update=lambda node_id, state: emit("node", {"node": node_id, "status": state}),
+                on_output=lambda node_id, line: emit("log", {"node": node_id, "line": line}),
+            )
+        finally:
+            connection.close()
+
+    return event_stream_response(request, stream_events(execute))
+
+@csrf_exempt
+def submit_workflow_run(request):
+    """
+    Queues a workflow for the background workers and returns immediately with the run id.
+
+    With "targets" only those nodes and the ancestors they need are executed,
+    with "resume_from" nodes that succeeded in that run are reused.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST request required"}, status=400)
+
+    try:
+        data = json.loads(request.body)
+    except Exception as e:
+        return JsonResponse({"error": "Invalid JSON", "details": str(e)}, status=400)
+
+    try:
+        workflow_name, nodes, edges, plan = run_graph(data)
+        missing_response = async_to_sync(_preflight)(nodes)
+        if missing_response:
+            return missing_response
+        run = submit_run(workflow_name, nodes, edges, run_options(data), plan=plan)
+    except WorkflowError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+
+    return JsonResponse({"success": True, "run_id": run.pk, "status": run.status}, status=202)
+
+@csrf_exempt
+def resume_workflow_run(request, run_id):
+    """
+    Queues a new run of a finished run's workflow, starting from its first failed node.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST request required"}, status=400)
+
+    try:
+        run = WorkflowRun.objects.get(pk=run_id)
+    except WorkflowRun.DoesNotExist:
+        return JsonResponse({"error": f"Run {run_id} not found"}, status=404)
+
+    if run.status in (WorkflowRun.STATUS_QUEUED, WorkflowRun.STATUS_RUNNING):
+        return JsonResponse({"success": False, "error": f"Run {run_id} has not finished yet"}, status=409)
+
+    missing_response = async_to_sync(_preflight)(run.payload.get("nodes", []))
+    if missing_response:
+        return missing_response
+
+    try:
+        new_run = resume_run(run)
+    except WorkflowError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
 
-    return JsonResponse({"success": True, "log": log})
+    return JsonResponse({"success": True, "run_id": new_run.pk, "status": new_run.status}, status=202)
+
+@csrf_exempt
+def cancel_workflow_run(request, run_id):
+    """
+    Cancels a queued or running run; its running tools are terminated with their child processes.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST request required"}, status=400)
+
+    try:
+        run = WorkflowRun.objects.only("id").get(pk=run_id)
+    except WorkflowRun.DoesNotExist:
+        return JsonResponse({"error": f"Run {run_id} not found"}, status=404)
+
+    if not cancel_run(run):
+        return JsonResponse({"success": False, "error": f"Run {run_id} has already finished"}, status=409)
+
+    run = WorkflowRun.objects.defer("log", "payload").get(pk=run_id)
+    return JsonResponse({"success": True, "run_id": run.pk, "status": run.status}, status=202)
+
+def workflow_run_status(request, run_id):
+    try:
+        run = WorkflowRun.objects.defer("log", "payload").get(pk=run_id)
+    except WorkflowRun.DoesNotExist:
+        return JsonResponse({"error": f"Run {run_id} not found"}, status=404)
+    return JsonResponse(run_to_dict(run))
+
+def metrics(request):
+    if request.META.get("REMOTE_ADDR") not in getattr(settings, "METRICS_ALLOWED_IPS", ["127.0.0.1", "::1"]):
+        return HttpResponse(status=403)
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+def tool_usage(request):
+    """
+    Per-tool runtime, CPU, memory and I/O aggregates. Optional ?tool=<name> and ?days=<n>.
+    """
+    try:
+        days = int(request.GET["days"]) if request.GET.get("days") else None
+    except ValueError:
+        return JsonResponse({"error": "days must be a number"}, status=400)
+    return JsonResponse({"tools": accounting.tool_summary(tool=request.GET.get("tool"), days=days)})
+
+def workflow_run_log(request, run_id):
+    try:
+        run = WorkflowRun.objects.defer("payload").get(pk=run_id)
+    except WorkflowRun.DoesNotExist:
+        return JsonResponse({"error": f"Run {run_id} not found"}, status=404)
+    return JsonResponse(run_to_dict(run, include_log=True))
+
+def workflow_run_manifest(request, run_id):
+    """
+    Returns the manifest of files each node of a run produced.
+    """
+    try:
+        run = WorkflowRun.objects.only("workflow_name").get(pk=run_id)
+    except WorkflowRun.DoesNotExist:
+        return JsonResponse({"error": f"Run {run_id} not found"}, status=404)
+
+    manifest_path = os.path.join(run_output_dir(run.workflow_name, run.pk), "manifest.json")
+    if not os.path.isfile(manifest_path):
+        return JsonResponse({"error": f"Run {run_id} has not produced any outputs yet"}, status=404)
+    with open(manifest_path) as f:
+        return JsonResponse(json.load(f))
+
+def workflow_run_node_log(request, run_id, node_id):
+    """
+    Returns the full output of one node of a run as plain text.
+    """
+    log_path = os.path.join(run_log_dir(run_id), f"{os.path.basename(node_id)}.log")
+    if not os.path.isfile(log_path):
+        return JsonResponse({"error": f"No log for node '{node_id}' in run {run_id}"}, status=404)
+    return for_server(request, FileResponse(open(log_path, "rb"), content_type="text/plain; charset=utf-8"))
 
 
 
@@ -239,28 +287,94 @@ def save_workflow(request):
     if not name or not graph:
         return JsonResponse({"error": "Missing workflow name or graph"}, status=400)
 
+    # Compiled once here so executions do not have to validate the graph again.
+    # Unfinished workflows are still saved, just without a plan.
+    plan, plan_error = None, None
+    try:
+        plan = compile_workflow(graph.get("nodes", []), graph.get("edges", []))
+    except (WorkflowError, KeyError, TypeError, AttributeError) as e:
+        plan_error = str(e) if isinstance(e, WorkflowError) else "Malformed graph."
+
     try:
         obj, created = Workflow.objects.update_or_create(
             name=name,
-            defaults={"graph": graph}
+            defaults={"graph": graph, "plan": plan, "node_count": len(graph.get("nodes") or [])}
         )
-        return JsonResponse({"success": True, "created": created})
+        return JsonResponse({"success": True, "created": created, "valid": plan is not None, "plan_error": plan_error})
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
 
+def workflows_etag(request, *args, **kwargs):
+    """
+    Changes whenever a workflow is saved, added or deleted; computed without loading any graph.
+    """
+    state = Workflow.objects.aggregate(count=Count("id"), last_id=Max("id"), updated=Max("updated_at"))
+    updated = state["updated"].timestamp() if state["updated"] else 0
+    # Pages of the listing must not share a validator
+    return f'{state["count"]}-{state["last_id"]}-{updated}-{request.GET.urlencode()}'
+
+@etag(workflows_etag)
 def load_workflows(request):
-    workflows = Workflow.objects.all().order_by('-created_at')
+    workflows = Workflow.objects.defer("plan").order_by('-created_at')
     data = [
         {"id": wf.id, "name": wf.name, "graph": wf.graph}
         for wf in workflows
     ]
     return JsonResponse(data, safe=False)
 
+def workflow_to_summary(workflow):
+    return {
+        "id": workflow.id,
+        "name": workflow.name,
+        "node_count": workflow.node_count,
+        "created_at": workflow.created_at.isoformat(),
+        "updated_at": workflow.updated_at.isoformat(),
+    }
+
+@etag(workflows_etag)
+def list_workflow_summaries(request):
+    """
+    One page of workflows without their graphs, newest first (?page=, ?page_size= up to 200).
+    """
+    try:
+        page_size = min(max(int(request.GET.get("page_size", 50)), 1), 200)
+    except ValueError:
+        return JsonResponse({"error": "page_size must be a number"}, status=400)
+
+    workflows = Workflow.objects.only("id", "name", "node_count", "created_at", "updated_at").order_by("-created_at", "-id")
+    paginator = Paginator(workflows, page_size)
+    page = paginator.get_page(request.GET.get("page", 1))
+    return JsonResponse({
+        "page": page.number,
+        "pages": paginator.num_pages,
+        "count": paginator.count,
+        "workflows": [workflow_to_summary(w) for w in page.object_list],
+    })
+
+def workflow_etag(request, workflow_id):
+    updated = Workflow.objects.filter(pk=workflow_id).values_list("updated_at", flat=True).first()
+    return f"{workflow_id}-{updated.timestamp()}" if updated else None
+
+@etag(workflow_etag)
+def workflow_detail(request, workflow_id):
+    """
+    The full graph of one saved workflow.
+    """
+    workflow = Workflow.objects.defer("plan").filter(pk=workflow_id).first()
+    if workflow is None:
+        return JsonResponse({"error": f"Workflow {workflow_id} not found"}, status=404)
+    data = workflow_to_summary(workflow)
+    data["graph"] = workflow.graph
+    data["valid"] = Workflow.objects.filter(pk=workflow_id, plan__isnull=False).exists()
+    return JsonResponse(data)
+
+@etag(lambda request: tool_registry.get_json()[1])
 def get_tools_json(request):
-    tools_path = os.path.join(settings.BASE_DIR, 'tools', 'tools.json')
-    with open(tools_path, 'r') as f:
-        tools = json.load(f)
-    return JsonResponse(tools)
+    content, _ = tool_registry.get_json()
+    response = HttpResponse(content, content_type="application/json")
+    # Let the editor revalidate with If-None-Match on every poll
+    response["Cache-Control"] = "no-cache"
+    return response
 
 def workflow_editor(request):
     react_static_path = os.path.join(settings.BASE_DIR, 'tools', 'static', 'react', 'static')
@@ -278,30 +392,28 @@ def workflow_editor(request):
 def delete_tool(request):
     if request.method == "POST":
         tool_name = request.POST.get("tool_name")
+        def remove(tools):
+            if tool_name not in tools:
+                raise KeyError(tool_name)
+            del tools[tool_name]
+
         try:
-            with open(TOOLS_JSON_PATH, 'r+') as file:
-                tools = json.load(file)
-                if tool_name in tools:
-                    del tools[tool_name]
-                    file.seek(0)
-                    json.dump(tools, file, indent=4)
-                    file.truncate()
-                    return JsonResponse({"success": True, "message": f"Tool '{tool_name}' deleted successfully."})
-                else:
-                    return JsonResponse({"success": False, "message": "Tool not found."})
+            tool_registry.update(remove)
+            return JsonResponse({"success": True, "message": f"Tool '{tool_name}' deleted successfully."})
+        except KeyError:
+            return JsonResponse({"success": False, "message": "Tool not found."})
         except Exception as e:
             return JsonResponse({"success": False, "message": str(e)})
     return JsonResponse({"success": False, "message": "Invalid request method."})
 
 def tool_deletion(request):
     try:
-        with open(TOOLS_JSON_PATH, 'r') as file:
-            tools = json.load(file)
+        tools = load_tools_config()
         return render(request, 'tools/tool_deletion.html', {'tools': tools})
     except Exception as e:
         return JsonResponse({"success": False, "message": f"Error loading tools: {str(e)}"})
 
-def tool_help(request):
+async def tool_help(request):
     if request.method == "POST":
         try:
             data = json.loads(request.body)
@@ -310,19 +422,18 @@ def tool_help(request):
             if not tool_name:
                 return JsonResponse({"error": "Tool command is required."}, status=400)
 
-            # Run the help command
-            result = subprocess.run(
-                f"{tool_name} --help", shell=True, capture_output=True, text=True, check=False
-            )
+            # Help texts are cached per tool binary; only a new or changed binary is run
+            info = await introspection.tool_info(tool_name)
 
-            if result.returncode != 0:
+            if info["help_returncode"] != 0:
                 return JsonResponse({
-                    "error": f"Failed to get help for '{tool_name}': {result.stderr.strip()}"
+                    "error": f"Failed to get help for '{tool_name}': {info['help_error']}"
                 }, status=500)
 
             return JsonResponse({
                 "success": True,
-                "help_output": result.stdout.strip()
+                "help_output": info["help"],
+                "version": info["version"],
             })
 
         except Exception as e:
@@ -372,22 +483,14 @@ def install_tool(request):
 
                      
                     if "pip3 install" in command:
-                        version_command = f"python3 -m {tool_name} --version"
+                        tool_command = f"python3 -m {tool_name}"
                     else:
-                        version_command = f"{tool_name} --version"
+                        tool_command = tool_name
 
-                    print(f"Checking version with command: {version_command}")
-                    version_result = subprocess.run(
-                        version_command,
-                        shell=True,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        text=True
-                    )
-                    print(f"Version Output:\n{version_result.stdout}")
-                    print(f"Version Errors:\n{version_result.stderr}")
-
-                    version = version_result.stdout.strip()
+                    # A fresh probe, so a reinstall reports the new version; it also caches the help text
+                    info = introspection.probe_sync(tool_command)
+                    version = info["version"]
+                    print(f"Version: {version}")
 
                     return JsonResponse({
                         "success": True,
@@ -448,43 +551,110 @@ def files(request):
     """
     View for rendering the My Files page, showing all directories and files under media/my_files.
     """
-    media_root = os.path.join(settings.MEDIA_ROOT, "my_files")
-    tools = {}
-
-    if os.path.exists(media_root):
-        for tool_name in os.listdir(media_root):
-            tool_path = os.path.join(media_root, tool_name)
-            if os.path.isdir(tool_path):
-                tools[tool_name] = get_directory_structure(tool_path)
+    # Only the top-level folders are rendered; their contents are fetched from the file index on demand
+    ensure_index()
+    tools = FileEntry.objects.filter(parent="", is_dir=True)
 
     return render(request, "tools/files.html", {"output_files": tools})
 
+def list_files(request):
+    """
+    Paginated listing of one directory under media/my_files, served from the file index.
+    """
+    ensure_index()
+    path = request.GET.get("path", "")
+    try:
+        page = int(request.GET.get("page", 1))
+        page_size = min(max(int(request.GET.get("page_size", 100)), 1), 1000)
+    except ValueError:
+        return JsonResponse({"error": "page and page_size must be integers."}, status=400)
+    return JsonResponse(list_directory(path, page, page_size))
+
 from django.http import FileResponse
+
+def resolve_my_files_path(relative_path):
+    """
+    Returns the absolute path of a path under media/my_files, or None if it points outside of it.
+    """
+    root = os.path.realpath(os.path.join(settings.MEDIA_ROOT, "my_files"))
+    full_path = os.path.realpath(os.path.join(root, relative_path))
+    if full_path != root and not full_path.startswith(root + os.sep):
+        return None
+    return full_path
+
+def zip_response(request, entries, filename):
+    response = StreamingHttpResponse(stream_zip(entries), content_type="application/zip")
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return for_server(request, response)
+
 # Download Folder as ZIP
 def download_folder(request, folder_path):
     """
-    Creates a ZIP file of the specified folder and returns it as a download response.
+    Streams a ZIP file of the specified folder while it is being built.
     """
-    full_folder_path = os.path.join(settings.MEDIA_ROOT, "my_files", folder_path)
+    full_folder_path = resolve_my_files_path(folder_path)
 
-    if os.path.exists(full_folder_path) and os.path.isdir(full_folder_path):
-         
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for root, _, files in os.walk(full_folder_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, full_folder_path)
-                    zip_file.write(file_path, arcname)
-        zip_buffer.seek(0)
-
-         
-        folder_name = os.path.basename(folder_path)
-        response = FileResponse(zip_buffer, as_attachment=True, filename=f"{folder_name}.zip")
-        return response
+    if full_folder_path and os.path.isdir(full_folder_path):
+        folder_name = os.path.basename(folder_path.rstrip("/"))
+        return zip_response(request, collect_entries(full_folder_path), f"{folder_name}.zip")
     else:
         return JsonResponse({"status": "error", "message": "Folder not found."})
 
+def download_selection(request):
+    """
+    Streams one ZIP file with every selected file and folder (repeated "paths" parameters).
+    """
+    paths = request.POST.getlist("paths") if request.method == "POST" else request.GET.getlist("paths")
+    if not paths:
+        return JsonResponse({"status": "error", "message": "No files selected."}, status=400)
+
+    entries = []
+    seen = set()
+    for path in paths:
+        full_path = resolve_my_files_path(path)
+        if not full_path or not os.path.exists(full_path):
+            return JsonResponse({"status": "error", "message": f"'{path}' not found."}, status=404)
+        # A file may be selected both on its own and through its folder
+        for file_path, arcname in collect_entries(full_path, path.strip("/")):
+            if arcname not in seen:
+                seen.add(arcname)
+                entries.append((file_path, arcname))
+
+    return zip_response(request, entries, "selection.zip")
+
+def preview_file(request, file_path):
+    """
+    Returns records of a FASTQ/FASTA file under my_files.
+
+    ?start=1000000&count=50 pages through records (numbered from 1),
+    ?sample=50&seed=1 picks records at random.
+    """
+    full_path = resolve_my_files_path(file_path)
+    if not full_path or not os.path.isfile(full_path):
+        return JsonResponse({"error": "File not found."}, status=404)
+
+    try:
+        start = int(request.GET.get("start", 1))
+        count = int(request.GET.get("count", 20))
+        sample = int(request.GET["sample"]) if "sample" in request.GET else None
+    except ValueError:
+        return JsonResponse({"error": "start, count and sample must be integers."}, status=400)
+
+    try:
+        with SequenceFile(full_path) as sequences:
+            if sample is not None:
+                records = sequences.sample(sample, request.GET.get("seed"))
+            else:
+                records = sequences.read_range(start - 1, count)
+            return JsonResponse({
+                "path": file_path,
+                "format": sequences.format,
+                "total_records": sequences.records,
+                "records": records,
+            })
+    except PreviewError as e:
+        return JsonResponse({"error": str(e)}, status=e.status)
+
 def delete_file(request):
     """
     Deletes a specific file.
@@ -495,7 +665,16 @@ def delete_file(request):
 
         if os.path.exists(full_path) and os.path.isfile(full_path):
             try:
-                os.remove(full_path)
+                # Frees the upload's blob too if no other file links to it
+                blobs.remove_file(full_path)
+                rel = relative_path(full_path)
+                if rel:
+                    remove_path(rel)
+                # The block index of a BGZF file is useless without it
+                if os.path.isfile(full_path + bgzf.INDEX_SUFFIX):
+                    blobs.remove_file(full_path + bgzf.INDEX_SUFFIX)
+                    if rel:
+                        remove_path(rel + bgzf.INDEX_SUFFIX)
                 return JsonResponse({"status": "success"})
             except Exception as e:
                 return JsonResponse({"status": "error", "message": str(e)})
@@ -516,10 +695,13 @@ def delete_folder(request):
 
         if os.path.exists(full_path) and os.path.isdir(full_path):
             try:
-                shutil.rmtree(full_path)
+                blobs.remove_tree(full_path)
             except Exception as e:
                  
                 pass
+            rel = relative_path(full_path)
+            if rel:
+                remove_path(rel)
         
          
         return redirect(request.META.get('HTTP_REFERER', '/'))   
@@ -538,6 +720,7 @@ def add_tool(request):
             install_command = data.get("install_command", "")
             command = data.get("command", "")   
             options = data.get("options", [])
+            resources = data.get("resources")
 
             if not name:
                 return JsonResponse({"error": "Tool name is required."}, status=400)
@@ -552,27 +735,40 @@ def add_tool(request):
                     return JsonResponse({"error": "Each option must have a label and a type."}, status=400)
                 
                  
-                validated_options.append({
+                validated_option = {
                     "label": opt["label"],
                     "flag": opt.get("flag"),   
                     "type": opt["type"],
                     "mandatory": opt.get("mandatory", False)   
-                })
-
-             
-            tools_json_path = os.path.join(settings.BASE_DIR, "tools", "tools.json")
-            if not os.path.exists(tools_json_path):
-                os.makedirs(os.path.dirname(tools_json_path), exist_ok=True)
-                with open(tools_json_path, "w") as f:
-                    json.dump({}, f)
-
-             
-            with open(tools_json_path, "r+") as f:
-                tools = json.load(f)
+                }
+                # Read or written sequentially once, so workflows may pass it through a named pipe
+                if opt.get("stream"):
+                    validated_option["stream"] = True
+                validated_options.append(validated_option)
+
+            # Optional CPU/memory declaration used by the workflow scheduler
+            if resources is not None:
+                if not isinstance(resources, dict):
+                    return JsonResponse({"error": "Resources must be an object."}, status=400)
+                try:
+                    validated_resources = {key: int(resources[key]) for key in ("cpus", "memory_mb") if key in resources}
+                except (TypeError, ValueError):
+                    return JsonResponse({"error": "Resource cpus and memory_mb must be numbers."}, status=400)
+                if resources.get("threads_option"):
+                    validated_resources["threads_option"] = resources["threads_option"]
+                resources = validated_resources
+
+            # Optional default time limit in seconds
+            timeout = data.get("timeout")
+            if timeout not in (None, ""):
+                try:
+                    timeout = float(timeout)
+                except (TypeError, ValueError):
+                    return JsonResponse({"error": "Timeout must be a number of seconds."}, status=400)
 
-                 
+            def add(tools):
                 if name in tools:
-                    return JsonResponse({"error": f"Tool '{name}' already exists."}, status=400)
+                    raise KeyError(name)
 
                 # Add new tool to tools.json
                 tools[name] = {
@@ -581,12 +777,23 @@ def add_tool(request):
                     "command": command,
                     "options": validated_options,   
                 }
+                if resources:
+                    tools[name]["resources"] = resources
+                # Tools reading gzip themselves get compressed inputs as they are stored
+                if data.get("gzip_input"):
+                    tools[name]["gzip_input"] = True
+                if timeout not in (None, ""):
+                    tools[name]["timeout"] = timeout
 
-                 
-                f.seek(0)
-                json.dump(tools, f, indent=4)
-                f.truncate()
-
+            try:
+                tool_registry.update(add)
+            except KeyError:
+                return JsonResponse({"error": f"Tool '{name}' already exists."}, status=400)
+            except ToolsConfigError as e:
+                return JsonResponse({"error": str(e)}, status=500)
+
+            # Warm the help and version cache before the tool is first used
+            introspection.refresh_in_background([command])
             return JsonResponse({"success": True, "message": "Tool added successfully."})
 
         except json.JSONDecodeError:
@@ -607,10 +814,7 @@ def run_tool(request):
     if request.method == "POST":
         try:
             selected_tool = request.POST.get("tool")
-            tools_json_path = os.path.join(settings.BASE_DIR, "tools", "tools.json")
-
-            with open(tools_json_path, "r") as f:
-                tools = json.load(f)
+            tools = load_tools_config()
 
             if selected_tool not in tools:
                 return JsonResponse({"error": "Invalid tool selected."}, status=400)
@@ -645,6 +849,62 @@ def run_tool(request):
     return JsonResponse({"error": "Invalid request method."}, status=405)
 
 
+@csrf_exempt
+def create_chunked_upload(request):
+    """
+    Starts a resumable upload. JSON body: filename, tool, size and optionally sha256.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST request required"}, status=405)
+
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON payload."}, status=400)
+
+    try:
+        upload = create_upload(data.get("filename"), data.get("tool"), data.get("size"), data.get("sha256"))
+    except (UploadError, ValueError) as e:
+        return JsonResponse({"error": str(e)}, status=getattr(e, "status", 400))
+
+    return JsonResponse(upload_to_dict(upload), status=201)
+
+@csrf_exempt
+def chunked_upload(request, upload_id):
+    """
+    GET returns the acknowledged offset to resume from. PUT/PATCH/POST appends
+    the raw request body at the "Upload-Offset" header. POST with an empty body
+    to an upload created without a size completes it.
+    """
+    try:
+        upload = Upload.objects.get(pk=upload_id)
+    except Upload.DoesNotExist:
+        return JsonResponse({"error": "Upload not found."}, status=404)
+
+    if request.method == "GET":
+        return JsonResponse(upload_to_dict(upload))
+
+    if request.method not in ("PUT", "PATCH", "POST"):
+        return JsonResponse({"error": "Invalid request method."}, status=405)
+
+    try:
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+        if length == 0 and upload.size is None:
+            upload = finish_upload(upload)
+        else:
+            offset = int(request.headers.get("Upload-Offset", upload.offset))
+            # Read the body as a stream so Django does not buffer or spool it
+            upload = append_chunk(upload, offset, request, length)
+    except ValueError:
+        return JsonResponse({"error": "Upload-Offset and Content-Length must be integers."}, status=400)
+    except UploadError as e:
+        data = upload_to_dict(Upload.objects.get(pk=upload_id))
+        data["error"] = str(e)
+        return JsonResponse(data, status=e.status)
+
+    return JsonResponse(upload_to_dict(upload))
+
+
 def generate_unique_filename(directory, filename):
     base, ext = os.path.splitext(filename)
     counter = 1
@@ -655,135 +915,191 @@ def generate_unique_filename(directory, filename):
     return unique_filename
 
 
-def tool_selector(request):
-    tools_json_path = os.path.join(settings.BASE_DIR, "tools", "tools.json")
+def build_tool_command(request, tool_details, tool_base_dir, streams):
+    """
+    Builds the command line of a tool_selector form submission.
 
-    try:
-         
-        with open(tools_json_path, "r") as f:
-            tools = json.load(f)
-    except FileNotFoundError:
-        tools = {}
+    Returns (command, None), or (None, error response data) for a missing input
+    file. BGZF inputs of tools without "gzip_input" are added to streams.
+    """
+    form_data = request.POST
+    file_data = request.FILES
 
-    selected_tool = request.GET.get("tool")
-    tool_details = None
+    # Base command
+    configured_command = tool_details["command"]
 
      
-    if selected_tool and selected_tool in tools:
-        tool_details = tools[selected_tool]
-
-    if request.method == "POST":
-        form_data = request.POST
-        file_data = request.FILES
-
-        # Base command
-        configured_command = tool_details["command"]
-
-        # Directory structure: media/my_files/<tool_name>
-        tool_base_dir = os.path.join(settings.MEDIA_ROOT, "my_files", selected_tool)
-        os.makedirs(tool_base_dir, exist_ok=True)
+    for option in tool_details["options"]:
+        label = option["label"]
+        flag = option.get("flag")   
+        input_type = option["type"]
 
          
-        for option in tool_details["options"]:
-            label = option["label"]
-            flag = option.get("flag")   
-            input_type = option["type"]
-
-             
-            if input_type == "file":
-                file_path = form_data.get(label, "").strip()
-
-                # If the file is uploaded, save it under the tool's directory
-                if label in file_data:
-                    uploaded_file = file_data[label]
+        if input_type == "file":
+            file_path = form_data.get(label, "").strip()
+
+            # Files sent earlier through the chunked upload API are referenced by id
+            upload_id = form_data.get(f"{label}_upload_id", "").strip()
+            if upload_id:
+                upload = Upload.objects.filter(pk=upload_id, status=Upload.STATUS_COMPLETE).first()
+                if upload is None:
+                    return None, {
+                        "success": False,
+                        "error_output": f"Upload '{upload_id}' does not exist or is not complete."
+                    }
+                file_path = os.path.join(settings.MEDIA_ROOT, upload.path)
+
+            # If the file is uploaded, save it under the tool's directory
+            elif label in file_data:
+                uploaded_file = file_data[label]
+                if blobs.dedup_enabled():
+                    # Stored once however often it is uploaded, and linked into the tool's directory
+                    file_path = blobs.store_chunks(uploaded_file.chunks(), tool_base_dir, uploaded_file.name)
+                else:
                     unique_filename = generate_unique_filename(tool_base_dir, uploaded_file.name)
                     file_path = os.path.join(tool_base_dir, unique_filename)
                     with open(file_path, "wb") as f:
                         for chunk in uploaded_file.chunks():
                             f.write(chunk)
+                    file_path = compress_upload(file_path)
 
-                 
-                if not os.path.isfile(file_path):
-                    return JsonResponse({
-                        "success": False,
-                        "error_output": f"File '{file_path}' does not exist. Please provide a valid file path."
-                    })
+             
+            if not os.path.isfile(file_path):
+                return None, {
+                    "success": False,
+                    "error_output": f"File '{file_path}' does not exist. Please provide a valid file path."
+                }
 
-                 
-                if flag:
-                    configured_command += f" {flag} {file_path}"
-                else:
-                    configured_command += f" {file_path}"
+            # Tools that cannot read gzip get block-compressed inputs through a pipe
+            if not tool_details.get("gzip_input") and bgzf.is_bgzf(file_path):
+                file_path = streams.add(file_path)
 
-            # Handle custom output directories or files
-            elif input_type == "text" and (flag == "-o" or flag == "--output" or "output" in label.lower()):
-                output_path = form_data.get(label, "").strip()
+             
+            if flag:
+                configured_command += f" {flag} {file_path}"
+            else:
+                configured_command += f" {file_path}"
 
-                if output_path:
+        # Handle custom output directories or files
+        elif input_type == "text" and (flag == "-o" or flag == "--output" or "output" in label.lower()):
+            output_path = form_data.get(label, "").strip()
+
+            if output_path:
+                 
+                if "." in os.path.basename(output_path) and len(output_path.split(".")[-1]) > 1:
                      
-                    if "." in os.path.basename(output_path) and len(output_path.split(".")[-1]) > 1:
-                         
-                        sanitized_output = "".join(c for c in output_path if c.isalnum() or c in ("_", "-", "."))
-                        unique_output_file = generate_unique_filename(tool_base_dir, sanitized_output)
-                        output_file = os.path.join(tool_base_dir, unique_output_file)
-
-                         
-                        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-
-                        if flag:
-                            configured_command += f" {flag} {output_file}"
-                        else:
-                            configured_command += f" {output_file}"
-                    else:
-                         
-                        sanitized_output = "".join(c for c in output_path if c.isalnum() or c in ("_", "-"))
-                        unique_output_dir = generate_unique_filename(tool_base_dir, sanitized_output)
-                        output_dir = os.path.join(tool_base_dir, unique_output_dir)
-                        os.makedirs(output_dir, exist_ok=True)
+                    sanitized_output = "".join(c for c in output_path if c.isalnum() or c in ("_", "-", "."))
+                    unique_output_file = generate_unique_filename(tool_base_dir, sanitized_output)
+                    output_file = os.path.join(tool_base_dir, unique_output_file)
 
-                        if flag:
-                            configured_command += f" {flag} {output_dir}"
-                        else:
-                            configured_command += f" {output_dir}"
+                     
+                    os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-             
-            elif input_type in ["text", "number"] and label in form_data:
-                value = form_data[label].strip()
-                if value:
                     if flag:
-                        configured_command += f" {flag} {value}"
+                        configured_command += f" {flag} {output_file}"
                     else:
-                        configured_command += f" {value}"
+                        configured_command += f" {output_file}"
+                else:
+                     
+                    sanitized_output = "".join(c for c in output_path if c.isalnum() or c in ("_", "-"))
+                    unique_output_dir = generate_unique_filename(tool_base_dir, sanitized_output)
+                    output_dir = os.path.join(tool_base_dir, unique_output_dir)
+                    os.makedirs(output_dir, exist_ok=True)
 
-        # Run the command in the terminal as a subprocess
-        try:
-            print(f"Executing command: {configured_command}")   
-
-            result = subprocess.run(
-                configured_command,
-                shell=True,
-                cwd=tool_base_dir,   
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True
-            )
+                    if flag:
+                        configured_command += f" {flag} {output_dir}"
+                    else:
+                        configured_command += f" {output_dir}"
+
+         
+        elif input_type in ["text", "number"] and label in form_data:
+            value = form_data[label].strip()
+            if value:
+                if flag:
+                    configured_command += f" {flag} {value}"
+                else:
+                    configured_command += f" {value}"
+
+    return configured_command, None
 
-             
-            print(f"Command Output:\n{result.stdout}")
 
+async def tool_selector(request):
+    tools = load_tools_config()
+
+    selected_tool = request.GET.get("tool")
+    tool_details = None
+
+     
+    if selected_tool and selected_tool in tools:
+        tool_details = tools[selected_tool]
+
+    if request.method == "POST":
+        # Directory structure: media/my_files/<tool_name>
+        tool_base_dir = os.path.join(settings.MEDIA_ROOT, "my_files", selected_tool)
+        os.makedirs(tool_base_dir, exist_ok=True)
+
+        # Saving uploads and looking up chunked uploads is blocking work
+        streams = bgzf.DecompressedStreams()
+        configured_command, error = await sync_to_async(build_tool_command)(request, tool_details, tool_base_dir, streams)
+        if error:
+            return JsonResponse(error)
+
+        try:
+            timeout = tool_timeout(tool_details.get("timeout"))
+        except (TypeError, ValueError):
+            return JsonResponse({"success": False, "error_output": f"Invalid timeout for {selected_tool}: {tool_details.get('timeout')}"})
+
+        # Full output goes to a log file; only its tail is kept in memory
+        log_path = os.path.join(settings.MEDIA_ROOT, "logs", selected_tool, f"{uuid.uuid4().hex}.log")
+
+        def finish(result):
+            file_index.sync_directory(tool_base_dir)
+            accounting.record_usage(selected_tool, result)
+            if result.terminated == TIMEOUT:
+                print(f"Command Error: timed out after {timeout:g} seconds.")
+                return {
+                    "success": False,
+                    "error_output": f"{selected_tool} did not finish within {timeout:g} seconds and was stopped.\n{result.output.strip()}",
+                    "log_file": os.path.relpath(log_path, settings.MEDIA_ROOT),
+                }
             if result.returncode != 0:
-                print(f"Command Error: Non-zero return code detected. Full output:\n{result.stdout.strip()}")
-                return JsonResponse({
+                print(f"Command Error: Non-zero return code detected. Output tail:\n{result.output.strip()}")
+                return {
                     "success": False,
-                    "error_output": result.stdout.strip()
-                })
-
-             
-            return JsonResponse({
+                    "error_output": result.output.strip(),
+                    "log_file": os.path.relpath(log_path, settings.MEDIA_ROOT),
+                }
+            return {
                 "success": True,
                 "message": "Tool executed successfully! Your files are available in 'My Files'.",
-                "output": result.stdout.strip()
-            })
+                "output": result.output.strip(),
+                "log_file": os.path.relpath(log_path, settings.MEDIA_ROOT),
+            }
+
+        print(f"Executing command: {configured_command}")
+
+        # Streaming mode: forward output line by line as server-sent events
+        if request.GET.get("stream") or request.POST.get("stream"):
+            def run(emit):
+                with streams:
+                    result = run_process(
+                        configured_command, shell=True, cwd=tool_base_dir, log_path=log_path,
+                        on_line=lambda line: emit("log", {"line": line}), timeout=timeout,
+                    )
+                try:
+                    return finish(result)
+                finally:
+                    connection.close()
+
+            return event_stream_response(request, stream_events(run))
+
+        # Run the command in the terminal as a subprocess
+        try:
+            with streams:
+                result = await run_process_async(
+                    configured_command, shell=True, cwd=tool_base_dir, log_path=log_path, timeout=timeout,
+                )
+            return JsonResponse(await sync_to_async(finish)(result))
 
         except Exception as e:
             print(f"An unexpected error occurred: {str(e)}")   
@@ -793,7 +1109,7 @@ def tool_selector(request):
             })
 
      
-    return render(request, "tools/tool_selector.html", {
+    return await sync_to_async(render)(request, "tools/tool_selector.html", {
         "tools": tools,
         "selected_tool": selected_tool,
         "tool_details": tool_details,
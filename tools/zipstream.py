@@ -0,0 +1,101 @@
+"""
+ZIP archives generated while they are being sent.
+
+Members are read from disk in fixed-size chunks and the compressed bytes are
+yielded as soon as zipfile produces them, so memory use does not depend on the
+size of the folder. Formats that are already compressed are stored as is.
+"""
+import io
+import os
+import zipfile
+
+CHUNK_SIZE = 1024 * 1024
+
+# Recompressing these only burns CPU
+STORED_EXTENSIONS = (
+    ".zip", ".gz", ".bgz", ".bz2", ".xz", ".zst", ".bam", ".cram",
+    ".png", ".jpg", ".jpeg", ".gif", ".pdf",
+)
+
+
+class _StreamBuffer(io.RawIOBase):
+    """
+    Write-only, non-seekable file object that collects what zipfile writes until it is drained.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, *args):
+        # Makes zipfile fall back to data descriptors instead of rewriting headers
+        raise io.UnsupportedOperation("seek")
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def compression_for(path):
+    if path.lower().endswith(STORED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def collect_entries(path, arc_prefix=""):
+    """
+    Returns (file_path, arcname) pairs for a file or every file below a folder.
+    """
+    if os.path.isfile(path):
+        return [(path, arc_prefix or os.path.basename(path))]
+
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            entries.append((file_path, os.path.join(arc_prefix, os.path.relpath(file_path, path))))
+    return entries
+
+
+def stream_zip(entries, chunk_size=CHUNK_SIZE):
+    """
+    Yields a ZIP archive of (file_path, arcname) entries chunk by chunk.
+    """
+    buffer = _StreamBuffer()
+
+    with zipfile.ZipFile(buffer, "w", allowZip64=True) as archive:
+        for file_path, arcname in entries:
+            try:
+                info = zipfile.ZipInfo.from_file(file_path, arcname)
+            except OSError:
+                # Deleted while the archive was being built
+                continue
+            info.compress_type = compression_for(file_path)
+
+            with open(file_path, "rb") as src, archive.open(info, "w") as dst:
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    dst.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+
+    # Central directory
+    data = buffer.drain()
+    if data:
+        yield data